@@ -0,0 +1,231 @@
+"""
+Statistics of the admin dashboard, `GET /admin/stats`.
+
+Table sizes and the number of questions of every category are read from the
+planner statistics of PostgreSQL (`pg_class.reltuples` and the most common
+values of `pg_stats`) rather than counted, so they stay cheap on a bank of
+millions of questions. They are estimates, as fresh as the last ANALYZE; on
+other databases, or for a table that was never analyzed, the rows are
+counted instead and reported with `"estimated": false`.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import func, select, text
+
+from models import db, Question
+
+# Upper bounds, in milliseconds, of the latency histogram buckets of a route
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+DEFAULT_CACHE_SECONDS = 5
+DEFAULT_SLOWEST_ROUTES = 10
+
+
+class _RouteTiming:
+    __slots__ = ('requests', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.requests = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def quantile_ms(self, quantile):
+        # The upper bound of the bucket holding the quantile, capped by the slowest request
+        rank = quantile * self.requests
+        seen = 0
+        for bucket, requests in enumerate(self.buckets):
+            seen += requests
+            if seen >= rank:
+                break
+        bound = LATENCY_BUCKETS_MS[bucket] if bucket < len(LATENCY_BUCKETS_MS) else float('inf')
+        return min(bound, round(self.max, 2))
+
+
+"""
+RouteTimings
+
+"""
+class RouteTimings:
+    """
+    Counts the requests and their latency per route of a worker. Latencies
+    go into a fixed histogram per route, so memory does not grow with
+    traffic and the 95th percentile is known to the bucket.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = defaultdict(_RouteTiming)
+
+    def record(self, route, seconds):
+        milliseconds = seconds * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)
+        with self._lock:
+            timing = self._routes[route]
+            timing.requests += 1
+            timing.total += milliseconds
+            timing.max = max(timing.max, milliseconds)
+            timing.buckets[bucket] += 1
+
+    def slowest(self, limit=DEFAULT_SLOWEST_ROUTES):
+        """
+        Returns:
+            list: the `limit` routes with the highest 95th percentile latency
+        """
+        with self._lock:
+            routes = [{
+                'route': route,
+                'requests': timing.requests,
+                'mean_ms': round(timing.total / timing.requests, 2),
+                'p95_ms': timing.quantile_ms(0.95),
+                'max_ms': round(timing.max, 2)
+            } for route, timing in self._routes.items()]
+        routes.sort(key=lambda route: (route['p95_ms'], route['mean_ms']), reverse=True)
+        return routes[:limit]
+
+
+"""
+CachedValue
+
+"""
+class CachedValue:
+    """
+    A value computed at most once every `max_age` seconds. Callers arriving
+    while it is recomputed wait for the result instead of computing it too.
+    """
+
+    def __init__(self, max_age, clock=time.monotonic):
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._value = None
+        self._computed_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, compute):
+        with self._lock:
+            now = self._clock()
+            if self._computed_at is None or now - self._computed_at >= self.max_age:
+                self._value = compute()
+                self._computed_at = now
+                self.misses += 1
+            else:
+                self.hits += 1
+            return self._value
+
+
+def hit_rate(hits, misses):
+    return round(hits / (hits + misses), 4) if hits + misses else None
+
+
+def _is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _schema():
+    # Schema tenants read the unqualified tables through the schema_translate_map
+    # of their engine, which current_schema() knows nothing about
+    translate_map = db.engine.get_execution_options().get('schema_translate_map') or {}
+    return translate_map.get(None) or db.session.execute(text("SELECT current_schema()")).scalar()
+
+
+def _count(table):
+    return db.session.execute(select(func.count()).select_from(table)).scalar()
+
+
+def table_sizes(tables):
+    """
+    Returns:
+        dict: table name -> number of rows and whether it is an estimate
+    """
+    estimates = {}
+    if _is_postgresql():
+        estimates = dict(db.session.execute(text(
+            "SELECT c.relname, c.reltuples FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = :schema AND c.relkind = 'r' AND c.relname = ANY(:names)"),
+            {'schema': _schema(), 'names': [table.name for table in tables]}).all())
+
+    sizes = {}
+    for table in tables:
+        # reltuples is -1 (0 before PostgreSQL 14) until the table is first analyzed
+        estimate = estimates.get(table.name)
+        if estimate is not None and estimate > 0:
+            sizes[table.name] = {'rows': int(estimate), 'estimated': True}
+        else:
+            sizes[table.name] = {'rows': _count(table), 'estimated': False}
+    return sizes
+
+
+def _category_estimates(questions, category_ids):
+    row = db.session.execute(text(
+        "SELECT most_common_vals::text, most_common_freqs FROM pg_stats "
+        "WHERE schemaname = :schema AND tablename = :table AND attname = 'category'"),
+        {'schema': _schema(), 'table': Question.__tablename__}).first()
+    if row is None or row[0] is None:
+        return None
+
+    values = [int(value) for value in row[0].strip('{}').split(',') if value]
+    sizes = {value: round(frequency * questions) for value, frequency in zip(values, row[1])}
+    # The categories that are not among the most common values share the rest evenly
+    others = [category_id for category_id in category_ids if category_id not in sizes]
+    if others:
+        rest = max(questions - sum(sizes.values()), 0)
+        sizes.update((category_id, rest // len(others)) for category_id in others)
+    return sizes
+
+
+def category_sizes(category_ids, questions):
+    """
+    Args:
+        questions (dict): the size of the questions table, as returned by `table_sizes`
+
+    Returns:
+        tuple: category id -> number of questions, and whether they are estimates
+    """
+    if questions['estimated']:
+        sizes = _category_estimates(questions['rows'], category_ids)
+        if sizes is not None:
+            return sizes, True
+    sizes = dict(db.session.execute(
+        select(Question.category, func.count()).group_by(Question.category)).all())
+    return sizes, False
+
+
+def category_skew(sizes, category_types):
+    """
+    Returns:
+        dict: the questions of every category, largest first, the share of the
+            largest category and its size relative to the mean category
+    """
+    categories = sorted(
+        ({'id': category_id, 'type': category_types.get(category_id), 'questions': sizes.get(category_id, 0)}
+         for category_id in set(category_types) | set(sizes)),
+        key=lambda category: (-category['questions'], category['id'] or 0))
+    total = sum(category['questions'] for category in categories)
+    largest = categories[0]['questions'] if categories else 0
+    return {
+        'categories': categories,
+        'largest_share': round(largest / total, 4) if total else None,
+        'max_to_mean': round(largest * len(categories) / total, 2) if total else None
+    }
+
+
+def pool_stats(engine):
+    """
+    Returns:
+        dict: the connections of the SQLAlchemy pool of `engine`, where the pool class reports them
+    """
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    for key, method in (('size', 'size'), ('checked_out', 'checkedout'),
+                        ('checked_in', 'checkedin'), ('overflow', 'overflow')):
+        if callable(getattr(pool, method, None)):
+            stats[key] = getattr(pool, method)()
+    if 'size' in stats and 'checked_out' in stats:
+        stats['usage'] = round(stats['checked_out'] / stats['size'], 4) if stats['size'] else None
+    return stats
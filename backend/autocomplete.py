@@ -0,0 +1,194 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from itertools import chain, islice
+
+from models import Question
+
+_word = re.compile(r'\w+')
+
+# Upper bound of completions looked at for a very short prefix
+MAX_SCANNED_TERMS = 1000
+
+
+def tokenize(text):
+    return _word.findall((text or '').lower())
+
+
+"""
+PrefixIndex
+
+"""
+class PrefixIndex:
+    """
+    In-memory typeahead index over question text.
+
+    Distinct words are kept in a sorted list, so the words starting with a
+    prefix are a contiguous range found with `bisect`. Each word maps to the
+    ids of the questions containing it. Lookups never scan the whole bank.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._terms = []      # sorted distinct words
+        self._postings = {}   # word -> set of question ids
+        self._texts = {}      # question id -> question text
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, question_id, text):
+        with self._lock:
+            if question_id in self._texts:
+                self.remove(question_id)
+            self._texts[question_id] = text
+            for term in set(tokenize(text)):
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = set()
+                    insort(self._terms, term)
+                postings.add(question_id)
+
+    def replace(self, texts, postings):
+        """
+        Replaces the whole index by `texts` (question id -> text) and their
+        `postings` (word -> set of question ids), built elsewhere.
+        """
+        terms = sorted(postings)
+        with self._lock:
+            self._texts, self._postings, self._terms = dict(texts), dict(postings), terms
+
+    def load(self, rows):
+        """
+        Replaces the whole index by the questions of `rows`, (id, text) pairs,
+        tokenized in one pass with the words sorted once at the end.
+        """
+        texts, postings = {}, defaultdict(set)
+        for question_id, text in rows:
+            texts[question_id] = text
+            for term in tokenize(text):
+                postings[term].add(question_id)
+        self.replace(texts, postings)
+
+    def remove(self, question_id):
+        with self._lock:
+            text = self._texts.pop(question_id, None)
+            if text is None:
+                return
+            for term in set(tokenize(text)):
+                postings = self._postings[term]
+                postings.discard(question_id)
+                if not postings:
+                    del self._postings[term]
+                    del self._terms[bisect_left(self._terms, term)]
+
+    def _completions(self, prefix):
+        terms = self._terms
+        for position in range(bisect_left(terms, prefix), len(terms)):
+            if not terms[position].startswith(prefix):
+                break
+            yield terms[position]
+
+    @staticmethod
+    def _matching(postings, required):
+        # Lazily yields the ids of `postings` that are also in `required`
+        if required is None:
+            return iter(postings)
+        smaller, larger = (postings, required) if len(postings) <= len(required) else (required, postings)
+        return (question_id for question_id in smaller if question_id in larger)
+
+    def complete(self, text, limit=5):
+        """
+        Completes the last word of `text` and finds questions containing every
+        other word of `text` plus a completion of the last one.
+
+        Returns:
+            dict: up to `limit` completed `terms` and `questions` as {'id', 'question'}
+        """
+        words = tokenize(text)
+        if not words:
+            return {'terms': [], 'questions': []}
+        *complete_words, prefix = words
+        if text[-1:].isspace():
+            # The last word is finished, there is nothing to complete
+            complete_words, prefix = words, None
+
+        with self._lock:
+            required = None
+            # Intersect the smallest postings first
+            for postings in sorted((self._postings.get(word, set()) for word in complete_words), key=len):
+                required = postings if required is None else required & postings
+                if not required:
+                    return {'terms': [], 'questions': []}
+
+            if prefix is None:
+                return {
+                    'terms': [],
+                    'questions': [{'id': question_id, 'question': self._texts[question_id]}
+                                  for question_id in islice(required, limit)]
+                }
+
+            terms, question_ids = [], []
+            seen = set()
+            for term in islice(self._completions(prefix), MAX_SCANNED_TERMS):
+                matches = self._matching(self._postings[term], required)
+                first = next(matches, None)
+                if first is None:
+                    continue
+                if len(terms) < limit:
+                    terms.append(term)
+                if len(question_ids) < limit:
+                    for question_id in chain((first,), matches):
+                        if question_id not in seen:
+                            seen.add(question_id)
+                            question_ids.append(question_id)
+                            if len(question_ids) == limit:
+                                break
+                elif len(terms) == limit:
+                    break
+
+            return {
+                'terms': terms,
+                'questions': [{'id': question_id, 'question': self._texts[question_id]}
+                              for question_id in question_ids]
+            }
+
+
+"""
+QuestionPrefixIndex
+
+"""
+class QuestionPrefixIndex(PrefixIndex):
+    """
+    A `PrefixIndex` over `questions.question`, built from the database on first use
+    and kept in sync with `add_question` and `discard` when questions are created or deleted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self.load(Question.query.with_entities(Question.id, Question.question).yield_per(1000))
+
+    def replace(self, texts, postings):
+        super().replace(texts, postings)
+        self._loaded = True
+
+    def add_question(self, question):
+        if self._loaded:
+            self.add(question.id, question.question)
+
+    def discard(self, question_id):
+        if self._loaded:
+            self.remove(question_id)
+
+    def complete(self, text, limit=5):
+        self.ensure_loaded()
+        return super().complete(text, limit)
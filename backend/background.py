@@ -0,0 +1,46 @@
+import atexit
+import threading
+import time
+
+from models import db
+
+
+class PeriodicTask:
+    """
+    Runs `func` inside an application context every `interval` seconds on a
+    daemon thread. The thread is only started by the first call to `start`, so
+    creating the task is free for processes that never need it.
+    """
+
+    def __init__(self, app, name, interval, func, run_at_exit=False):
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_at_exit = run_at_exit
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+                if self.run_at_exit:
+                    atexit.register(self.run_once)
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                return self.func()
+            except Exception:
+                self.app.logger.exception(f"Background task {self.name} failed")
+            finally:
+                db.session.remove()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
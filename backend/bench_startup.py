@@ -0,0 +1,62 @@
+"""
+Measures the cold start of a worker: importing the app package, `create_app()`
+and the first request, each in a fresh interpreter so nothing is cached.
+
+Usage (from the backend folder):
+    python bench_startup.py [--runs 10] [--database-url postgresql://...] [--path /categories]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]} if sys.argv[1] else None)
+created = time.perf_counter()
+status = None
+if sys.argv[2]:
+    status = app.test_client().get(sys.argv[2]).status_code
+first_request = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_request': first_request - created,
+    'total': first_request - start,
+    'status': status,
+}))
+"""
+
+
+def run_once(database_url, path):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, database_url or '', path or ''],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--path', default='/categories',
+                        help='path of the first request, empty to skip it')
+    args = parser.parse_args()
+
+    runs = [run_once(args.database_url, args.path) for _ in range(args.runs)]
+
+    print(f"{'phase':<15}{'median ms':>12}{'max ms':>12}")
+    for phase in ('import', 'create_app', 'first_request', 'total'):
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:<15}{statistics.median(values):>12.1f}{max(values):>12.1f}")
+    statuses = {run['status'] for run in runs}
+    if statuses != {200} and args.path:
+        print(f"warning: first request returned {statuses}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import random
+import threading
+from array import array
+
+from sqlalchemy import select
+
+from models import db, Question
+from sampling import weighted_pool_sample
+
+
+"""
+CategoryPools
+
+"""
+class CategoryPools:
+    """
+    The ids of the questions of every category, as one array per category.
+
+    The pools are read from the database on first use and kept in sync with
+    `add` and `discard`. Removing an id moves the last id of its pool into its
+    place, so both take constant time and the pools never have holes, which
+    lets `sample` draw an id with a single random index.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}      # category id -> array of question ids
+        self._positions = {}  # question id -> (category id, index in the pool)
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            rows = db.session.execute(
+                select(Question.id, Question.category).execution_options(stream_results=True))
+            for question_id, category in rows:
+                self._add(question_id, category)
+            self._loaded = True
+
+    def _add(self, question_id, category):
+        pool = self._pools.get(category)
+        if pool is None:
+            pool = self._pools[category] = array('q')
+        self._positions[question_id] = (category, len(pool))
+        pool.append(question_id)
+
+    def _discard(self, question_id):
+        category, position = self._positions.pop(question_id)
+        pool = self._pools[category]
+        last = pool.pop()
+        if last != question_id:
+            pool[position] = last
+            self._positions[last] = (category, position)
+
+    def add(self, question_id, category):
+        if not self._loaded:
+            return
+        with self._lock:
+            if self._positions.get(question_id, (None,))[0] == category:
+                return
+            if question_id in self._positions:
+                self._discard(question_id)
+            self._add(question_id, category)
+
+    def discard(self, question_id):
+        if not self._loaded:
+            return
+        with self._lock:
+            if question_id in self._positions:
+                self._discard(question_id)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def sizes(self):
+        """
+        Returns:
+            dict: category id -> number of questions, without loading the pools
+        """
+        with self._lock:
+            return {category: len(pool) for category, pool in self._pools.items() if pool}
+
+    def size(self, category):
+        self.ensure_loaded()
+        return len(self._pools.get(category, ()))
+
+    def sample(self, weights, count, exclude=(), rng=random):
+        """
+        Picks up to `count` distinct question ids not in `exclude`, each from a
+        category drawn with the probability of its weight.
+
+        Args:
+            weights (dict): category id -> positive weight
+        """
+        self.ensure_loaded()
+        with self._lock:
+            return weighted_pool_sample(self._pools, weights, count, exclude, rng)
@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+
+from sqlalchemy import event, func, inspect, select
+
+from background import PeriodicTask
+from models import db, Question, Category, QuestionTranslation, ChangeEvent
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+BULK_UPDATE = 'bulk_update'
+
+# A sequence number that is still missing after this many seconds belongs to a
+# transaction that rolled back and is not waited for anymore
+GAP_TIMEOUT = 10
+
+TAIL_BATCH_SIZE = 1000
+
+_change_events = ChangeEvent.__table__
+# model -> (entity name, attribute holding the entity id)
+_entities = {
+    Question: ('question', 'id'),
+    Category: ('category', 'id'),
+    QuestionTranslation: ('translation', 'question_id'),
+}
+
+
+def _record(connection, entity, entity_id, operation, data=None):
+    connection.execute(_change_events.insert().values(
+        entity=entity, entity_id=entity_id, operation=operation,
+        data=json.dumps(data) if data is not None else None, created_at=time.time()))
+
+
+def _changed_fields(target):
+    state = inspect(target)
+    return sorted(attribute.key for attribute in state.attrs if attribute.history.has_changes())
+
+
+def _listen(model, entity, id_attribute):
+    # The events are written on the connection of the flush, so they are
+    # committed or rolled back with the change itself (a transactional outbox)
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        _record(connection, entity, getattr(target, id_attribute), INSERT, _event_data(target))
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        fields = _changed_fields(target)
+        if fields:
+            _record(connection, entity, getattr(target, id_attribute), UPDATE,
+                    dict(_event_data(target) or {}, fields=fields))
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        _record(connection, entity, getattr(target, id_attribute), DELETE, _event_data(target))
+
+
+def _event_data(target):
+    # A translation is identified by its question and its locale
+    if isinstance(target, QuestionTranslation):
+        return {'locale': target.locale}
+    return None
+
+
+for _model, (_entity, _id_attribute) in _entities.items():
+    _listen(_model, _entity, _id_attribute)
+
+
+def record_bulk_update(entity, ids, fields):
+    """
+    Records a bulk update made without the ORM, in the current transaction.
+    Must be called within an application context.
+    """
+    if ids:
+        _record(db.session.connection(), entity, None, BULK_UPDATE,
+                {'ids': list(ids), 'fields': list(fields)})
+
+
+def changed_ids(events, entity, fields=None):
+    """
+    Splits the changes of `entity` into the ids that were inserted or updated
+    and the ids that were deleted. With `fields`, updates of other fields are ignored.
+
+    Returns:
+        tuple: the set of upserted ids and the set of deleted ids
+    """
+    upserted, deleted = set(), set()
+    for change in events:
+        if change['entity'] != entity:
+            continue
+        data = change['data'] or {}
+        if change['operation'] in (UPDATE, BULK_UPDATE) and fields is not None \
+                and not set(fields) & set(data.get('fields', ())):
+            continue
+        ids = data['ids'] if change['operation'] == BULK_UPDATE else [change['entity_id']]
+        if change['operation'] == DELETE:
+            upserted.difference_update(ids)
+            deleted.update(ids)
+        else:
+            deleted.difference_update(ids)
+            upserted.update(ids)
+    return upserted, deleted
+
+
+"""
+ChangeFeedTail
+
+"""
+class ChangeFeedTail:
+    """
+    Follows the `change_events` table and hands new events to the subscribers,
+    so that every worker can keep its in-memory indexes and caches up to date
+    with the writes of the other workers.
+
+    The position is the highest sequence number up to which every event was
+    delivered. Sequence numbers are allocated before commit, so a transaction
+    may commit after a later one; events past a gap are delivered once and
+    remembered until the gap is filled or older than `GAP_TIMEOUT`. Subscribers
+    are called with a list of `ChangeEvent.format()` dictionaries and must
+    tolerate an event they already applied.
+    """
+
+    def __init__(self, app, poll_interval=1):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._position = None
+        self._delivered = set()  # delivered sequence numbers above the position
+        self._gaps = {}          # missing sequence number -> first time it was seen missing
+        self.applied = 0
+        self._poller = PeriodicTask(app, 'change-feed-tail', poll_interval, self.poll)
+
+    @property
+    def position(self):
+        return self._position
+
+    def subscribe(self, subscriber):
+        self._subscribers.append(subscriber)
+
+    def start(self):
+        """
+        Starts following the feed from its current end. Must be called within an
+        application context, before the subscribers load their initial state.
+        """
+        if self._position is None:
+            with self._lock:
+                if self._position is None:
+                    self._position = db.session.execute(
+                        select(func.coalesce(func.max(ChangeEvent.seq), 0))).scalar()
+        self._poller.start()
+
+    def poll(self):
+        """
+        Delivers the events committed since the last poll.
+        Must be called within an application context.
+
+        Returns:
+            int: The number of events delivered
+        """
+        if self._position is None:
+            self.start()
+        with self._lock:
+            rows = db.session.execute(
+                select(ChangeEvent).where(ChangeEvent.seq > self._position)
+                .order_by(ChangeEvent.seq).limit(TAIL_BATCH_SIZE)).scalars().all()
+            events = [row.format() for row in rows if row.seq not in self._delivered]
+            db.session.rollback()
+
+            if events:
+                for subscriber in self._subscribers:
+                    subscriber(events)
+                self.applied += len(events)
+            self._advance([row.seq for row in rows])
+            return len(events)
+
+    def _advance(self, seqs):
+        now = time.time()
+        self._delivered.update(seqs)
+        if seqs:
+            for missing in set(range(self._position + 1, max(seqs))) - self._delivered:
+                self._gaps.setdefault(missing, now)
+        while True:
+            following = self._position + 1
+            if following in self._delivered:
+                self._delivered.discard(following)
+            elif following in self._gaps and now - self._gaps[following] > GAP_TIMEOUT:
+                pass
+            else:
+                break
+            self._gaps.pop(following, None)
+            self._position = following
+
+    def stats(self):
+        return {
+            'position': self._position,
+            'applied': self.applied,
+            'pending_gaps': len(self._gaps)
+        }
+
+
+def prune_change_events(older_than):
+    """
+    Deletes the events older than `older_than` seconds.
+    Must be called within an application context.
+
+    Returns:
+        int: The number of deleted events
+    """
+    result = db.session.execute(
+        _change_events.delete().where(_change_events.c.created_at < time.time() - older_than))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,223 @@
+import re
+import threading
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from models import Question
+
+# (2 ** 61) - 1, the Mersenne prime used for the universal hash family
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+SHINGLE_SIZE = 4
+
+_non_word = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    return _non_word.sub(' ', (text or '').lower()).strip()
+
+
+def shingles(text):
+    """
+    Returns the set of character shingles of the normalized text.
+    Character shingles are used rather than words because trivia questions are
+    short and paraphrases often only differ in word endings or articles.
+    """
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def question_text(question, answer):
+    return f"{question} {answer}"
+
+
+"""
+MinHashLSH
+
+"""
+class MinHashLSH:
+    """
+    Near-duplicate index over question text.
+
+    Every question is reduced to a MinHash signature of `num_perm` values whose
+    agreement estimates the Jaccard similarity of the shingle sets. Signatures are
+    split into `bands` bands which are hashed into buckets, so a lookup only
+    compares against the questions sharing at least one bucket instead of the
+    whole bank. With the default 32 bands of 4 rows, pairs above ~0.4 similarity
+    are very likely to share a bucket.
+    """
+
+    def __init__(self, num_perm=128, bands=32, threshold=0.7, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.seed = seed
+
+        # A fixed seed keeps signatures comparable between processes
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, int(MERSENNE_PRIME), num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, int(MERSENNE_PRIME), num_perm, dtype=np.uint64)
+
+        self._lock = threading.RLock()
+        self._buckets = [defaultdict(set) for _ in range(bands)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key):
+        return key in self._signatures
+
+    def signature(self, text):
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)), dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=0)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes()
+                for band in range(self.bands)]
+
+    def insert(self, key, text=None, signature=None):
+        if signature is None:
+            signature = self.signature(text)
+        with self._lock:
+            if key in self._signatures:
+                self.remove(key)
+            self._signatures[key] = signature
+            for band, band_key in enumerate(self._band_keys(signature)):
+                self._buckets[band][band_key].add(key)
+
+    def load_signatures(self, signatures):
+        """
+        Replaces the whole index by `signatures` (key -> signature), for
+        signatures computed elsewhere, for example by a pool of processes.
+        """
+        buckets = [defaultdict(set) for _ in range(self.bands)]
+        for key, signature in signatures.items():
+            for band, band_key in enumerate(self._band_keys(signature)):
+                buckets[band][band_key].add(key)
+        with self._lock:
+            self._signatures = dict(signatures)
+            self._buckets = buckets
+
+    def remove(self, key):
+        with self._lock:
+            signature = self._signatures.pop(key, None)
+            if signature is None:
+                return
+            for band, band_key in enumerate(self._band_keys(signature)):
+                bucket = self._buckets[band].get(band_key)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band][band_key]
+
+    def query(self, text=None, signature=None, threshold=None, exclude=None):
+        """
+        Returns the (key, estimated similarity) pairs above `threshold`, most similar first.
+        """
+        if signature is None:
+            signature = self.signature(text)
+        threshold = self.threshold if threshold is None else threshold
+
+        with self._lock:
+            candidates = set()
+            for band, band_key in enumerate(self._band_keys(signature)):
+                candidates |= self._buckets[band].get(band_key, set())
+            candidates.discard(exclude)
+            matches = [
+                (key, float(np.mean(self._signatures[key] == signature)))
+                for key in candidates
+            ]
+        return sorted(
+            (match for match in matches if match[1] >= threshold), key=lambda match: -match[1])
+
+    def clusters(self, threshold=None):
+        """
+        Groups every indexed key with its near-duplicates.
+
+        Returns:
+            list: lists of keys with more than one member, largest cluster first
+        """
+        with self._lock:
+            signatures = dict(self._signatures)
+
+        parent = {}
+
+        def find(key):
+            root = key
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while key != root:
+                parent[key], key = root, parent.get(key, key)
+            return root
+
+        for key, signature in signatures.items():
+            for other, _ in self.query(signature=signature, threshold=threshold, exclude=key):
+                root, other_root = find(key), find(other)
+                if root != other_root:
+                    parent[max(root, other_root)] = min(root, other_root)
+
+        groups = defaultdict(list)
+        for key in signatures:
+            groups[find(key)].append(key)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1),
+                      key=lambda group: (-len(group), group[0]))
+
+
+"""
+QuestionDuplicateIndex
+
+"""
+class QuestionDuplicateIndex(MinHashLSH):
+    """
+    A `MinHashLSH` over the question bank. The index is built from the `questions`
+    table on first use and must be kept in sync with `add` and `discard` when
+    questions are created or deleted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            rows = Question.query.with_entities(
+                Question.id, Question.question, Question.answer).yield_per(1000)
+            for question_id, question, answer in rows:
+                super().insert(question_id, question_text(question, answer))
+            self._loaded = True
+
+    def load_signatures(self, signatures):
+        super().load_signatures(signatures)
+        self._loaded = True
+
+    def add(self, question):
+        if self._loaded:
+            self.insert(question.id, question_text(question.question, question.answer))
+
+    def discard(self, question_id):
+        if self._loaded:
+            self.remove(question_id)
+
+    def near_duplicates(self, question, answer):
+        """
+        Returns the ids and similarity of existing questions that look like a paraphrase.
+        """
+        self.ensure_loaded()
+        return [
+            {'id': question_id, 'similarity': round(similarity, 2)}
+            for question_id, similarity in self.query(question_text(question, answer))
+        ]
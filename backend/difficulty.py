@@ -0,0 +1,109 @@
+import numpy as np
+from sqlalchemy import bindparam, select, text
+
+from models import db, Question, QuestionStat
+from changefeed import record_bulk_update
+
+# Number of ids sent in a single `UPDATE ... WHERE id IN (...)` statement
+UPDATE_CHUNK_SIZE = 5000
+
+
+def compute_difficulty(answers, correct, levels=5, prior_weight=10):
+    """
+    Maps observed answer counts to difficulty levels.
+
+    The correct rate of every question is smoothed towards the rate of the whole
+    bank, so questions with few answers are not pushed to the extremes, and then
+    split into `levels` equal-width bins: the highest rates get difficulty 1 and
+    the lowest get difficulty `levels`.
+
+    Args:
+        answers (numpy.ndarray): number of answers of each question
+        correct (numpy.ndarray): number of correct answers of each question
+        levels (int): number of difficulty levels
+        prior_weight (float): number of answers the bank-wide rate is worth
+
+    Returns:
+        numpy.ndarray: the difficulty of each question
+    """
+    answers = answers.astype(np.float64)
+    correct = correct.astype(np.float64)
+    total_answers = answers.sum()
+    prior = correct.sum() / total_answers if total_answers else 0.5
+
+    rate = (correct + prior_weight * prior) / (answers + prior_weight)
+    return (levels - np.floor(rate * levels)).clip(1, levels).astype(np.int64)
+
+
+def _analyze(table):
+    # Schema tenants reach their tables through the schema_translate_map of
+    # their engine, which a textual statement does not go through
+    preparer = db.engine.dialect.identifier_preparer
+    schema = (db.engine.get_execution_options().get('schema_translate_map') or {}).get(None)
+    name = preparer.quote(table.name)
+    if schema:
+        name = f"{preparer.quote_schema(schema)}.{name}"
+    db.session.execute(text(f"ANALYZE {name}"))
+
+
+def recalibrate_difficulty(min_answers=20, levels=5, prior_weight=10, dry_run=False):
+    """
+    Recomputes the difficulty of every question with at least `min_answers` answers
+    from the `question_stats` table and writes the changed values back in bulk.
+    Must be called within an application context.
+
+    Returns:
+        dict: the number of questions considered and updated per difficulty level
+    """
+    stats = QuestionStat.__table__
+    questions = Question.__table__
+
+    rows = db.session.execute(
+        select(stats.c.question_id, stats.c.answers, stats.c.correct, questions.c.difficulty)
+        .join(questions, questions.c.id == stats.c.question_id)
+        .where(stats.c.answers >= min_answers)
+    ).fetchall()
+
+    if not rows:
+        return {'considered': 0, 'updated': 0, 'levels': {}}
+
+    data = np.array(rows, dtype=np.float64)
+    ids = data[:, 0].astype(np.int64)
+    current = np.nan_to_num(data[:, 3], nan=0).astype(np.int64)
+    new = compute_difficulty(data[:, 1], data[:, 2], levels, prior_weight)
+
+    changed = new != current
+    updated = {}
+
+    # Every changed question gets one of `levels` values, so the write is one
+    # `UPDATE ... WHERE id IN (...)` per level and chunk instead of one per row
+    statement = (questions.update()
+                 .where(questions.c.id.in_(bindparam('ids', expanding=True)))
+                 .values(difficulty=bindparam('difficulty')))
+    for level in range(1, levels + 1):
+        level_ids = ids[changed & (new == level)]
+        if len(level_ids) == 0:
+            continue
+        updated[level] = int(len(level_ids))
+        if dry_run:
+            continue
+        for start in range(0, len(level_ids), UPDATE_CHUNK_SIZE):
+            db.session.execute(statement, {
+                'ids': level_ids[start:start + UPDATE_CHUNK_SIZE].tolist(),
+                'difficulty': level
+            })
+
+    if not dry_run:
+        # One change feed event for the whole job instead of one per question
+        record_bulk_update('question', ids[changed].tolist(), ['difficulty'])
+        db.session.commit()
+        if db.engine.dialect.name == 'postgresql':
+            # Refresh the planner statistics of the difficulty column
+            _analyze(questions)
+            db.session.commit()
+
+    return {
+        'considered': int(len(ids)),
+        'updated': int(changed.sum()),
+        'levels': updated
+    }
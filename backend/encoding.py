@@ -0,0 +1,74 @@
+import gzip
+
+from flask import current_app, jsonify, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+COLUMNAR_SHAPE = 'columnar'
+
+# Responses smaller than this are not worth the compression CPU
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+
+
+def to_columnar(rows):
+    """
+    Turns a list of dictionaries into a dictionary of parallel lists, so the key
+    names are sent once instead of once per row.
+
+    Sample: [{'id': 1, 'answer': 'Agra'}, {'id': 2, 'answer': 'Escher'}]
+        becomes {'id': [1, 2], 'answer': ['Agra', 'Escher']}
+    """
+    if not rows:
+        return {}
+    return {key: [row[key] for row in rows] for key in rows[0]}
+
+
+def _compress(response):
+    min_size = current_app.config.get('COMPRESSION_MIN_SIZE', DEFAULT_COMPRESSION_MIN_SIZE)
+    if response.content_length is None or response.content_length < min_size:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(response.get_data(), quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def listing_response(payload, rows_key='questions'):
+    """
+    Serializes the payload of a listing endpoint according to the request.
+
+    - `?shape=columnar` sends `payload[rows_key]` as parallel arrays (see `to_columnar`)
+      and adds `"shape": "columnar"` to the payload.
+    - `Accept: application/x-msgpack` encodes the payload with MessagePack when it is installed.
+    - `Accept-Encoding: br` or `gzip` compresses bodies of at least `COMPRESSION_MIN_SIZE` bytes.
+
+    Without any of them the response is the same JSON as `jsonify(payload)`.
+    """
+    if request.args.get('shape') == COLUMNAR_SHAPE:
+        payload = dict(payload, shape=COLUMNAR_SHAPE)
+        payload[rows_key] = to_columnar(payload[rows_key])
+
+    offered = [JSON_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack is not None else [])
+    if request.accept_mimetypes.best_match(offered, default=JSON_MIMETYPE) == MSGPACK_MIMETYPE:
+        response = current_app.response_class(
+            msgpack.packb(payload, use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(payload)
+
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return _compress(response)
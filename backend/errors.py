@@ -0,0 +1,92 @@
+import threading
+from collections import defaultdict
+
+
+"""
+TriviaError
+
+"""
+class TriviaError(Exception):
+    """
+    Base class of the errors of the question bank. The app renders them like
+    the HTTP errors raised with `abort`, with `status_code` and `message`.
+    """
+
+    status_code = 500
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class QuestionNotFound(TriviaError):
+    status_code = 404
+
+    def __init__(self, question_id):
+        super().__init__(f"Question with `id` {question_id} does not exist")
+        self.question_id = question_id
+
+
+class CategoryNotFound(TriviaError):
+    status_code = 404
+
+    def __init__(self, category_id):
+        super().__init__(f"The category with ID {category_id} does not exist")
+        self.category_id = category_id
+
+
+class DuplicateQuestion(TriviaError):
+    status_code = 422
+
+    def __init__(self, question_id, message=None):
+        super().__init__(message or f"The question already exists with an ID {question_id}")
+        self.question_id = question_id
+
+
+class PersistenceError(TriviaError):
+    """
+    A database write failed. The session was rolled back, so the next
+    statement of the request or of the next request starts from a clean
+    transaction.
+    """
+
+    status_code = 500
+
+
+def error_message(error):
+    """
+    Returns the message given with `abort(code, description={'custom_message': ...})`, or None.
+    """
+    description = getattr(error, 'description', None)
+    if isinstance(description, dict):
+        return description.get('custom_message') or None
+    return None
+
+
+"""
+ErrorCounters
+
+"""
+class ErrorCounters:
+    """
+    Counts the error responses of a worker by status code and by error type,
+    the name of the exception class (`NotFound`, `QuestionNotFound`,
+    `OperationalError`, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_status = defaultdict(int)
+        self._by_type = defaultdict(int)
+
+    def record(self, status_code, error_type):
+        with self._lock:
+            self._by_status[status_code] += 1
+            self._by_type[error_type] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'by_status': dict(self._by_status),
+                'by_type': dict(self._by_type)
+            }
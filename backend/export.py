@@ -0,0 +1,176 @@
+import csv
+import importlib.util
+import io
+import json
+import zlib
+
+from sqlalchemy import select
+
+from models import db, Question, Category
+
+# pyarrow is optional and slow to import, it is only imported for columnar exports
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+EXPORT_FIELDS = ('id', 'question', 'answer', 'category', 'category_type', 'difficulty')
+EXPORT_BATCH_SIZE = 1000
+
+TEXT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+COLUMNAR_FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+COMPRESSIONS = ('gzip',)
+
+
+def available_formats():
+    return tuple(TEXT_FORMATS) + (tuple(COLUMNAR_FORMATS) if HAS_PYARROW else ())
+
+
+def iter_question_batches(category=None, after_id=0, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields lists of question rows ordered by id, starting after `after_id`.
+
+    The rows are read through a server-side cursor, so only one batch is held
+    in memory no matter how large the bank is. Categories are small and are
+    joined in memory as the `category_type` column.
+    """
+    category_types = dict(db.session.query(Category.id, Category.type))
+
+    questions = Question.__table__
+    statement = (select(questions.c.id, questions.c.question, questions.c.answer,
+                        questions.c.category, questions.c.difficulty)
+                 .where(questions.c.id > after_id)
+                 .order_by(questions.c.id))
+    if category is not None:
+        statement = statement.where(questions.c.category == category)
+
+    result = db.session.execute(statement, execution_options={'stream_results': True})
+    for partition in result.partitions(batch_size):
+        yield [
+            {
+                'id': question_id,
+                'question': question,
+                'answer': answer,
+                'category': question_category,
+                'category_type': category_types.get(question_category),
+                'difficulty': difficulty
+            }
+            for question_id, question, answer, question_category, difficulty in partition
+        ]
+
+
+def _ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(row) + '\n' for row in batch).encode('utf-8')
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _DrainableSink(io.RawIOBase):
+    # A write-only file whose content is handed out as soon as it is written
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _columnar_chunks(batches, format):
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('question', pyarrow.string()),
+        ('answer', pyarrow.string()),
+        ('category', pyarrow.int64()),
+        ('category_type', pyarrow.string()),
+        ('difficulty', pyarrow.int64()),
+    ])
+    sink = _DrainableSink()
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+        write = writer.write_table
+        to_arrow = pyarrow.Table.from_pylist
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+        to_arrow = pyarrow.RecordBatch.from_pylist
+
+    for batch in batches:
+        # Every batch becomes one parquet row group or one arrow record batch
+        write(to_arrow(batch, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_questions(format='ndjson', category=None, after_id=0, compress=None,
+                     batch_size=EXPORT_BATCH_SIZE):
+    """
+    Streams the question bank in the given format.
+    Must be consumed within an application context.
+
+    Args:
+        format (str): one of `available_formats()`
+        category (int): only export the questions of this category
+        after_id (int): resume an export after the last id already received
+        compress (str): None or 'gzip'
+
+    Returns:
+        tuple: the mimetype, the file extension and an iterator of bytes
+    """
+    batches = iter_question_batches(category, after_id, batch_size)
+
+    if format in TEXT_FORMATS:
+        mimetype, extension = TEXT_FORMATS[format]
+        chunks = _ndjson_chunks(batches) if format == 'ndjson' else _csv_chunks(batches)
+    elif format in COLUMNAR_FORMATS and HAS_PYARROW:
+        mimetype, extension = COLUMNAR_FORMATS[format]
+        chunks = _columnar_chunks(batches, format)
+    else:
+        raise ValueError(f"Unsupported export format {format}")
+
+    if compress == 'gzip':
+        return 'application/gzip', f"{extension}.gz", _gzip_chunks(chunks)
+    elif compress:
+        raise ValueError(f"Unsupported compression {compress}")
+    return mimetype, extension, chunks
@@ -0,0 +1,209 @@
+"""
+Database fixtures for the test suites.
+
+Every test process (every pytest-xdist worker) builds its own SQLite database
+file in the temp folder, seeded from `trivia.psql` or with a generated bank of
+questions, and every test runs inside a transaction that is rolled back
+afterwards. Tests can therefore run in parallel and in any order.
+
+Set `TEST_DATABASE_URL` to run against an existing database instead, for
+example the Postgres `trivia_test` database restored from `trivia.psql`.
+"""
+import atexit
+import os
+import random
+import re
+import tempfile
+import unittest
+
+from sqlalchemy import event, insert
+
+from flaskr import create_app
+from models import db, create_tables, Question, Category
+
+SEED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+
+# Configuration of every test app: no rate limiting and no background threads
+# writing outside of the test transaction
+TEST_CONFIG = {
+    'RATE_LIMIT_ENABLED': False,
+    'LEADERBOARD_SNAPSHOT_SECONDS': 0,
+    'QUESTION_STATS_FLUSH_SECONDS': 0,
+    'CHANGE_FEED_POLL_SECONDS': 0,
+}
+
+_WORDS = ('river mountain painter empire planet ocean novel battle element '
+          'composer island festival desert canvas orbit dynasty molecule '
+          'stadium theatre glacier volcano sculpture treaty galaxy').split()
+
+_databases = {}
+
+
+def _copy_rows(text, table):
+    # Rows of the `COPY public.<table> (...) FROM stdin;` block of a pg_dump
+    match = re.search(r'COPY public\.%s \((.*?)\) FROM stdin;\n(.*?)\\\.' % table, text, re.S)
+    columns = match.group(1).split(', ')
+    return [dict(zip(columns, line.split('\t'))) for line in match.group(2).splitlines()]
+
+
+def seed_rows(path=SEED_FILE):
+    """
+    Reads the categories and questions of the `trivia.psql` dump.
+
+    Returns:
+        tuple: lists of category and question rows as dictionaries
+    """
+    with open(path, encoding='utf-8') as dump:
+        text = dump.read()
+    categories = [{'id': int(row['id']), 'type': row['type']}
+                  for row in _copy_rows(text, 'categories')]
+    questions = [dict(row, id=int(row['id']), difficulty=int(row['difficulty']),
+                      category=int(row['category']))
+                 for row in _copy_rows(text, 'questions')]
+    return categories, questions
+
+
+def generate_questions(size, seed=0):
+    """
+    Yields `size` deterministic synthetic questions spread over the six categories,
+    for performance tests that need a realistic bank size.
+    """
+    rng = random.Random(seed)
+    for question_id in range(1, size + 1):
+        words = rng.sample(_WORDS, 4)
+        yield {
+            'id': question_id,
+            'question': f"Which {words[0]} of the {words[1]} is known as {words[2]} {question_id}?",
+            'answer': f"The {words[3]} {question_id}",
+            'difficulty': rng.randint(1, 5),
+            'category': rng.randint(1, len(CATEGORIES))
+        }
+
+
+def _worker_name():
+    # pytest-xdist names its workers gw0, gw1, ...
+    return os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+
+def _enable_sqlite_savepoints(engine):
+    # pysqlite starts and ends transactions on its own, which breaks SAVEPOINT.
+    # Let SQLAlchemy emit BEGIN itself instead.
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def build_database(path, bank_size=None):
+    """
+    Creates a SQLite database file at `path` with the tables and either the
+    `trivia.psql` rows or `bank_size` generated questions.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    app = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI=f'sqlite:///{path}'))
+    with app.app_context():
+        create_tables()
+        categories, questions = seed_rows()
+        if bank_size is not None:
+            categories = [{'id': index, 'type': name} for index, name in enumerate(CATEGORIES, 1)]
+            questions = generate_questions(bank_size)
+        db.session.execute(insert(Category), categories)
+        batch = []
+        for question in questions:
+            batch.append(question)
+            if len(batch) == 5000:
+                db.session.execute(insert(Question), batch)
+                batch = []
+        if batch:
+            db.session.execute(insert(Question), batch)
+        db.session.commit()
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+
+def test_database_url(bank_size=None):
+    """
+    Returns the url of the database of this test process, building it on first use.
+    `TEST_DATABASE_URL` takes precedence for the default bank.
+    """
+    if bank_size is None and os.environ.get('TEST_DATABASE_URL'):
+        return os.environ['TEST_DATABASE_URL']
+    if bank_size not in _databases:
+        name = f"trivia_test_{_worker_name()}_{os.getpid()}_{bank_size or 'seed'}.db"
+        path = os.path.join(tempfile.gettempdir(), name)
+        build_database(path, bank_size)
+        atexit.register(_remove, path)
+        _databases[bank_size] = f'sqlite:///{path}'
+    return _databases[bank_size]
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+"""
+DatabaseTestCase
+
+"""
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Gives every test a fresh app in `self.app` whose session is bound to a
+    transaction that is rolled back when the test ends, including the
+    changes committed by the endpoints.
+
+    Set `bank_size` to use a generated bank of that many questions instead of
+    the `trivia.psql` rows, and `app_config` to override the app configuration.
+    """
+
+    bank_size = None
+    app_config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database_path = test_database_url(cls.bank_size)
+        if cls.database_path == os.environ.get('TEST_DATABASE_URL'):
+            app = create_app({'SQLALCHEMY_DATABASE_URI': cls.database_path})
+            with app.app_context():
+                create_tables()
+
+    def setUp(self):
+        config = dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI=self.database_path, **self.app_config)
+        if self.database_path.startswith('sqlite'):
+            # Background threads of the app, such as the job runner, share the test connection
+            config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'connect_args': {'check_same_thread': False}})
+        self.app = create_app(config)
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        _enable_sqlite_savepoints(engine)
+
+        connection = engine.connect()
+        transaction = connection.begin()
+        connection.begin_nested()
+        session = db.create_scoped_session(options={'bind': connection, 'binds': {}})
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(ended_session, ended_transaction):
+            # A commit or rollback of the session ends the savepoint; open the next one
+            if not connection.in_nested_transaction():
+                connection.begin_nested()
+
+        original_session, db.session = db.session, session
+
+        def rollback():
+            session.remove()
+            db.session = original_session
+            transaction.rollback()
+            connection.close()
+            engine.dispose()
+
+        self.addCleanup(rollback)
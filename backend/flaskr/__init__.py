@@ -1,19 +1,70 @@
 import os
 import json
+import hmac
+import time
 from typing import ParamSpec
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
+from sqlalchemy import func, select
 
-from models import setup_db, Question, Category
+from models import setup_db, create_tables, commit, db, Question, Category, QuestionStat, QuestionTranslation, ChangeEvent
+from errors import (TriviaError, QuestionNotFound, CategoryNotFound, DuplicateQuestion, ErrorCounters,
+                    error_message)
+from leaderboard import Leaderboard, GLOBAL_SCOPE
+from stats import QuestionStatsAggregator
+from export import export_questions, available_formats, COMPRESSIONS
+from sampling import reservoir_sample
+from encoding import listing_response
+from singleflight import SingleFlight, coalesce
+from ratelimit import RateLimiter, LoadShedder, create_backend
+from autocomplete import QuestionPrefixIndex
+from lazy import LazyObject
+from writebehind import QuestionQueue, QuestionWriter
+from changefeed import ChangeFeedTail, changed_ids, prune_change_events
+from translations import TranslationStore, normalize_locale, localized_columns, DEFAULT_LOCALE, DEFAULT_CACHE_SIZE
+from snapshot import QuestionSnapshot
+from categorypools import CategoryPools
+from questionpack import MappedQuestionPack, build_pack, DEFAULT_CHECK_INTERVAL
+from adminstats import (RouteTimings, CachedValue, hit_rate, table_sizes, category_sizes, category_skew,
+                        pool_stats, DEFAULT_CACHE_SECONDS, DEFAULT_SLOWEST_ROUTES)
+from quizpacks import (QuizPack, QuizPackCache, sign_token, verify_token, pack_rng, DEFAULT_PACK_SIZE,
+                       MAX_PACK_SIZE, DEFAULT_MAX_AGE)
+from quizpacks import DEFAULT_CACHE_SIZE as DEFAULT_PACK_CACHE_SIZE
+from jobs import (JobRunner, FAILED, DEFAULT_CHUNK_SIZE, validate_questions, find_duplicate_clusters,
+                  question_signatures, prefix_postings)
 
 QUESTIONS_PER_PAGE = 10
+QUIZ_MAX_COUNT = 50
+AUTOCOMPLETE_DEFAULT_LIMIT = 5
+AUTOCOMPLETE_MAX_LIMIT = 20
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 100
+LEADERBOARD_DEFAULT_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
+
+# (requests per second, burst) allowed per client and route
+DEFAULT_RATE_LIMIT = (10, 50)
+ROUTE_RATE_LIMITS = {
+    'search_questions': (2, 20),
+    'export_question_bank': (0.1, 2),
+}
+# Routes whose concurrent requests are capped by the load shedder
+EXPENSIVE_ENDPOINTS = ('search_questions', 'export_question_bank', 'get_next_question')
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    
+    # Behind proxies the client address, which rate limits are keyed by, is
+    # the one the TRUSTED_PROXY_COUNT proxies appended to X-Forwarded-For
+    if app.config.get('TRUSTED_PROXY_COUNT'):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_COUNT'])
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -21,6 +72,10 @@ def create_app(test_config=None):
     
     CORS(app)
     
+    # Identical concurrent reads share one execution of the handler
+    single_flight = SingleFlight()
+    app.extensions['single_flight'] = single_flight
+    
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
     """
@@ -28,13 +83,45 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add(
-            "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
+            "Access-Control-Allow-Headers", "Content-Type,Authorization,Idempotency-Key,X-Tenant-ID,true"
         )
         response.headers.add(
             "Access-Control-Allow-Methods", "GET,PUT,PATCH,POST,DELETE,OPTIONS"
         )
         return response
     
+    # Every client gets a token bucket per route, and expensive routes are shed
+    # with a 503 once too many of them run at the same time
+    rate_limiter = RateLimiter(
+        create_backend(app.config.get('RATE_LIMIT_STORAGE_URL')),
+        app.config.get('RATE_LIMIT_DEFAULT', DEFAULT_RATE_LIMIT),
+        app.config.get('RATE_LIMITS', ROUTE_RATE_LIMITS))
+    load_shedder = LoadShedder(app.config.get('MAX_EXPENSIVE_IN_FLIGHT', 16))
+    app.extensions['rate_limiter'] = rate_limiter
+    app.extensions['load_shedder'] = load_shedder
+    
+    @app.before_request
+    def limit_request():
+        if request.endpoint is None or request.method == 'OPTIONS':
+            return
+        
+        if app.config.get('RATE_LIMIT_ENABLED', True):
+            allowed, retry_after = rate_limiter.check(request.remote_addr, request.endpoint)
+            if not allowed:
+                abort(429, description={'custom_message': 
+                    f"Too many requests. Retry in {retry_after} seconds"}, retry_after=retry_after)
+        
+        if request.endpoint in EXPENSIVE_ENDPOINTS:
+            if not load_shedder.acquire():
+                abort(503, description={'custom_message': 
+                    "The server is busy. Please retry shortly"}, retry_after=1)
+            g.load_shedder_slot = True
+    
+    @app.teardown_request
+    def release_load_shedder_slot(error=None):
+        if g.pop('load_shedder_slot', False):
+            load_shedder.release()
+    
     """
     @TODO:
     Create an endpoint to handle GET requests
@@ -68,9 +155,24 @@ def create_app(test_config=None):
         
         categories =   format(Category.query.all())
         return {cat['id']: cat['type'] for cat in categories}
+    
+    # Question text in other locales than DEFAULT_LOCALE, picked from the
+    # Accept-Language header of the request by the read endpoints
+    translations = TranslationStore(app.config.get('DEFAULT_LOCALE', DEFAULT_LOCALE),
+                                    app.config.get('TRANSLATION_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    app.extensions['translations'] = translations
+    
+    def request_locale():
+        return translations.negotiate(request.accept_languages)
+    
+    def localized(response, locale):
+        response.headers['Content-Language'] = locale
+        response.vary.add('Accept-Language')
+        return response
         
         
     @app.route("/categories", methods=["GET"])
+    @coalesce(single_flight)
     def get_categories():
         """
         Fetches a dictionary of categories in which the keys are the ids and the value is the corresponding string of the category
@@ -98,12 +200,14 @@ def create_app(test_config=None):
             }
         """
         
+        bank = snapshot_bank()
+        
         return jsonify(
             {
                 "success": True,
                 "status_code": 200,
                 "message": 'OK',
-                "categories": all_formatted_categories()
+                "categories": bank.category_types if bank else all_formatted_categories()
             }
         )
 
@@ -122,6 +226,7 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions", methods=["GET"])
+    @coalesce(single_flight)
     def get_questions():
         """
         Fetches a paginated set of questions, a total number of questions, all categories 
@@ -173,27 +278,34 @@ def create_app(test_config=None):
         start = (page - 1) * QUESTIONS_PER_PAGE
         end = start + QUESTIONS_PER_PAGE
 
-        all_questions = Question.query.order_by(Question.id)
-        questions_on_page = all_questions[start:end]
+        bank = snapshot_bank()
+        if bank:
+            questions_on_page = bank.page(start, end)
+            total_questions = len(bank)
+            categories = bank.category_types
+        else:
+            all_questions = Question.query.order_by(Question.id)
+            questions_on_page = format(all_questions[start:end])
+            total_questions = all_questions.count()
+            categories = all_formatted_categories()
         
         if len(questions_on_page) == 0:
             abort(404, description={"custom_message": f"No questions on page {page}"})
         
-        format_questions_on_page = format(questions_on_page)
+        locale = request_locale()
+        format_questions_on_page = translations.localize(questions_on_page, locale)
         
-        categories =  all_formatted_categories()
-        
-        return jsonify(
+        return localized(listing_response(
             {
                 "success": True,
                 "status_code": 200,
                 "message": 'OK',
                 "questions": format_questions_on_page,
-                "total_questions": all_questions.count(), 
+                "total_questions": total_questions, 
                 'categories': categories,
                 'currentCategory': ''
             }
-        )
+        ), locale)
 
 
     """
@@ -229,15 +341,12 @@ def create_app(test_config=None):
         question = Question.query.filter(Question.id == question_id).one_or_none() 
         
         if question is None:
-            abort(404, description={
-                'custom_message': f"Question with `id` {question_id} does not exist"})
-
-        try:         
-            question.delete()
+            raise QuestionNotFound(question_id)
 
-        except:
-            abort(500, description={'custom_message': 
-                f"Internal server error occurred. Question with `id` {question_id} could not be deleted"})
+        question.delete()
+        duplicate_index.discard(question_id)
+        prefix_index.discard(question_id)
+        category_pools.discard(question_id)
             
         return jsonify(
                 {
@@ -259,6 +368,48 @@ def create_app(test_config=None):
     of the questions list in the "List" tab.
     """
     
+    # Paraphrased questions are detected with a MinHash/LSH index over the question
+    # and answer text. NEAR_DUPLICATE_MODE is 'flag' (report them in the response),
+    # 'reject' (422) or 'off'.
+    near_duplicate_mode = app.config.get('NEAR_DUPLICATE_MODE', 'flag')
+    def create_duplicate_index():
+        # Imported here so that numpy is only loaded once the index is needed
+        from dedup import QuestionDuplicateIndex
+        return QuestionDuplicateIndex(threshold=app.config.get('NEAR_DUPLICATE_THRESHOLD', 0.7))
+
+    duplicate_index = LazyObject(create_duplicate_index)
+    app.extensions['duplicate_index'] = duplicate_index
+
+    def check_near_duplicates(payload):
+        if near_duplicate_mode == 'off':
+            return [], None
+        near_duplicates = duplicate_index.near_duplicates(payload['question'], payload['answer'])
+        if near_duplicates and near_duplicate_mode == 'reject':
+            return near_duplicates, (
+                f"The question looks like a duplicate of the question with ID {near_duplicates[0]['id']}")
+        return near_duplicates, None
+
+    def index_created_question(question):
+        duplicate_index.add(question)
+        prefix_index.add_question(question)
+        category_pools.add(question.id, question.category)
+
+    # QUESTION_WRITE_MODE is 'sync' (insert in the request) or 'write-behind': new
+    # questions are queued in a local SQLite file, answered with 202 and a tracking
+    # id, and inserted in batches by a background thread
+    question_write_mode = app.config.get('QUESTION_WRITE_MODE', 'sync')
+    def create_question_writer():
+        queue = QuestionQueue(app.config.get('QUESTION_QUEUE_PATH',
+                                             os.path.join(app.instance_path, 'question_queue.db')))
+        return QuestionWriter(app, queue,
+                              app.config.get('QUESTION_QUEUE_FLUSH_SECONDS', 1),
+                              app.config.get('QUESTION_QUEUE_BATCH_SIZE', 500),
+                              check_duplicates=check_near_duplicates,
+                              on_created=index_created_question)
+
+    question_writer = LazyObject(create_question_writer)
+    app.extensions['question_writer'] = question_writer
+
     def validate_create_question(body):
         error_code = 400
         success = False
@@ -321,7 +472,12 @@ def create_app(test_config=None):
             "difficulty": 2
         } 
         
+        Request Headers: `Idempotency-Key` - Optional in write-behind mode, a retry with the same
+            key returns the first queued entry instead of queueing the question again.
+        
         Returns: A JSON object which includes a status of 201 Created and the question ID of the created question.
+            In write-behind mode (`QUESTION_WRITE_MODE = 'write-behind'`) the question is queued instead
+            and the response is 202 Accepted with a `tracking_id`, see `GET /questions/queue/<tracking_id>`.
         Sample response: {
                 "success": True,
                 "status_code": 201,
@@ -334,6 +490,9 @@ def create_app(test_config=None):
         
         results = validate_create_question(body)
         
+        if results['success'] and question_write_mode == 'write-behind':
+            return enqueue_question(body)
+        
         if results['success']:
             # Test if that question already exist
             check_question = Question.query.filter_by(
@@ -341,24 +500,17 @@ def create_app(test_config=None):
                                     category=body['category']
                                 ).one_or_none()
             if check_question:
-                abort(422, description={'custom_message': 
-                f"The question already exists with an ID {check_question.id}"})
+                raise DuplicateQuestion(check_question.id)
                 
+            near_duplicates, error = check_near_duplicates(body)
+            if error:
+                abort(422, description={'custom_message': error})
             
             new_question = Question(question=body['question'], answer=body['answer'], 
                                     category=body['category'], difficulty=body['difficulty'])
-            try:     
-                new_question.insert()
-                
-                # To get the id of the created question
-                get_inserted_question = Question.query.filter_by(
-                                    question=body['question'], answer=body['answer'], 
-                                    category=body['category'], difficulty=body['difficulty']
-                                ).one_or_none()
-                
-            except:
-                abort(500, description={'custom_message': 
-                f"Internal server error occurred whiles creating the question."})
+            # The id is set by the insert, there is no need to query the question again
+            new_question.insert()
+            index_created_question(new_question)
                 
         else:
             # When request body validation fails
@@ -370,10 +522,78 @@ def create_app(test_config=None):
                 "success": True,
                 "status_code": 201,
                 "message": "Question Created",
-                "question_id": get_inserted_question.id
+                "question_id": new_question.id,
+                "near_duplicates": near_duplicates
             }
         )
 
+    def enqueue_question(body):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+            abort(400, description={'custom_message': 
+                "The Idempotency-Key header must have between 1 and 255 characters"})
+        
+        payload = {
+            'question': body['question'],
+            'answer': body['answer'],
+            'category': int(body['category']),
+            'difficulty': int(body['difficulty'])
+        }
+        try:
+            entry, _ = question_writer.queue.enqueue(payload, idempotency_key)
+        except ValueError as error:
+            abort(422, description={'custom_message': str(error)})
+        question_writer.start()
+        
+        response = jsonify({
+            "success": True,
+            "status_code": 202,
+            "message": "Question queued",
+            **entry
+        })
+        response.status_code = 202
+        response.headers['Location'] = f"/questions/queue/{entry['tracking_id']}"
+        return response
+    
+    
+    @app.route("/questions/queue/<tracking_id>")
+    def get_queued_question(tracking_id):
+        """
+        Fetches the status of a question created in write-behind mode.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            tracking_id - The tracking id returned by `POST /questions`
+        
+        Returns: A JSON object with the `status` of the question: `queued`, `created`
+            (with the `question_id`) or `rejected` (with the `error`).
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "tracking_id": "5f0c8b6be2d04f7c9a5b1e0d3c2a4f61",
+            "status": "created",
+            "question_id": 25,
+            "near_duplicates": []
+        }
+        """
+        
+        entry = None
+        if question_write_mode == 'write-behind':
+            entry = question_writer.queue.get(tracking_id)
+        if entry is None:
+            abort(404, description={'custom_message': 
+                f"There is no queued question with the tracking id {tracking_id}"})
+        
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            **entry
+        })
+
         
             
 
@@ -388,6 +608,109 @@ def create_app(test_config=None):
     Try using the word "title" to start.
     """
 
+    @app.route("/questions/<int:question_id>/translations", methods=["GET"])
+    def get_question_translations(question_id):
+        """
+        Fetches every translation of a question.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            question_id - ID of the question
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "question_id": 9,
+            "translations": [
+                {
+                    "question_id": 9,
+                    "locale": "fr",
+                    "question": "Quel est le nom de naissance du boxeur Mohamed Ali ?",
+                    "answer": "Cassius Clay"
+                }
+            ]
+        }
+        """
+        
+        if Question.query.get(question_id) is None:
+            raise QuestionNotFound(question_id)
+        
+        rows = (QuestionTranslation.query.filter_by(question_id=question_id)
+                .order_by(QuestionTranslation.locale))
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "question_id": question_id,
+            "translations": format(rows)
+        })
+    
+    
+    @app.route("/questions/<int:question_id>/translations/<locale>", methods=["PUT"])
+    def put_question_translation(question_id, locale):
+        """
+        Creates or replaces the translation of a question into a locale.
+        
+        Methods: ['PUT']
+        
+        Request Parameters: 
+            question_id - ID of the question
+            locale - Language tag of the translation, e.g. `fr` or `pt-BR`
+        
+        Request Data: A JSON object containing the keys `question` and `answer`.
+        
+        Sample request data: {
+            "question": "Quel est le nom de naissance du boxeur Mohamed Ali ?",
+            "answer": "Cassius Clay"
+        }
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "Translation saved",
+            "translation": {
+                "question_id": 9,
+                "locale": "fr",
+                "question": "Quel est le nom de naissance du boxeur Mohamed Ali ?",
+                "answer": "Cassius Clay"
+            }
+        }
+        """
+        
+        body = request.get_json(silent=True)
+        normalized = normalize_locale(locale)
+        if normalized is None:
+            abort(422, description={'custom_message': f"'{locale}' is not a language tag"})
+        if normalized == translations.default_locale:
+            abort(422, description={'custom_message': 
+                f"'{normalized}' is the default locale, update the question itself"})
+        if not (body and isinstance(body.get('question'), str) and isinstance(body.get('answer'), str)
+                and body['question'].strip() and body['answer'].strip()):
+            abort(400, description={'custom_message': 
+                'The request body must be a JSON object with the non-empty strings "question" and "answer"'})
+        if Question.query.get(question_id) is None:
+            raise QuestionNotFound(question_id)
+        
+        translation = QuestionTranslation.query.get((normalized, question_id))
+        if translation is None:
+            translation = QuestionTranslation(question_id, normalized, body['question'], body['answer'])
+            db.session.add(translation)
+        else:
+            translation.question = body['question']
+            translation.answer = body['answer']
+        commit(f"The translation of question {question_id} into {normalized} could not be saved")
+        translations.invalidate([question_id], [normalized])
+        
+        return jsonify({
+            "success": True,
+            "status_code": 200,
+            "message": "Translation saved",
+            "translation": translation.format()
+        })
+        
+    
     @app.route('/questions/search', methods=['POST'])
     def search_questions():
         """
@@ -397,14 +720,18 @@ def create_app(test_config=None):
         
         Request Parameters: None
         
-        Request Data: A JSON object containing a single key `searchTerm` with the search value
+        Request Data: A JSON object containing the key `searchTerm` with the search value and optionally:
+            limit - number of questions to return (default 50, max 100)
+            cursor - the `next_cursor` of the previous page to fetch the next page
+            category - ID of the category to search in
         Sample request data: {
-            "searchTerm": "champions"
+            "searchTerm": "champions",
+            "limit": 10
         } 
         
         Returns: A JSON object which includes a key - `questions` - that contains list of dictionary of questions that
-            match the search term or empty list if no match, total questions that matched the search term 
-            and the current category.
+            match the search term or empty list if no match, total questions that matched the search term,
+            the cursor of the next page (null on the last page) and the current category.
             
         Sample response: {
             'success': True,
@@ -432,8 +759,9 @@ def create_app(test_config=None):
                 },
 
             ],
-            'current_category': '',
-            'total_questions': 3
+            'currentCategory': '',
+            'totalQuestions': 3,
+            'next_cursor': None
         }
         """
         body = request.get_json()
@@ -448,25 +776,193 @@ def create_app(test_config=None):
         # description={'custom_message': error_body}
 
         search_term = body.get("searchTerm")
-        
-        try:   
-            search = Question.query.filter(Question.question.ilike(f"%{search_term}%"))    
-
-        except:
-            abort(500)
-            
-        questions = [] # returns empty list if no searchTerm is matched
-        
-        if search:
-            questions = format(search)
+        limit = body.get("limit", SEARCH_DEFAULT_LIMIT)
+        cursor = body.get("cursor") or 0
+        category = body.get("category") or None
+        
+        if not (isinstance(limit, int) and 1 <= limit <= SEARCH_MAX_LIMIT and isinstance(cursor, int)
+                and (category is None or isinstance(category, int))):
+            abort(422, description={'custom_message': 
+                f"'limit' must be an integer between 1 and {SEARCH_MAX_LIMIT}, "
+                "'cursor' and 'category' must be integers"})
+        
+        locale = request_locale()
+        bank = snapshot_bank(locale)
+        if bank:
+            questions, total_questions, has_next_page = bank.search(search_term, category, cursor, limit)
+            return localized(listing_response({
+                'success': True,
+                'questions': questions,
+                'totalQuestions': total_questions,
+                'next_cursor': questions[-1]['id'] if has_next_page else None,
+                'currentCategory': ''
+            }), locale)
+        
+        questions_table = Question.__table__
+        source, question_text, answer_text = localized_columns(locale, translations.default_locale)
+        
+        # The total number of matches is computed by a window function in the same
+        # query as the page, which is fetched by keyset pagination on the id
+        matches = (select(questions_table.c.id, question_text.label('question'),
+                          answer_text.label('answer'), questions_table.c.difficulty,
+                          questions_table.c.category, func.count().over().label('total'))
+                   .select_from(source)
+                   .where(question_text.ilike(f"%{search_term}%")))
+        if category is not None:
+            matches = matches.where(questions_table.c.category == category)
+        matches = matches.subquery()
+        
+        rows = db.session.execute(
+            select(matches)
+            .where(matches.c.id > cursor)
+            .order_by(matches.c.id)
+            .limit(limit + 1)
+        ).mappings().all()
+        
+        has_next_page = len(rows) > limit
+        rows = rows[:limit]
+        questions = [{key: row[key] for key in row.keys() if key != 'total'} for row in rows]
+        
+        if rows:
+            total_questions = rows[0]['total']
+        else:
+            # The window function has no row to report on an empty page
+            total_questions = db.session.execute(
+                select(func.count()).select_from(matches)).scalar()
                 
-        return jsonify({
+        return localized(listing_response({
+            'success': True,
             'questions': questions,
-            'totalQuestions': search.count(),
+            'totalQuestions': total_questions,
+            'next_cursor': rows[-1]['id'] if has_next_page else None,
             'currentCategory': ''
-        })
+        }), locale)
         
     
+    prefix_index = QuestionPrefixIndex()
+    app.extensions['prefix_index'] = prefix_index
+
+    # Every worker tails the change feed and applies the question writes of the
+    # other workers to its in-memory indexes, so they never need a full reload
+    change_feed = ChangeFeedTail(app, app.config.get('CHANGE_FEED_POLL_SECONDS', 1))
+    app.extensions['change_feed'] = change_feed
+
+    def apply_question_changes(events):
+        upserted, deleted = changed_ids(events, 'question', fields=('question', 'answer'))
+        indexes_loaded = duplicate_index.created
+        questions = Question.query.filter(Question.id.in_(sorted(upserted))).all() if upserted else []
+        for question in questions:
+            prefix_index.add_question(question)
+            if indexes_loaded:
+                duplicate_index.add(question)
+        # Upserted questions that are gone were deleted since
+        for question_id in deleted | (upserted - {question.id for question in questions}):
+            prefix_index.discard(question_id)
+            if indexes_loaded:
+                duplicate_index.discard(question_id)
+
+    change_feed.subscribe(apply_question_changes)
+
+    def apply_translation_changes(events):
+        upserted, deleted = changed_ids(events, 'question', fields=('question', 'answer'))
+        translated, removed = changed_ids(events, 'translation')
+        new_locales = {event['data']['locale'] for event in events if event['entity'] == 'translation'}
+        question_ids = upserted | deleted | translated | removed
+        if question_ids:
+            translations.invalidate(question_ids, new_locales)
+
+    change_feed.subscribe(apply_translation_changes)
+
+    # The question ids of every category, for the weighted multi-category quizzes
+    category_pools = CategoryPools()
+    app.extensions['category_pools'] = category_pools
+
+    def apply_category_pool_changes(events):
+        upserted, deleted = changed_ids(events, 'question', fields=('category',))
+        found = set()
+        if upserted:
+            for question_id, category in db.session.execute(
+                    select(Question.id, Question.category).where(Question.id.in_(sorted(upserted)))):
+                found.add(question_id)
+                category_pools.add(question_id, category)
+        for question_id in deleted | (upserted - found):
+            category_pools.discard(question_id)
+
+    change_feed.subscribe(apply_category_pool_changes)
+
+    # With READ_MODE 'snapshot' the read endpoints are served from an immutable
+    # in-memory copy of the question bank, replaced whenever the feed reports a change.
+    # With READ_MODE 'pack' they are served from a question pack file mapped by every worker
+    read_mode = app.config.get('READ_MODE', 'database')
+    question_pack_path = app.config.get('QUESTION_PACK_PATH', os.path.join(app.instance_path, 'questions.pack'))
+    if read_mode == 'snapshot':
+        snapshot = QuestionSnapshot(change_feed)
+    elif read_mode == 'pack':
+        snapshot = MappedQuestionPack(question_pack_path,
+                                      app.config.get('QUESTION_PACK_CHECK_SECONDS', DEFAULT_CHECK_INTERVAL))
+    else:
+        snapshot = None
+    app.extensions['snapshot'] = snapshot
+
+    def snapshot_bank(locale=None):
+        """
+        Returns the current `QuestionBank`, or None when the request must be served
+        from the database: in the `database` read mode, or when the question text
+        has to be matched in another locale than the default one.
+        """
+        if snapshot is None or (locale is not None and locale != translations.default_locale):
+            return None
+        return snapshot.current()
+
+    @app.before_request
+    def follow_change_feed():
+        # Fixes the feed position before any index is loaded by a request
+        change_feed.start()
+
+    @app.route('/questions/autocomplete', methods=['GET'])
+    def autocomplete_questions():
+        """
+        Suggests words and questions for a partially typed search term. Served from an
+        in-memory prefix index over the question text.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            q - The typed text. The last word is treated as a prefix
+            limit - Optional (default 5, max 20) number of suggestions
+        
+        Returns: A JSON object with the completed `terms` and matching question snippets.
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "terms": ["painting", "paintings", "palace"],
+            "questions": [
+                {"id": 19, "question": "Which American artist was a pioneer of Abstract Expressionism, and a leading exponent of action painting?"},
+                {"id": 18, "question": "How many paintings did Van Gogh sell in his lifetime?"},
+                {"id": 14, "question": "In which royal palace would you find the Hall of Mirrors?"}
+            ]
+        }
+        """
+
+        text = request.args.get('q', '')
+        limit = request.args.get('limit', AUTOCOMPLETE_DEFAULT_LIMIT, type=int)
+        limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+        
+        locale = request_locale()
+        index = prefix_index if locale == translations.default_locale else translations.prefix_index(locale)
+
+        return localized(jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                **index.complete(text, limit)
+            }
+        ), locale)
+
+
     """
     @TODO:
     Create a GET endpoint to get questions based on category.
@@ -477,6 +973,7 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories/<int:category_id>/questions", methods=["GET"])
+    @coalesce(single_flight)
     def get_questions_for_category(category_id):
         """
         Returns a list of all the questions available for a given category or an empty list
@@ -516,24 +1013,32 @@ def create_app(test_config=None):
         }
         """
 
-        category = Category.query.get(category_id)
+        bank = snapshot_bank()
+        if bank:
+            category_type = bank.category_types.get(category_id)
+        else:
+            category = Category.query.get(category_id)
+            category_type = category.type if category else None
         
-        if not category:
-            abort(404, description={'custom_message': 
-                f"The category with ID {category_id} does not exist"})
+        if not category_type:
+            raise CategoryNotFound(category_id)
 
-        cat_questions = Question.query.filter(Question.category==category_id)
-        format_cat_questions = format(cat_questions)
+        if bank:
+            cat_questions = bank.rows(bank.category_rows.get(category_id, ()))
+        else:
+            cat_questions = format(Question.query.filter(Question.category==category_id))
+        locale = request_locale()
+        format_cat_questions = translations.localize(cat_questions, locale)
         
         
-        return jsonify({
+        return localized(listing_response({
             'success': True,
             'status_code': 200,
             'message': 'OK',
             'questions': format_cat_questions,
-            'total_questions': cat_questions.count(),
-            'currentCategory': category.type
-        })
+            'total_questions': len(cat_questions),
+            'currentCategory': category_type
+        }), locale)
      
         
     """
@@ -554,6 +1059,22 @@ def create_app(test_config=None):
     including 404 and 422.
     """
     
+    def parse_category_weights(weights):
+        """
+        Returns:
+            dict: category id -> weight of a `quiz_categories` object, or None when it is invalid
+        """
+        if not (isinstance(weights, dict) and weights):
+            return None
+        parsed = {}
+        for category, weight in weights.items():
+            if not (isinstance(category, str) and category.isdigit()):
+                return None
+            if isinstance(weight, bool) or not (isinstance(weight, (int, float)) and weight > 0):
+                return None
+            parsed[int(category)] = weight
+        return parsed
+
     def validate_next_question(body):
         error_code = 400
         success = True
@@ -587,6 +1108,22 @@ def create_app(test_config=None):
             if not success:
                 error_code = 422
                 error_body = "'previous_questions' must be a list of integers and 'quiz_category' must be an integer"
+            
+            # If quiz_categories was supplied
+            elif 'quiz_categories' in body:
+                if quiz_category or parse_category_weights(body['quiz_categories']) is None:
+                    success = False
+                    error_code = 422
+                    error_body = ("'quiz_categories' must be an object of category IDs and positive weights, "
+                                  "for example {\"1\": 0.5, \"4\": 0.3, \"6\": 0.2}, and replaces 'quiz_category'")
+            
+            # If count was supplied, whatever the categories
+            if success and 'count' in body:
+                count = body['count']
+                if isinstance(count, bool) or not (isinstance(count, int) and 1 <= count <= QUIZ_MAX_COUNT):
+                    success = False
+                    error_code = 422
+                    error_body = f"'count' must be an integer between 1 and {QUIZ_MAX_COUNT}"
                 
         else:
             success = False
@@ -603,6 +1140,8 @@ def create_app(test_config=None):
         """
         Returns a random question for the quiz from the given category if given or from any category
         , that is different from any previous question in the previous questions.
+        When `count` is given, up to `count` distinct random questions are returned at once so
+        the client can prefetch a whole round.
         
         Methods: ['POST']
         
@@ -617,6 +1156,13 @@ def create_app(test_config=None):
             "quiz_category": 1,
         } 
         
+        Optional request data: 
+            count - number of questions to return (1 to 50). The response then also contains
+                a `questions` list, `question` being its first item.
+            quiz_categories - an object of category IDs and weights, for example
+                {"1": 0.5, "4": 0.3, "6": 0.2}, that replaces `quiz_category`. Every question
+                is then drawn from a category picked with the probability of its weight.
+        
         Returns: A JSON object which includes a random question and status messages.
         
         Sample response: {
@@ -643,16 +1189,36 @@ def create_app(test_config=None):
             previous_questions = body.get("previous_questions", [])
             quiz_category = body.get("quiz_category", "")
              
-            if quiz_category:
-                next_available_questions = Question.query.filter(Question.category == quiz_category,
-                                                Question.id.not_in(previous_questions) ).all()
+            count = body.get("count", 1)
+            category_weights = parse_category_weights(body['quiz_categories']) if 'quiz_categories' in body else None
+             
+            bank = snapshot_bank()
+            if bank and category_weights:
+                picked_questions = bank.weighted_sample(category_weights, count, previous_questions)
+                picked_ids = [question['id'] for question in picked_questions]
+            elif bank:
+                picked_questions = bank.sample(count, quiz_category or None, previous_questions)
+                picked_ids = [question['id'] for question in picked_questions]
+            elif category_weights:
+                picked_ids = category_pools.sample(category_weights, count, previous_questions)
             else:
-                next_available_questions = Question.query.filter(
-                                                Question.id.not_in(previous_questions) ).all()    
-        
-            if next_available_questions:
-                random.shuffle(next_available_questions) # To pick a random question
-                next_question = next_available_questions[0].format()
+                available_ids = db.session.query(Question.id).filter(Question.id.not_in(previous_questions))
+                if quiz_category:
+                    available_ids = available_ids.filter(Question.category == quiz_category)
+            
+                # Only the ids are streamed and at most `count` of them are kept in memory
+                picked_ids = [question_id for question_id, in
+                              reservoir_sample(available_ids.yield_per(1000), count)]
+        
+            if picked_ids:
+                if not bank:
+                    picked = {question.id: question.format() for question in
+                              Question.query.filter(Question.id.in_(picked_ids))}
+                    picked_questions = [picked[question_id] for question_id in picked_ids]
+                locale = request_locale()
+                next_questions = translations.localize(picked_questions, locale)
+                next_question = next_questions[0]
+                question_stats.record_plays(picked_ids)
                 
             else:
                 abort(404, description={'custom_message':"No more questions found"}) # If there is no more question available
@@ -661,63 +1227,1237 @@ def create_app(test_config=None):
             abort(results['error'], description={'custom_message': results['message']})
 
         
-        return jsonify(
-            {
-                "success": True,
-                "status_code": 200,
-                "message": 'OK',
-                "question": next_question
-            }
-        )
+        response = {
+            "success": True,
+            "status_code": 200,
+            "message": 'OK',
+            "question": next_question
+        }
+        if 'count' in body:
+            response['questions'] = next_questions
         
+        return localized(jsonify(response), locale)
         
-    @app.errorhandler(404)
-    def not_found(error):
-        return (
-            jsonify({"success": False, "error": 404, "message": customize_error_message(error)
-                     or error.name}),
-            404,
-        )
+        
+    @app.route('/questions/export', methods=['GET'])
+    def export_question_bank():
+        """
+        Streams the whole question bank, or the questions of a category, as a file download.
+        Questions are read in id order through a server-side cursor so memory use does not
+        depend on the size of the bank. An interrupted export can be resumed by passing the
+        last received id as `after_id`.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            format - Optional (default ndjson) one of ndjson, csv, arrow or parquet.
+                arrow and parquet are only available when pyarrow is installed
+            category - Optional ID of the category to export
+            after_id - Optional (default 0) only export questions with a greater id
+            compress - Optional `gzip` to compress the file
+        
+        Returns: A file with one record per question with the fields `id`, `question`,
+            `answer`, `category`, `category_type` and `difficulty`.
+        
+        Sample response (ndjson):
+            {"id": 5, "question": "Whose autobiography is entitled 'I Know Why the Caged Bird Sings'?", "answer": "Maya Angelou", "category": 4, "category_type": "History", "difficulty": 2}
+            {"id": 9, "question": "What boxer's original name is Cassius Clay?", "answer": "Muhammad Ali", "category": 4, "category_type": "History", "difficulty": 1}
+        """
 
-    @app.errorhandler(422)
-    def unprocessable(error):
-        return (
-            jsonify({"success": False, "error": 422, 
-                     "message": customize_error_message(error) or "unprocessable"}),
-            422,
-        )
+        format = request.args.get('format', 'ndjson')
+        category = request.args.get('category', None, type=int)
+        after_id = request.args.get('after_id', 0, type=int)
+        compress = request.args.get('compress', None)
 
-    @app.errorhandler(400)
-    def bad_request(error):
-        return jsonify({"success": False, 
-                        "error": 400, 
-                        "message": customize_error_message(error) or error.name}), 400
+        if format not in available_formats() or (compress and compress not in COMPRESSIONS):
+            abort(422, description={'custom_message':
+                f"'format' must be one of {', '.join(available_formats())} and "
+                f"'compress' must be one of {', '.join(COMPRESSIONS)}"})
 
-    @app.errorhandler(405)
-    def not_allowed(error):
-        return (
-            jsonify({"success": False, "error": 405, 
-                     "message": customize_error_message(error) or "method not allowed"}),
-            405,
+        mimetype, extension, chunks = export_questions(format, category, after_id, compress)
+
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=questions.{extension}'}
         )
+
+
+    """
+    Leaderboard
+    Players submit their score at the end of a quiz. Rankings are kept in memory
+    by `Leaderboard`, periodically written to the `leaderboard_entries` table and
+    merged with the scores the other workers wrote there.
+    """
+
+    leaderboard = Leaderboard(app, app.config.get('LEADERBOARD_SNAPSHOT_SECONDS', 30))
+    app.extensions['leaderboard'] = leaderboard
+
+    def validate_score(body):
+        error_code = 400
+        success = True
+        error_body = '''The request body must a JSON object in the below format:  
+                {
+                    'player':  '<The player name>',
+                    'score':  '<integer: the number of correct answers>',
+                    'quiz_category':  '<ID of the category or empty for all categories>',
+                }
+
+            '''
+
+        if body and body.get('player') and 'score' in body:
+            score = body['score']
+            quiz_category = body.get('quiz_category', "")
+
+            if not (isinstance(body['player'], str) and isinstance(score, int) and score >= 0):
+                success = False
+            if quiz_category and not isinstance(quiz_category, int):
+                success = False
+
+            if not success:
+                error_code = 422
+                error_body = "'player' must be a string, 'score' a non-negative integer and 'quiz_category' an integer"
+        else:
+            success = False
+
+        return {
+            'success': success,
+            'error': '' if success else error_code,
+            'message': '' if success else error_body
+        }
+
+
+    @app.route('/scores', methods=['POST'])
+    def submit_score():
+        """
+        Records the score of a finished quiz in the category and global leaderboards.
+        Only the best score of each player is kept.
         
+        Methods: ['POST']
         
-    @app.errorhandler(500)
-    def internal_serval_error(error):
-        return jsonify({
-            "error": 500,
-            "message": customize_error_message(error) or error.name,
-            "success": False
-        })
+        Request Parameters: None
         
+        Request Data: A JSON object containing the keys `player`, `score` and optionally `quiz_category`.
         
-    def customize_error_message(error):
-        try:
-            if error.description['custom_message']:
-                message = error.description['custom_message']
-                return message
-        except:
-            return None
+        Sample request data: {
+            "player": "ada",
+            "score": 4,
+            "quiz_category": 1
+        } 
+        
+        Returns: A JSON object with the rank of the player in each leaderboard the score was recorded in.
+        
+        Sample response: {
+            "success": True,
+            "status_code": 201,
+            "message": "Score recorded",
+            "ranks": {
+                "0": 3,
+                "1": 1
+            }
+        }
+        """
+
+        body = request.get_json()
+
+        results = validate_score(body)
+
+        if not results['success']:
+            abort(results['error'], description={'custom_message': results['message']})
+
+        quiz_category = body.get('quiz_category', "")
+        if quiz_category and not Category.query.get(quiz_category):
+            raise CategoryNotFound(quiz_category)
+
+        ranks = leaderboard.record(body['player'], quiz_category or None, body['score'])
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 201,
+                "message": "Score recorded",
+                "ranks": ranks
+            }
+        ), 201
+
+
+    def leaderboard_scope():
+        category = request.args.get('category', GLOBAL_SCOPE, type=int)
+        return category or GLOBAL_SCOPE
+
+
+    @app.route('/leaderboard', methods=['GET'])
+    def get_leaderboard():
+        """
+        Fetches the best players globally or for a single category.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            category - Optional ID of the category (default: all categories)
+            limit - Optional (default 10, max 100) number of players to return
+        
+        Returns: A JSON object with the ranked players.
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "category": 0,
+            "leaderboard": [
+                {"rank": 1, "player": "ada", "score": 5},
+                {"rank": 2, "player": "alan", "score": 3}
+            ]
+        }
+        """
+
+        scope = leaderboard_scope()
+        limit = request.args.get('limit', LEADERBOARD_DEFAULT_LIMIT, type=int)
+        limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "category": scope,
+                "leaderboard": leaderboard.top(scope, limit)
+            }
+        )
+
+
+    @app.route('/leaderboard/<string:player>', methods=['GET'])
+    def get_player_rank(player):
+        """
+        Fetches the rank and best score of a player globally or for a single category.
+        
+        Methods: ['GET']
+        
+        Request Arguments: 
+            player: Name of the player
+        
+        Request Parameters: 
+            category - Optional ID of the category (default: all categories)
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "category": 0,
+            "player": "ada",
+            "rank": 1,
+            "score": 5,
+            "total_players": 2
+        }
+        """
+
+        scope = leaderboard_scope()
+        player_rank = leaderboard.rank(player, scope)
+
+        if player_rank is None:
+            abort(404, description={'custom_message':
+                f"The player {player} has no score in this leaderboard"})
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "category": scope,
+                **player_rank
+            }
+        )
+
+
+    """
+    Question statistics
+    Plays and answers are counted in memory by `QuestionStatsAggregator` and merged
+    into the `question_stats` table in the background.
+    """
+
+    question_stats = QuestionStatsAggregator(app, app.config.get('QUESTION_STATS_FLUSH_SECONDS', 10))
+    app.extensions['question_stats'] = question_stats
+
+    def validate_answers(body):
+        error_code = 400
+        success = True
+        error_body = '''The request body must a JSON object in the below format:  
+                {
+                    'answers':  [{'question_id': '<ID of the question>', 'correct': '<boolean>'}],
+                }
+
+            '''
+
+        if body and isinstance(body.get('answers'), list) and body['answers']:
+            for answer in body['answers']:
+                if not (isinstance(answer, dict) and isinstance(answer.get('question_id'), int)
+                        and isinstance(answer.get('correct'), bool)):
+                    success = False
+                    error_code = 422
+                    error_body = "each answer must contain an integer 'question_id' and a boolean 'correct'"
+                    break
+        else:
+            success = False
+
+        return {
+            'success': success,
+            'error': '' if success else error_code,
+            'message': '' if success else error_body
+        }
+
+
+    @app.route('/quizzes/answers', methods=['POST'])
+    def record_answers():
+        """
+        Records whether quiz questions were answered correctly. The outcomes are
+        aggregated in memory and written to the question statistics in the background.
+        
+        Methods: ['POST']
+        
+        Request Parameters: None
+        
+        Request Data: A JSON object containing the key `answers` with a list of answered questions.
+        
+        Sample request data: {
+            "answers": [
+                {"question_id": 5, "correct": true},
+                {"question_id": 9, "correct": false}
+            ]
+        } 
+        
+        Sample response: {
+            "success": True,
+            "status_code": 202,
+            "message": "Answers recorded",
+            "recorded": 2
+        }
+        """
+
+        body = request.get_json()
+
+        results = validate_answers(body)
+
+        if not results['success']:
+            abort(results['error'], description={'custom_message': results['message']})
+
+        question_stats.record_answers(
+            (answer['question_id'], answer['correct']) for answer in body['answers'])
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 202,
+                "message": "Answers recorded",
+                "recorded": len(body['answers'])
+            }
+        ), 202
+
+
+    """
+    Quiz packs
+    A whole quiz of a category in one cacheable download, played offline and
+    answered with a single submission, see `quizpacks.py`.
+    """
+
+    quiz_packs = QuizPackCache(app.config.get('QUIZ_PACK_CACHE_SIZE', DEFAULT_PACK_CACHE_SIZE))
+    app.extensions['quiz_packs'] = quiz_packs
+
+    def quiz_pack_secret():
+        secret = app.config.get('QUIZ_PACK_SECRET') or app.config.get('SECRET_KEY')
+        if not secret:
+            abort(403, description={'custom_message': "Quiz packs are disabled, set QUIZ_PACK_SECRET to enable them"})
+        return secret
+
+    def bank_version():
+        bank = snapshot_bank()
+        return bank.version if bank else change_feed.position
+
+    def build_quiz_pack(category, locale, version, secret):
+        size = min(app.config.get('QUIZ_PACK_SIZE', DEFAULT_PACK_SIZE), MAX_PACK_SIZE)
+        rng = pack_rng(category.id, locale, version)
+        bank = snapshot_bank()
+        if bank:
+            questions = bank.sample(size, category.id, rng=rng)
+        else:
+            # Streamed in id order so that every worker draws the same subset
+            available_ids = (db.session.query(Question.id)
+                             .filter(Question.category == category.id).order_by(Question.id))
+            picked_ids = [question_id for question_id, in
+                          reservoir_sample(available_ids.yield_per(1000), size, rng)]
+            picked = {question.id: question.format() for question in
+                      Question.query.filter(Question.id.in_(picked_ids))}
+            questions = [picked[question_id] for question_id in picked_ids]
+        questions = translations.localize(questions, locale)
+
+        token = sign_token(secret, {
+            'category': category.id,
+            'version': version,
+            'questions': [question['id'] for question in questions]
+        })
+        return QuizPack(category.id, locale, version, {
+            "success": True,
+            "status_code": 200,
+            "message": 'OK',
+            "pack": {
+                "category": category.format(),
+                "version": version,
+                "locale": locale,
+                "questions": questions,
+                "token": token
+            }
+        })
+
+
+    @app.route('/categories/<int:category_id>/quiz-pack', methods=['GET'])
+    def get_quiz_pack(category_id):
+        """
+        Fetches a quiz pack: up to QUIZ_PACK_SIZE random questions of the category,
+        with their answers, and the signed token to send the results back with
+        POST /quizzes/pack-results. The pack only changes with the question bank,
+        it is cached per category, locale and version and served gzip-compressed
+        with a strong ETag and `Cache-Control: public, max-age=QUIZ_PACK_MAX_AGE`.
+        
+        Methods: ['GET']
+        
+        Request Arguments: 
+            category_id: ID of the category
+        
+        Request Headers: `If-None-Match` with the ETag of a pack answers 304 while it is current
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "pack": {
+                "category": {"id": 2, "type": "Art"},
+                "version": 1842,
+                "locale": "en",
+                "questions": [
+                    {
+                        "id": 16,
+                        "question": "Which Dutch graphic artist-initials M C was a creator of optical illusions?",
+                        "answer": "Escher",
+                        "category": 2,
+                        "difficulty": 1
+                    }
+                ],
+                "token": "eyJjYXRlZ29yeSI6MiwicXVlc3Rpb25zIjpbMTZdLCJ2ZXJzaW9uIjoxODQyfQ.q3V0..."
+            }
+        }
+        """
+
+        secret = quiz_pack_secret()
+        locale = request_locale()
+        version = bank_version()
+
+        pack = quiz_packs.get(category_id, locale, version)
+        if pack is None:
+            category = Category.query.get(category_id)
+            if category is None:
+                raise CategoryNotFound(category_id)
+            # Concurrent misses of the same pack build it once
+            pack = single_flight.do(('quiz-pack', category_id, locale, version),
+                                    lambda: build_quiz_pack(category, locale, version, secret))
+            quiz_packs.put(pack)
+
+        if request.accept_encodings['gzip']:
+            response = Response(pack.body, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(pack.etag)
+        else:
+            response = Response(pack.content(), mimetype='application/json')
+            response.set_etag(f"{pack.etag}-identity")
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config.get('QUIZ_PACK_MAX_AGE', DEFAULT_MAX_AGE)
+        response.vary.add('Accept-Encoding')
+        return localized(response.make_conditional(request), locale)
+
+
+    @app.route('/quizzes/pack-results', methods=['POST'])
+    def submit_pack_results():
+        """
+        Records the answers of a quiz played from a quiz pack in one request: every
+        answered question counts as a play and an answer in the question statistics
+        and, when a `player` is given, the number of correct answers is recorded as
+        the score in the leaderboards of the category and the global one.
+        
+        Methods: ['POST']
+        
+        Request Data: A JSON object with the `token` of the pack, the `answers` in the
+            format of POST /quizzes/answers and optionally the `player`. Each question
+            of the pack can be answered once.
+        
+        Sample request data: {
+            "token": "eyJjYXRlZ29yeSI6MiwicXVlc3Rpb25zIjpbMTZdLCJ2ZXJzaW9uIjoxODQyfQ.q3V0...",
+            "player": "ada",
+            "answers": [
+                {"question_id": 16, "correct": true}
+            ]
+        } 
+        
+        Sample response: {
+            "success": True,
+            "status_code": 201,
+            "message": "Results recorded",
+            "recorded": 1,
+            "score": 1,
+            "ranks": {
+                "0": 3,
+                "2": 1
+            }
+        }
+        
+        `ranks` is null without a `player`.
+        """
+
+        body = request.get_json()
+
+        results = validate_answers(body)
+        if not results['success']:
+            abort(results['error'], description={'custom_message': results['message']})
+
+        player = body.get('player')
+        if player is not None and not (isinstance(player, str) and player):
+            abort(422, description={'custom_message': "'player' must be a non-empty string"})
+
+        claims = verify_token(quiz_pack_secret(), body.get('token'))
+        if claims is None:
+            abort(422, description={'custom_message': "'token' must be the token of a quiz pack"})
+
+        answered = [answer['question_id'] for answer in body['answers']]
+        if len(set(answered)) != len(answered) or not set(answered) <= set(claims['questions']):
+            abort(422, description={'custom_message': "Only the questions of the pack can be answered, each once"})
+
+        question_stats.record_plays(answered)
+        question_stats.record_answers(
+            (answer['question_id'], answer['correct']) for answer in body['answers'])
+        score = sum(answer['correct'] for answer in body['answers'])
+        ranks = leaderboard.record(player, claims['category'], score) if player else None
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 201,
+                "message": "Results recorded",
+                "recorded": len(answered),
+                "score": score,
+                "ranks": ranks
+            }
+        ), 201
+
+
+    @app.route('/questions/<int:question_id>/stats', methods=['GET'])
+    def get_question_stats(question_id):
+        """
+        Fetches the aggregated play count and correct answer rate of a question.
+        Counts recorded during the last flush interval may not be included yet.
+        
+        Methods: ['GET']
+        
+        Request Arguments: 
+            question_id: ID of the question
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "stats": {
+                "question_id": 5,
+                "plays": 120,
+                "answers": 100,
+                "correct": 64,
+                "correct_rate": 0.64
+            }
+        }
+        """
+
+        if Question.query.get(question_id) is None:
+            raise QuestionNotFound(question_id)
+
+        stat = QuestionStat.query.get(question_id) or QuestionStat(question_id)
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "stats": stat.format()
+            }
+        )
+
+
+    @app.route('/questions/stats', methods=['GET'])
+    def get_questions_stats():
+        """
+        Fetches a paginated list of question statistics ordered by play count.
+        
+        Methods: ['GET']
+        
+        Request Parameters: 
+            page - Optional (default 1) representing the page number
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "stats": [
+                {"question_id": 5, "plays": 120, "answers": 100, "correct": 64, "correct_rate": 0.64}
+            ],
+            "total_questions": 1
+        }
+        """
+
+        page = request.args.get("page", 1, type=int)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+
+        all_stats = QuestionStat.query.order_by(QuestionStat.plays.desc(), QuestionStat.question_id)
+        stats_on_page = all_stats.offset(max(start, 0)).limit(QUESTIONS_PER_PAGE).all()
+
+        if len(stats_on_page) == 0:
+            abort(404, description={"custom_message": f"No question statistics on page {page}"})
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "stats": format(stats_on_page),
+                "total_questions": all_stats.count()
+            }
+        )
+
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """
+        Fetches the in-process instrumentation counters of this worker.
+        
+        Methods: ['GET']
+        
+        Request Headers: `Authorization: Bearer <ADMIN_TOKEN>`
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "tenant": "acme",
+            "single_flight": {
+                "executed": 120,
+                "coalesced": 3400,
+                "in_flight": 0
+            },
+            "rate_limiter": {
+                "limited": 12
+            },
+            "load_shedder": {
+                "in_flight": 2,
+                "max_in_flight": 16,
+                "shed": 0
+            },
+            "change_feed": {
+                "position": 1842,
+                "applied": 57,
+                "pending_gaps": 0
+            },
+            "translations": {
+                "locales": 3,
+                "cached": 420,
+                "hits": 9800,
+                "misses": 420
+            },
+            "snapshot": {
+                "loaded": true,
+                "version": 1842,
+                "built_at": 1700000000.0,
+                "reloads": 4,
+                "questions": 1000000,
+                "columns": {
+                    "ids": 8000000,
+                    "categories": 8000000,
+                    "difficulties": 1000000,
+                    "question_text": 62197775,
+                    "answer_text": 25026785,
+                    "search_text": 63197775,
+                    "category_rows": 8000000
+                },
+                "bytes": 175422335,
+                "bytes_per_million_questions": 175422335
+            },
+            "jobs": {
+                "workers": 8,
+                "jobs": {"succeeded": 3, "running": 1}
+            },
+            "quiz_packs": {
+                "packs": 6,
+                "bytes": 61440,
+                "hits": 5200,
+                "misses": 14
+            },
+            "errors": {
+                "by_status": {"404": 31, "422": 4, "500": 1},
+                "by_type": {"NotFound": 12, "QuestionNotFound": 19, "UnprocessableEntity": 2,
+                            "DuplicateQuestion": 2, "PersistenceError": 1}
+            }
+        }
+        
+        `snapshot` is null unless READ_MODE is `snapshot` or `pack`.
+        """
+
+        require_admin()
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "tenant": app.config.get('TENANT_ID'),
+                "single_flight": single_flight.stats(),
+                "rate_limiter": {
+                    "limited": rate_limiter.limited
+                },
+                "load_shedder": {
+                    "in_flight": load_shedder.in_flight,
+                    "max_in_flight": load_shedder.max_in_flight,
+                    "shed": load_shedder.shed
+                },
+                "change_feed": change_feed.stats(),
+                "translations": translations.stats(),
+                "snapshot": snapshot.stats() if snapshot else None,
+                "jobs": job_runner.stats(),
+                "quiz_packs": quiz_packs.stats(),
+                "errors": error_counters.stats()
+            }
+        )
+
+
+    """
+    Batch jobs
+    CPU-bound work over the whole question bank runs on a pool of processes,
+    see `jobs.py`. Jobs are started and followed through the admin API or `flask run-job`.
+    """
+
+    job_runner = JobRunner(app, app.config.get('JOB_WORKERS'),
+                           app.config.get('JOB_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    app.extensions['job_runner'] = job_runner
+
+    def reindex_questions(job):
+        # Changes applied by the tail to the old indexes while the new ones are
+        # built would be lost by the swap, so they are applied again afterwards
+        change_feed.start()
+        position = change_feed.position
+        texts, postings = prefix_postings(job_runner, job)
+        signatures = question_signatures(job_runner, job, duplicate_index.num_perm,
+                                         duplicate_index.bands, duplicate_index.seed)
+        prefix_index.replace(texts, postings)
+        duplicate_index.load_signatures(signatures)
+        missed = ChangeEvent.query.filter(ChangeEvent.seq > position).order_by(ChangeEvent.seq).all()
+        if missed:
+            apply_question_changes([event.format() for event in missed])
+        return {'questions': len(texts), 'terms': len(postings), 'changes_reapplied': len(missed)}
+
+    job_runner.register('validate', lambda job: validate_questions(job_runner, job, job.params['questions']))
+    job_runner.register('dedup', lambda job: find_duplicate_clusters(job_runner, job, job.params['threshold']))
+    job_runner.register('reindex', reindex_questions)
+
+    def validate_job(body):
+        error_body = '''The request body must a JSON object in the below format:
+                {
+                    "type": "<validate, dedup or reindex>",
+                    "questions": "<validate: list of questions in the format of POST /questions>",
+                    "threshold": "<dedup: optional similarity between 0 and 1, default 0.7>"
+                }
+
+            '''
+        if not (body and body.get('type') in job_runner.kinds):
+            return None, 400, error_body
+        params = {}
+        if body['type'] == 'validate':
+            if not isinstance(body.get('questions'), list):
+                return None, 422, "'questions' must be a list of questions"
+            params['questions'] = body['questions']
+        elif body['type'] == 'dedup':
+            threshold = body.get('threshold', 0.7)
+            if not (isinstance(threshold, (int, float)) and 0 < threshold <= 1):
+                return None, 422, "'threshold' must be a number between 0 and 1"
+            params['threshold'] = threshold
+        return params, None, None
+
+    def require_admin():
+        admin_token = app.config.get('ADMIN_TOKEN')
+        if not admin_token:
+            abort(403, description={'custom_message': "The admin API is disabled, set ADMIN_TOKEN to enable it"})
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {admin_token}'):
+            abort(401, description={'custom_message': "A valid `Authorization: Bearer <ADMIN_TOKEN>` header is required"})
+
+
+    @app.route('/admin/jobs', methods=['POST'])
+    def start_job():
+        """
+        Starts a batch job on the process pool. Jobs run one at a time in the order
+        they were started.
+        
+        Methods: ['POST']
+        
+        Request Headers: `Authorization: Bearer <ADMIN_TOKEN>`
+        
+        Request Data: A JSON object with the job `type` and its parameters:
+            validate - `questions`, a list of questions to import, in the format of POST /questions
+            dedup - `threshold`, optional minimum similarity of near-duplicates (default 0.7)
+            reindex - no parameters, rebuilds the autocomplete and near-duplicate indexes
+        
+        Sample request data: {
+            "type": "dedup",
+            "threshold": 0.8
+        }
+        
+        Returns: A JSON object with the queued job, with a status of 202 Accepted. Its
+            progress and result are fetched with GET /admin/jobs/<job_id>.
+        
+        Sample response: {
+            "success": True,
+            "status_code": 202,
+            "message": "Job queued",
+            "job": {
+                "id": "5f0c2a4e9b7d4f6c8a1e3b5d7f9a1c3e",
+                "type": "dedup",
+                "status": "queued",
+                "progress": 0.0,
+                "items_total": 0,
+                "items_done": 0,
+                "chunks_total": 0,
+                "chunks_done": 0,
+                "created_at": 1700000000.0,
+                "started_at": null,
+                "finished_at": null,
+                "error": null
+            }
+        }
+        """
+
+        require_admin()
+        body = request.get_json(silent=True)
+        params, error_code, error_body = validate_job(body)
+        if error_code:
+            abort(error_code, description={'custom_message': error_body})
+
+        job = job_runner.submit(body['type'], params)
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 202,
+                "message": "Job queued",
+                "job": job.format(with_result=False)
+            }
+        ), 202, {'Location': f'/admin/jobs/{job.id}'}
+
+
+    @app.route('/admin/jobs', methods=['GET'])
+    def get_jobs():
+        """
+        Lists the running, queued and recently finished jobs, most recent first, without their results.
+        
+        Methods: ['GET']
+        
+        Request Headers: `Authorization: Bearer <ADMIN_TOKEN>`
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "jobs": [
+                {
+                    "id": "5f0c2a4e9b7d4f6c8a1e3b5d7f9a1c3e",
+                    "type": "reindex",
+                    "status": "running",
+                    "progress": 0.4213,
+                    ...
+                }
+            ]
+        }
+        """
+
+        require_admin()
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "jobs": [job.format(with_result=False) for job in job_runner.jobs()]
+            }
+        )
+
+
+    @app.route('/admin/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        """
+        Fetches the progress of a job and, once it succeeded, its result.
+        
+        Methods: ['GET']
+        
+        Request Headers: `Authorization: Bearer <ADMIN_TOKEN>`
+        
+        Request Arguments: 
+            job_id: the `id` returned by POST /admin/jobs
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "job": {
+                "id": "5f0c2a4e9b7d4f6c8a1e3b5d7f9a1c3e",
+                "type": "validate",
+                "status": "succeeded",
+                "progress": 1.0,
+                "items_total": 2,
+                "items_done": 2,
+                "chunks_total": 1,
+                "chunks_done": 1,
+                "created_at": 1700000000.0,
+                "started_at": 1700000000.1,
+                "finished_at": 1700000000.4,
+                "error": null,
+                "result": {
+                    "questions": 2,
+                    "valid": 1,
+                    "problems": [
+                        {"index": 1, "error": "'category' and 'difficulty' must be integers"}
+                    ]
+                }
+            }
+        }
+        """
+
+        require_admin()
+        job = job_runner.get(job_id)
+        if job is None:
+            abort(404, description={'custom_message': f"Job with `id` {job_id} does not exist"})
+
+        return jsonify(
+            {
+                "success": True,
+                "status_code": 200,
+                "message": 'OK',
+                "job": job.format()
+            }
+        )
+
+
+    """
+    Admin statistics
+    Table sizes, category skew, cache hit rates, connection pool usage and the
+    slowest routes in one response, see `adminstats.py`. The response is built
+    at most once every ADMIN_STATS_CACHE_SECONDS seconds.
+    """
+
+    route_timings = RouteTimings()
+    app.extensions['route_timings'] = route_timings
+    admin_stats = CachedValue(app.config.get('ADMIN_STATS_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.teardown_request
+    def record_request_time(error=None):
+        started = g.pop('request_started', None)
+        # Requests that matched no route are left out, they would add one route per URL
+        if started is not None and request.url_rule is not None:
+            route_timings.record(f"{request.method} {request.url_rule.rule}", time.perf_counter() - started)
+
+    def current_category_sizes(questions):
+        # The question ids already held in memory give exact sizes for free
+        bank = snapshot_bank()
+        if bank:
+            return {category: bank.category_size(category) for category in bank.category_rows}, False
+        if category_pools.loaded:
+            return category_pools.sizes(), False
+        return category_sizes(list(all_formatted_categories()), questions)
+
+    def build_admin_stats():
+        tables = table_sizes(sorted(db.metadata.tables.values(), key=lambda table: table.name))
+        sizes, estimated = current_category_sizes(tables[Question.__tablename__])
+        single_flight_stats = single_flight.stats()
+        translation_stats = translations.stats()
+        return {
+            "generated_at": time.time(),
+            "tables": tables,
+            "categories": dict(category_skew(sizes, all_formatted_categories()), estimated=estimated),
+            "cache_hit_rates": {
+                "translations": hit_rate(translation_stats['hits'], translation_stats['misses']),
+                "single_flight": hit_rate(single_flight_stats['coalesced'], single_flight_stats['executed']),
+                "quiz_packs": hit_rate(quiz_packs.hits, quiz_packs.misses),
+                "admin_stats": hit_rate(admin_stats.hits, admin_stats.misses)
+            },
+            "connection_pool": pool_stats(db.engine),
+            "load_shedder": {
+                "in_flight": load_shedder.in_flight,
+                "max_in_flight": load_shedder.max_in_flight
+            },
+            "slowest_routes": route_timings.slowest(DEFAULT_SLOWEST_ROUTES)
+        }
+
+
+    @app.route('/admin/stats', methods=['GET'])
+    def get_admin_stats():
+        """
+        Fetches the data shape and the live performance statistics of this worker.
+        Table sizes and category sizes are planner estimates on PostgreSQL, see
+        `estimated`. The statistics are cached for ADMIN_STATS_CACHE_SECONDS seconds
+        (default 5), `generated_at` tells when they were built.
+        
+        Methods: ['GET']
+        
+        Request Headers: `Authorization: Bearer <ADMIN_TOKEN>`
+        
+        Sample response: {
+            "success": True,
+            "status_code": 200,
+            "message": "OK",
+            "generated_at": 1700000000.0,
+            "tables": {
+                "questions": {"rows": 1000000, "estimated": true},
+                "categories": {"rows": 6, "estimated": false}
+            },
+            "categories": {
+                "categories": [
+                    {"id": 1, "type": "Science", "questions": 412000},
+                    {"id": 4, "type": "History", "questions": 208000}
+                ],
+                "largest_share": 0.412,
+                "max_to_mean": 2.47,
+                "estimated": true
+            },
+            "cache_hit_rates": {
+                "translations": 0.9589,
+                "single_flight": 0.9659,
+                "quiz_packs": 0.9973,
+                "admin_stats": 0.8
+            },
+            "connection_pool": {
+                "class": "QueuePool",
+                "size": 5,
+                "checked_out": 2,
+                "checked_in": 3,
+                "overflow": -3,
+                "usage": 0.4
+            },
+            "load_shedder": {
+                "in_flight": 2,
+                "max_in_flight": 16
+            },
+            "slowest_routes": [
+                {"route": "GET /questions/export", "requests": 12, "mean_ms": 840.5, "p95_ms": 1000, "max_ms": 1210.4},
+                {"route": "POST /questions/search", "requests": 3400, "mean_ms": 18.2, "p95_ms": 50, "max_ms": 95.1}
+            ]
+        }
+        
+        A hit rate is null until its cache was used. `p95_ms` is the upper bound of
+        the latency bucket of the 95th percentile.
+        """
+
+        require_admin()
+        stats = admin_stats.get(build_admin_stats)
+
+        return jsonify(dict({"success": True, "status_code": 200, "message": 'OK'}, **stats))
+
+
+    """
+    Command line jobs
+    Run with `flask <command>` from the backend folder.
+    """
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the missing tables in the configured database."""
+        create_tables()
+        click.echo(f"Tables created in {app.config['SQLALCHEMY_DATABASE_URI']}")
+
+
+    @app.cli.command('recalibrate-difficulty')
+    @click.option('--min-answers', default=20, show_default=True,
+                  help='Only recalibrate questions with at least this many answers.')
+    @click.option('--levels', default=5, show_default=True, help='Number of difficulty levels.')
+    @click.option('--prior-weight', default=10.0, show_default=True,
+                  help='Number of answers the bank-wide correct rate is worth when smoothing.')
+    @click.option('--dry-run', is_flag=True, help='Report the changes without writing them.')
+    def recalibrate_difficulty_command(min_answers, levels, prior_weight, dry_run):
+        """Recompute question difficulty from the observed correct answer rates."""
+        from difficulty import recalibrate_difficulty
+        
+        question_stats.flush()
+        result = recalibrate_difficulty(min_answers, levels, prior_weight, dry_run)
+        click.echo(f"{result['considered']} questions considered, {result['updated']} "
+                   f"{'would be ' if dry_run else ''}updated")
+        for level, count in sorted(result['levels'].items()):
+            click.echo(f"  difficulty {level}: {count}")
+
+
+    @app.cli.command('find-duplicates')
+    @click.option('--threshold', default=0.7, show_default=True,
+                  help='Minimum estimated similarity of two questions in a cluster.')
+    def find_duplicates_command(threshold):
+        """Cluster near-duplicate questions across the whole question bank."""
+        duplicate_index.ensure_loaded()
+        clusters = duplicate_index.clusters(threshold)
+        questions = {
+            question.id: question for question in
+            Question.query.filter(Question.id.in_([id for cluster in clusters for id in cluster]))
+        }
+        for cluster in clusters:
+            click.echo(f"Cluster of {len(cluster)} questions:")
+            for question_id in cluster:
+                click.echo(f"  {question_id}: {questions[question_id].question}")
+        click.echo(f"{len(clusters)} clusters found in {len(duplicate_index.get())} questions")
+
+
+    @app.cli.command('export-questions')
+    @click.argument('output', type=click.File('wb'))
+    @click.option('--format', 'format', default='ndjson', show_default=True,
+                  type=click.Choice(available_formats()))
+    @click.option('--category', type=int, help='Only export the questions of this category.')
+    @click.option('--after-id', default=0, show_default=True,
+                  help='Resume an export after the last exported id.')
+    @click.option('--compress', type=click.Choice(COMPRESSIONS))
+    def export_questions_command(output, format, category, after_id, compress):
+        """Stream the question bank to OUTPUT (use - for stdout)."""
+        _, _, chunks = export_questions(format, category, after_id, compress)
+        for chunk in chunks:
+            output.write(chunk)
+
+
+    @app.cli.command('run-job')
+    @click.argument('type', type=click.Choice(['validate', 'dedup']))
+    @click.option('--input', 'input_file', type=click.File('r'),
+                  help='validate: JSON file with the list of questions to import.')
+    @click.option('--threshold', default=0.7, show_default=True,
+                  help='dedup: minimum estimated similarity of two questions in a cluster.')
+    def run_job_command(type, input_file, threshold):
+        """Run a batch job on the process pool and print its result as JSON."""
+        body = {'type': type, 'threshold': threshold}
+        if type == 'validate':
+            if input_file is None:
+                raise click.UsageError("validate needs --input")
+            body['questions'] = json.load(input_file)
+        params, _, error_body = validate_job(body)
+        if params is None:
+            raise click.UsageError(error_body)
+
+        job = job_runner.submit(type, params)
+        while not job.done.wait(1):
+            click.echo(f"{job.progress:.0%} ({job.items_done}/{job.items_total} items)", err=True)
+        if job.status == FAILED:
+            raise click.ClickException(job.error)
+        click.echo(json.dumps(job.result, indent=2))
+
+
+    @app.cli.command('build-question-pack')
+    @click.argument('output', required=False)
+    def build_question_pack_command(output):
+        """Compile the question bank into a pack file (default QUESTION_PACK_PATH)."""
+        output = output or question_pack_path
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        bank = build_pack(output)
+        click.echo(f"{len(bank)} questions written to {output} at version {bank.version}")
+
+
+    @app.cli.command('flush-question-queue')
+    def flush_question_queue_command():
+        """Write the questions queued in write-behind mode to the database."""
+        inserted = question_writer.flush()
+        click.echo(f"{inserted} questions inserted, {question_writer.queue.depth()} still queued")
+
+
+    @app.cli.command('prune-change-events')
+    @click.option('--keep-hours', default=24.0, show_default=True,
+                  help='Keep the change events of the last hours.')
+    def prune_change_events_command(keep_hours):
+        """Delete old events of the change feed."""
+        deleted = prune_change_events(keep_hours * 3600)
+        click.echo(f"{deleted} change events deleted")
+
+
+    """
+    Error handling
+    Every error response has the same JSON body and is counted by status code
+    and error type, see `errors` in GET /metrics.
+    """
+
+    error_counters = ErrorCounters()
+    app.extensions['error_counters'] = error_counters
+
+    def error_response(status_code, message, error_type):
+        error_counters.record(status_code, error_type)
+        return jsonify({"success": False, "error": status_code, "message": message}), status_code
+
+    @app.teardown_request
+    def rollback_failed_request(error=None):
+        # A request that raised, or whose flush failed, must not leave its
+        # transaction to be rolled back implicitly by the next user of the session
+        if error is not None or not db.session.is_active:
+            db.session.rollback()
+
+    @app.errorhandler(TriviaError)
+    def trivia_error(error):
+        if error.status_code >= 500:
+            app.logger.error(f"{error.message}: {error.__cause__!r}")
+        return error_response(error.status_code, error.message, type(error).__name__)
+
+    @app.errorhandler(404)
+    def not_found(error):
+        return error_response(404, customize_error_message(error) or error.name, type(error).__name__)
+
+    @app.errorhandler(422)
+    def unprocessable(error):
+        return error_response(422, customize_error_message(error) or "unprocessable", type(error).__name__)
+
+    @app.errorhandler(401)
+    def unauthorized(error):
+        return error_response(401, customize_error_message(error) or error.name, type(error).__name__)
+
+    @app.errorhandler(403)
+    def forbidden(error):
+        return error_response(403, customize_error_message(error) or error.name, type(error).__name__)
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return error_response(400, customize_error_message(error) or error.name, type(error).__name__)
+
+    @app.errorhandler(405)
+    def not_allowed(error):
+        return error_response(405, customize_error_message(error) or "method not allowed", type(error).__name__)
+        
+        
+    def retry_later(error, status_code):
+        response, _ = error_response(status_code, customize_error_message(error) or error.name,
+                                     type(error).__name__)
+        # Carries the Retry-After header set by `abort(..., retry_after=...)`
+        response.headers.extend(
+            (name, value) for name, value in error.get_headers() if name == 'Retry-After')
+        return response, status_code
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return retry_later(error, 429)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return retry_later(error, 503)
+        
+        
+    @app.errorhandler(500)
+    def internal_server_error(error):
+        # Unhandled exceptions reach this handler wrapped in an InternalServerError
+        original = getattr(error, 'original_exception', None) or error
+        return error_response(500, customize_error_message(error) or error.name, type(original).__name__)
+        
+        
+    def customize_error_message(error):
+        """
+        Returns the message given with `abort(code, description={'custom_message': ...})`,
+        or None for the errors raised without one.
+        """
+        return error_message(error)
         
 
     return app
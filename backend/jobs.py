@@ -0,0 +1,410 @@
+"""
+Batch jobs run on a pool of worker processes.
+
+Validating an import, clustering near-duplicates and rebuilding the search
+indexes are CPU-bound. Running them in a request thread would hold the GIL
+and slow every other request of the worker, so a `JobRunner` runs them in the
+background: a coordinator thread reads the question bank, splits it into
+chunks and hands the chunks to a `ProcessPoolExecutor`. Only the coordinator
+thread, which mostly waits for the pool, shares the GIL with the requests.
+
+The chunk functions of this module run in the pool processes: they are plain
+top-level functions of picklable arguments that never touch the database.
+"""
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from sqlalchemy import func, select
+
+from autocomplete import tokenize
+from models import db, Question, Category
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Finished jobs kept for `GET /admin/jobs`
+DEFAULT_RETENTION = 100
+
+QUESTION_FIELDS = ('answer', 'question', 'category', 'difficulty')
+
+
+"""
+Job
+
+"""
+class Job:
+    """
+    A batch job and its progress. `items_done` out of `items_total` items
+    were processed, over every phase of the job.
+    """
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.items_total = 0
+        self.items_done = 0
+        self.chunks_total = 0
+        self.chunks_done = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def progress(self):
+        if self.status == SUCCEEDED:
+            return 1.0
+        return round(self.items_done / self.items_total, 4) if self.items_total else 0.0
+
+    def format(self, with_result=True):
+        formatted = {
+            'id': self.id,
+            'type': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'items_total': self.items_total,
+            'items_done': self.items_done,
+            'chunks_total': self.chunks_total,
+            'chunks_done': self.chunks_done,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error
+        }
+        if with_result:
+            formatted['result'] = self.result
+        return formatted
+
+
+def _chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+"""
+JobRunner
+
+"""
+class JobRunner:
+    """
+    Runs the jobs of one app, one at a time, on a coordinator thread.
+
+    Job types are registered with `register(kind, handler)`; the handler is
+    called with the `Job` inside an application context and returns the job
+    result. Handlers spread their work over the pool with `map_chunks`. With
+    `max_workers` 0 the chunks are processed on the coordinator thread
+    instead, which suits hosts with a single core.
+    """
+
+    def __init__(self, app, max_workers=None, chunk_size=DEFAULT_CHUNK_SIZE, retention=DEFAULT_RETENTION):
+        self.app = app
+        self.max_workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+        self.chunk_size = chunk_size
+        self.retention = retention
+        self._handlers = {}
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pool = None
+
+    @property
+    def kinds(self):
+        return sorted(self._handlers)
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def submit(self, kind, params=None):
+        """
+        Queues a job of a registered type.
+
+        Returns:
+            Job: the queued job
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job type {kind!r}")
+        job = Job(kind, params or {})
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, other in self._jobs.items() if other.done.is_set()]
+            for job_id in finished[:max(len(finished) - self.retention, 0)]:
+                del self._jobs[job_id]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='job-runner', daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def _loop(self):
+        while True:
+            self.run(self._queue.get())
+
+    def run(self, job):
+        """
+        Runs `job` on the calling thread, inside an application context.
+        """
+        job.status = RUNNING
+        job.started_at = time.time()
+        with self.app.app_context():
+            try:
+                job.result = self._handlers[job.kind](job)
+                job.status = SUCCEEDED
+            except Exception as error:
+                self.app.logger.exception(f"Job {job.id} ({job.kind}) failed")
+                job.status = FAILED
+                job.error = str(error) or error.__class__.__name__
+            finally:
+                db.session.remove()
+                job.finished_at = time.time()
+                job.done.set()
+        return job
+
+    def _executor(self):
+        if self._pool is None:
+            # Forked children would inherit the locks and connections of the
+            # serving threads, so the pool processes are started fresh
+            self._pool = ProcessPoolExecutor(self.max_workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def map_chunks(self, job, func, items, total, *args):
+        """
+        Calls `func(chunk, *args)` on the pool for every chunk of `items` and
+        yields the results as they complete, in any order. At most twice as
+        many chunks as there are workers are in flight, so `items` can be a
+        stream over the whole bank.
+
+        Args:
+            total (int): number of items, for the progress of the job
+        """
+        job.items_total += total
+        job.chunks_total += -(-total // self.chunk_size)
+        if not self.max_workers:
+            for chunk in _chunks(items, self.chunk_size):
+                result = func(chunk, *args)
+                self._chunk_done(job, len(chunk))
+                yield result
+            return
+
+        executor = self._executor()
+        pending = {}
+        for chunk in _chunks(items, self.chunk_size):
+            pending[executor.submit(func, chunk, *args)] = len(chunk)
+            while len(pending) >= 2 * self.max_workers:
+                yield from self._completed(job, pending)
+        while pending:
+            yield from self._completed(job, pending)
+
+    def _completed(self, job, pending):
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            self._chunk_done(job, pending.pop(future))
+            yield future.result()
+
+    def _chunk_done(self, job, size):
+        job.chunks_done += 1
+        job.items_done += size
+
+    def wait(self, job_id, timeout=None):
+        job = self._jobs[job_id]
+        job.done.wait(timeout)
+        return job
+
+    def stats(self):
+        with self._lock:
+            statuses = defaultdict(int)
+            for job in self._jobs.values():
+                statuses[job.status] += 1
+        return {'workers': self.max_workers, 'jobs': dict(statuses)}
+
+
+def validate_question_payload(payload, category_ids):
+    """
+    Checks one question of an import the way `POST /questions` does, and that its category exists.
+
+    Returns:
+        str: the reason the question is invalid, or None
+    """
+    if not isinstance(payload, dict) or not all(payload.get(key) for key in QUESTION_FIELDS):
+        return f"The question must have a non-empty {', '.join(QUESTION_FIELDS)}"
+    if not (isinstance(payload['question'], str) and isinstance(payload['answer'], str)):
+        return "'question' and 'answer' must be strings"
+    try:
+        category, difficulty = int(payload['category']), int(payload['difficulty'])
+    except (TypeError, ValueError):
+        return "'category' and 'difficulty' must be integers"
+    if category not in category_ids:
+        return f"The category with ID {category} does not exist"
+    return None
+
+
+def _duplicate_key(payload):
+    return ' '.join(tokenize(payload['question']))
+
+
+def validate_chunk(rows, category_ids):
+    """
+    Pool function: validates (index, payload) rows.
+
+    Returns:
+        list: (index, error, duplicate key) of every row
+    """
+    results = []
+    for index, payload in rows:
+        error = validate_question_payload(payload, category_ids)
+        results.append((index, error, None if error else _duplicate_key(payload)))
+    return results
+
+
+def postings_chunk(rows):
+    """
+    Pool function: tokenizes (id, question) rows for a `PrefixIndex`.
+
+    Returns:
+        dict: word -> ids of the questions of the chunk containing it
+    """
+    postings = defaultdict(list)
+    for question_id, question in rows:
+        for term in set(tokenize(question)):
+            postings[term].append(question_id)
+    return postings
+
+
+_signers = {}
+
+
+def signature_chunk(rows, num_perm, bands, seed):
+    """
+    Pool function: computes the MinHash signatures of (id, question, answer) rows.
+
+    Returns:
+        list: (id, signature) pairs
+    """
+    from dedup import MinHashLSH, question_text
+
+    signer = _signers.get((num_perm, bands, seed))
+    if signer is None:
+        signer = _signers[(num_perm, bands, seed)] = MinHashLSH(num_perm, bands, seed=seed)
+    return [(question_id, signer.signature(question_text(question, answer)))
+            for question_id, question, answer in rows]
+
+
+def _question_count():
+    return db.session.execute(select(func.count()).select_from(Question)).scalar()
+
+
+def _stream(*columns):
+    return db.session.execute(
+        select(*columns).order_by(Question.id).execution_options(stream_results=True))
+
+
+def validate_questions(runner, job, payloads):
+    """
+    Validates the questions of an import and finds the ones whose text is
+    already in the bank, or that repeat another question of the import
+    apart from case and punctuation.
+
+    Returns:
+        dict: the number of valid questions and the problems of the others
+    """
+    category_ids = set(db.session.execute(select(Category.id)).scalars())
+    rows = list(enumerate(payloads))
+    problems, keys = [], {}
+    for results in runner.map_chunks(job, validate_chunk, rows, len(rows), category_ids):
+        for index, error, key in results:
+            if error:
+                problems.append({'index': index, 'error': error})
+            else:
+                keys[index] = key
+
+    first_of_key = {}
+    for index in sorted(keys):
+        first_of_key.setdefault(keys[index], index)
+    existing = {}
+    texts = sorted({payloads[index]['question'] for index in first_of_key.values()})
+    for batch in _chunks(texts, 500):
+        for question_id, question in db.session.execute(
+                select(Question.id, Question.question).where(Question.question.in_(batch))):
+            existing[' '.join(tokenize(question))] = question_id
+
+    for index in sorted(keys):
+        key = keys[index]
+        if key in existing:
+            problems.append({'index': index,
+                             'error': f"The question already exists with ID {existing[key]}"})
+        elif first_of_key[key] != index:
+            problems.append({'index': index,
+                             'error': f"The question repeats the question at index {first_of_key[key]}"})
+
+    problems.sort(key=lambda problem: problem['index'])
+    return {'questions': len(payloads), 'valid': len(payloads) - len(problems), 'problems': problems}
+
+
+def question_signatures(runner, job, num_perm, bands, seed):
+    """
+    Returns:
+        dict: question id -> MinHash signature of the whole bank
+    """
+    signatures = {}
+    rows = _stream(Question.id, Question.question, Question.answer)
+    for results in runner.map_chunks(job, signature_chunk, rows, _question_count(), num_perm, bands, seed):
+        signatures.update(results)
+    return signatures
+
+
+def find_duplicate_clusters(runner, job, threshold):
+    """
+    Clusters the near-duplicate questions of the whole bank.
+
+    Returns:
+        dict: the clusters as lists of question ids, largest first
+    """
+    from dedup import MinHashLSH
+
+    index = MinHashLSH(threshold=threshold)
+    index.load_signatures(question_signatures(runner, job, index.num_perm, index.bands, index.seed))
+    clusters = index.clusters(threshold)
+    return {'questions': len(index), 'clusters': clusters}
+
+
+def prefix_postings(runner, job):
+    """
+    Tokenizes the question text of the whole bank for a `PrefixIndex`.
+
+    Returns:
+        tuple: question id -> text, word -> set of question ids
+    """
+    texts, postings = {}, defaultdict(set)
+    rows = list(_stream(Question.id, Question.question))
+    texts.update(rows)
+    for results in runner.map_chunks(job, postings_chunk, rows, len(rows)):
+        for term, question_ids in results.items():
+            postings[term].update(question_ids)
+    return texts, postings
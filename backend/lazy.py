@@ -0,0 +1,28 @@
+import threading
+
+
+class LazyObject:
+    """
+    Stands in for an object that is expensive to import or build, for example
+    because it needs numpy. The object is created by `factory` on the first
+    attribute access, so workers that never use it do not pay for it at startup.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._instance = None
+
+    @property
+    def created(self):
+        return self._instance is not None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
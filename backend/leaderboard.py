@@ -0,0 +1,286 @@
+import math
+import random
+import threading
+import time
+
+from sqlalchemy import select, tuple_
+
+from background import PeriodicTask
+from models import db, LeaderboardEntry
+
+# Scope used for the leaderboard across every category
+GLOBAL_SCOPE = 0
+
+# Entries written up to this many seconds before the newest one merged are
+# read again, for the transactions that committed late and the clocks of the
+# other hosts that are behind
+MERGE_OVERLAP = 60
+
+"""
+IndexableSkipList
+
+"""
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, next, width):
+        self.key = key
+        self.next = next
+        self.width = width
+
+
+class IndexableSkipList:
+    """
+    An ordered collection of unique keys where insert, remove and rank lookups
+    all run in O(log n). Every link stores how many positions it skips, so the
+    rank of a key is the sum of the widths crossed while searching for it.
+    """
+
+    MAX_LEVELS = 24
+
+    def __init__(self):
+        self._nil = _Node(None, [], [])
+        self._head = _Node(None, [self._nil] * self.MAX_LEVELS, [1] * self.MAX_LEVELS)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _search(self, key):
+        # Returns the rightmost node before `key` on every level and its position
+        chain = [None] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level] is not self._nil and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps_at_level
+
+    def insert(self, key):
+        chain, steps_at_level = self._search(key)
+        levels = min(self.MAX_LEVELS, 1 - int(math.log(1.0 - random.random(), 2.0)))
+        new_node = _Node(key, [None] * levels, [None] * levels)
+        steps = 0
+        for level in range(levels):
+            prev_node = chain[level]
+            new_node.next[level] = prev_node.next[level]
+            prev_node.next[level] = new_node
+            new_node.width[level] = prev_node.width[level] - steps
+            prev_node.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain, _ = self._search(key)
+        target = chain[0].next[0]
+        if target is self._nil or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev_node = chain[level]
+            prev_node.width[level] += target.width[level] - 1
+            prev_node.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """
+        Returns the zero based position of `key` or None when it is not stored.
+        """
+        chain, steps_at_level = self._search(key)
+        target = chain[0].next[0]
+        if target is self._nil or target.key != key:
+            return None
+        return sum(steps_at_level)
+
+    def head(self, limit):
+        """
+        Yields the first `limit` keys in order.
+        """
+        node = self._head.next[0]
+        while node is not self._nil and limit > 0:
+            yield node.key
+            node = node.next[0]
+            limit -= 1
+
+
+"""
+Leaderboard
+
+"""
+class Leaderboard:
+    """
+    Keeps the best score of every player per category and globally in memory.
+
+    Rankings are updated incrementally as scores are recorded, so reading the top
+    players or the rank of a single player never sorts the scores table. Every
+    `snapshot_interval` seconds a background thread writes the changed entries
+    back to `leaderboard_entries` in a batch and merges the better scores that
+    the other workers wrote there, so the rankings of all workers agree within
+    one interval. Only the entries updated since the last merge are read.
+    """
+
+    def __init__(self, app, snapshot_interval=30):
+        self._lock = threading.RLock()
+        self._boards = {}   # scope -> IndexableSkipList of (-score, player)
+        self._scores = {}   # scope -> {player: score}
+        self._dirty = set() # (scope, player) pairs not yet written to the database
+        self._merged_until = 0  # the newest `updated_at` merged
+        self._loaded = False
+        self._snapshots = PeriodicTask(app, 'leaderboard-snapshot', snapshot_interval, self.sync)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for entry in LeaderboardEntry.query.yield_per(1000):
+                self._set(entry.scope, entry.player, entry.score)
+                self._merged_until = max(self._merged_until, entry.updated_at)
+            self._loaded = True
+        # Workers that only read the rankings must follow the other workers too
+        self._snapshots.start()
+
+    def _set(self, scope, player, score):
+        board = self._boards.setdefault(scope, IndexableSkipList())
+        scores = self._scores.setdefault(scope, {})
+        previous = scores.get(player)
+        if previous is not None:
+            if previous >= score:
+                return False
+            board.remove((-previous, player))
+        board.insert((-score, player))
+        scores[player] = score
+        return True
+
+    def record(self, player, category, score):
+        """
+        Records a quiz score for a player in the category and global rankings.
+
+        Args:
+            player (str): The player name
+            category (int): The category of the quiz or None for a quiz from all categories
+            score (int): The number of correctly answered questions
+
+        Returns:
+            dict: The rank of the player in each scope the score was recorded in
+        """
+        self._ensure_loaded()
+        scopes = [GLOBAL_SCOPE] if not category else [category, GLOBAL_SCOPE]
+        with self._lock:
+            for scope in scopes:
+                if self._set(scope, player, score):
+                    self._dirty.add((scope, player))
+            ranks = {scope: self._rank(scope, player) for scope in scopes}
+        self._snapshots.start()
+        return ranks
+
+    def _rank(self, scope, player):
+        score = self._scores.get(scope, {}).get(player)
+        if score is None:
+            return None
+        return self._boards[scope].rank((-score, player)) + 1
+
+    def rank(self, player, scope=GLOBAL_SCOPE):
+        """
+        Returns the one based rank and best score of a player or None if the player has no score.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            rank = self._rank(scope, player)
+            if rank is None:
+                return None
+            return {
+                'player': player,
+                'rank': rank,
+                'score': self._scores[scope][player],
+                'total_players': len(self._boards[scope])
+            }
+
+    def top(self, scope=GLOBAL_SCOPE, limit=10):
+        """
+        Returns the `limit` best players of a scope ordered by rank.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            board = self._boards.get(scope)
+            if board is None:
+                return []
+            return [
+                {'rank': position, 'player': player, 'score': -negative_score}
+                for position, (negative_score, player) in enumerate(board.head(limit), start=1)
+            ]
+
+    def snapshot(self):
+        """
+        Writes every changed entry to the database in a single transaction.
+        Must be called within an application context.
+
+        Returns:
+            int: The number of entries written
+        """
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            values = {key: self._scores[key[0]][key[1]] for key in dirty}
+
+        if not values:
+            return 0
+
+        try:
+            now = time.time()
+            existing = LeaderboardEntry.query.filter(
+                tuple_(LeaderboardEntry.scope, LeaderboardEntry.player).in_(list(values))).all()
+            for entry in existing:
+                # Other workers may have written a better score in the meantime
+                score = values.pop((entry.scope, entry.player))
+                if score > entry.score:
+                    entry.score = score
+                    entry.updated_at = now
+            db.session.add_all(
+                LeaderboardEntry(scope=scope, player=player, score=score, updated_at=now)
+                for (scope, player), score in values.items())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        return len(dirty)
+
+    def merge(self):
+        """
+        Merges the entries of `leaderboard_entries` updated since the last
+        merge into the rankings: a score better than the one held here was
+        recorded by another worker.
+        Must be called within an application context.
+
+        Returns:
+            int: The number of entries that improved
+        """
+        since = self._merged_until - MERGE_OVERLAP
+        rows = db.session.execute(select(
+            LeaderboardEntry.scope, LeaderboardEntry.player, LeaderboardEntry.score, LeaderboardEntry.updated_at
+        ).where(LeaderboardEntry.updated_at > since).execution_options(stream_results=True))
+
+        improved, merged_until = 0, self._merged_until
+        for partition in rows.partitions(1000):
+            with self._lock:
+                for scope, player, score, updated_at in partition:
+                    improved += self._set(scope, player, score)
+                    merged_until = max(merged_until, updated_at)
+        with self._lock:
+            self._merged_until = max(self._merged_until, merged_until)
+        return improved
+
+    def sync(self):
+        """
+        Writes the changed entries, then merges the scores of the other workers.
+        """
+        self.snapshot()
+        return self.merge()
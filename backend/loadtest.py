@@ -0,0 +1,312 @@
+"""
+Load test replaying the traffic of quiz players against a running or spawned server.
+
+Every simulated player repeatedly picks a scenario following the frontend views
+(a quiz session, browsing the question list, a search or adding a question) and
+runs it without think time. The number of players is ramped up in stages, and
+each stage reports its throughput and latency percentiles, so the stage where
+throughput stops growing while latency keeps climbing is the saturation point.
+
+Usage (from the backend folder):
+    python loadtest.py [--players 1,2,4,8,16,32] [--duration 10] [--bank-size 5000]
+    python loadtest.py --url http://localhost:5000 [--read-only]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# Questions of a quiz, as in the frontend `QuizView`
+QUESTIONS_PER_PLAY = 5
+
+# Relative frequency of the scenarios
+SCENARIO_WEIGHTS = {
+    'quiz': 70,
+    'browse': 20,
+    'search': 7,
+    'add_question': 3,
+}
+
+SEARCH_TERMS = ['title', 'river', 'who', 'the', 'world cup', 'painter', 'xyz']
+
+# Throughput gain under which a stage counts as saturated
+SATURATION_GAIN = 0.05
+
+SERVER = """
+import sys
+from flaskr import create_app
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'RATE_LIMIT_ENABLED': False})
+app.run(host='127.0.0.1', port=int(sys.argv[2]), threaded=True)
+"""
+
+
+"""
+Player
+
+"""
+class Player:
+    """
+    A simulated player with its own keep-alive connection. Every request is
+    timed and recorded in `samples` as (endpoint, seconds, ok).
+    """
+
+    def __init__(self, url, player_id, rng, read_only=False):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.name = f"player-{player_id}"
+        self.rng = rng
+        self.read_only = read_only
+        self.samples = []
+        self.categories = None
+
+    def request(self, endpoint, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                    headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            ok = response.status < 500
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.samples.append((endpoint, time.perf_counter() - start, False))
+            return None
+        self.samples.append((endpoint, time.perf_counter() - start, ok))
+        if response.status >= 400:
+            return None
+        return json.loads(data) if data else {}
+
+    def load_categories(self):
+        result = self.request('GET /categories', 'GET', '/categories')
+        if result:
+            self.categories = [int(category_id) for category_id in result['categories']]
+        return self.categories or []
+
+    def quiz(self):
+        # QuizView: pick a category (0 is "ALL") and ask for questions one at a time
+        categories = self.load_categories()
+        quiz_category = self.rng.choice([0] + categories)
+        previous_questions, answers = [], []
+        while len(previous_questions) < QUESTIONS_PER_PLAY:
+            result = self.request('POST /quizzes', 'POST', '/quizzes', {
+                'previous_questions': previous_questions,
+                'quiz_category': quiz_category
+            })
+            if not result or not result.get('question'):
+                break
+            question_id = result['question']['id']
+            previous_questions.append(question_id)
+            answers.append({'question_id': question_id, 'correct': self.rng.random() < 0.6})
+
+        if answers and not self.read_only:
+            self.request('POST /quizzes/answers', 'POST', '/quizzes/answers', {'answers': answers})
+            self.request('POST /scores', 'POST', '/scores', {
+                'player': self.name,
+                'score': sum(answer['correct'] for answer in answers),
+                'quiz_category': quiz_category or None
+            })
+
+    def browse(self):
+        # QuestionView: a few pages of the list, then the questions of a category
+        for page in range(1, self.rng.randint(1, 3) + 1):
+            if self.request('GET /questions', 'GET', f'/questions?page={page}') is None:
+                break
+        categories = self.categories or self.load_categories()
+        if categories:
+            category_id = self.rng.choice(categories)
+            self.request('GET /categories/<id>/questions', 'GET', f'/categories/{category_id}/questions')
+
+    def search(self):
+        self.request('POST /questions/search', 'POST', '/questions/search',
+                     {'searchTerm': self.rng.choice(SEARCH_TERMS)})
+
+    def add_question(self):
+        # FormView: load the categories and submit a new question
+        categories = self.load_categories()
+        if self.read_only or not categories:
+            return self.search()
+        unique = f"{self.name} {self.rng.getrandbits(48):x}"
+        self.request('POST /questions', 'POST', '/questions', {
+            'question': f"Load test question {unique}?",
+            'answer': f"Answer {unique}",
+            'category': self.rng.choice(categories),
+            'difficulty': self.rng.randint(1, 5)
+        })
+
+    def run(self, stop):
+        scenarios, weights = zip(*SCENARIO_WEIGHTS.items())
+        while not stop.is_set():
+            getattr(self, self.rng.choices(scenarios, weights)[0])()
+        self.connection.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_stage(url, players, duration, read_only, seed):
+    """
+    Runs `players` players for `duration` seconds.
+
+    Returns:
+        dict: request count, errors, throughput and latency percentiles in ms,
+            overall and per endpoint
+    """
+    stop = threading.Event()
+    simulated = [Player(url, index, random.Random(seed * 1000 + index), read_only)
+                 for index in range(players)]
+    threads = [threading.Thread(target=player.run, args=(stop,), daemon=True) for player in simulated]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    by_endpoint = defaultdict(list)
+    errors = 0
+    for player in simulated:
+        for endpoint, seconds, ok in player.samples:
+            by_endpoint[endpoint].append(seconds * 1000)
+            errors += not ok
+
+    def summary(latencies):
+        latencies = sorted(latencies)
+        return {
+            'requests': len(latencies),
+            'rps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+        }
+
+    result = summary([latency for latencies in by_endpoint.values() for latency in latencies])
+    result.update(players=players, errors=errors,
+                  endpoints={endpoint: summary(latencies) for endpoint, latencies in by_endpoint.items()})
+    return result
+
+
+def saturation_point(stages):
+    """
+    Returns the number of players of the first stage whose throughput grew by
+    less than `SATURATION_GAIN` over the previous one, or None.
+    """
+    for previous, stage in zip(stages, stages[1:]):
+        if stage['rps'] < previous['rps'] * (1 + SATURATION_GAIN):
+            return previous['players']
+    return None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(database_url, bank_size):
+    """
+    Starts the app in a child process, on a seeded SQLite database of
+    `bank_size` questions unless `database_url` is given.
+
+    Returns:
+        tuple: the child process, its url and the database file to remove or None
+    """
+    database_file = None
+    if not database_url:
+        from fixtures import build_database
+        handle, database_file = tempfile.mkstemp(prefix='trivia_loadtest_', suffix='.db')
+        os.close(handle)
+        build_database(database_file, bank_size)
+        database_url = f'sqlite:///{database_file}'
+
+    port = _free_port()
+    server = subprocess.Popen([sys.executable, '-c', SERVER, database_url, str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/categories')
+            if connection.getresponse().status == 200:
+                return server, url, database_file
+        except OSError:
+            time.sleep(0.2)
+        if server.poll() is not None:
+            break
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+def print_stage(stage, by_endpoint):
+    print(f"{stage['players']:>8}{stage['requests']:>10}{stage['errors']:>8}{stage['rps']:>10.1f}"
+          f"{stage['p50']:>10.1f}{stage['p90']:>10.1f}{stage['p99']:>10.1f}")
+    if by_endpoint:
+        for endpoint, summary in sorted(stage['endpoints'].items()):
+            print(f"{'':>8}  {endpoint:<32}{summary['requests']:>8}{summary['rps']:>10.1f}"
+                  f"{summary['p50']:>10.1f}{summary['p99']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default=None,
+                        help='server to test, a server is spawned when omitted')
+    parser.add_argument('--database-url', default=None,
+                        help='database of the spawned server, a seeded SQLite file when omitted')
+    parser.add_argument('--bank-size', type=int, default=5000,
+                        help='generated questions of the seeded SQLite database')
+    parser.add_argument('--players', default='1,2,4,8,16,32',
+                        help='comma separated numbers of concurrent players, one stage each')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per stage')
+    parser.add_argument('--read-only', action='store_true',
+                        help='do not create questions, answers or scores')
+    parser.add_argument('--by-endpoint', action='store_true', help='print every endpoint of every stage')
+    parser.add_argument('--json', default=None, help='also write the stages to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    server = database_file = None
+    url = args.url
+    if url is None:
+        server, url, database_file = spawn_server(args.database_url, args.bank_size)
+
+    try:
+        print(f"{'players':>8}{'requests':>10}{'errors':>8}{'req/s':>10}"
+              f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+        stages = []
+        for players in (int(value) for value in args.players.split(',')):
+            stage = run_stage(url, players, args.duration, args.read_only, args.seed)
+            stages.append(stage)
+            print_stage(stage, args.by_endpoint)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if database_file is not None:
+            os.remove(database_file)
+
+    saturated = saturation_point(stages)
+    if saturated is not None:
+        print(f"Throughput stops growing after {saturated} players "
+              f"({max(stage['rps'] for stage in stages):.1f} req/s at best)")
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(stages, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,55 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, Float, Text, ForeignKey, UniqueConstraint, create_engine
+from sqlalchemy.exc import SQLAlchemyError
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from errors import PersistenceError
+
 database_name = 'trivia'
 username='student'
 password='student'
 database_path = 'postgresql://{}:{}@{}/{}'.format(username,password,'localhost:5432', database_name)
+default_database_path = database_path
 
 db = SQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    The database path defaults to the one in the app config, for example set by
+    `create_app(test_config)`, and then to `database_path`.
+    Tables are not created here, see `create_tables`.
 """
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = (
+        database_path or app.config.get("SQLALCHEMY_DATABASE_URI") or default_database_path)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
+
+"""
+create_tables()
+    creates the missing tables in the database bound to the current app.
+    This is a migration step run once per database with `flask init-db`,
+    not on every application start.
+"""
+def create_tables():
     db.create_all()
 
+"""
+commit(failure_message)
+    commits the session. When the commit fails the session is rolled back at
+    once, so it does not stay in a failed state for the rest of the request,
+    and a `PersistenceError` with `failure_message` is raised.
+"""
+def commit(failure_message="The change could not be saved"):
+    try:
+        db.session.commit()
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        raise PersistenceError(failure_message) from error
+
 """
 Question
 
@@ -31,7 +60,7 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer)
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -42,14 +71,15 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit("The question could not be created")
 
     def update(self):
-        db.session.commit()
+        commit(f"Question with `id` {self.id} could not be updated")
 
     def delete(self):
+        question_id = self.id
         db.session.delete(self)
-        db.session.commit()
+        commit(f"Question with `id` {question_id} could not be deleted")
 
     def format(self):
         return {
@@ -78,3 +108,132 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+"""
+LeaderboardEntry
+    the best score of a player within a scope, where scope 0 is the global
+    leaderboard and any other value is a category id
+"""
+class LeaderboardEntry(db.Model):
+    __tablename__ = 'leaderboard_entries'
+    __table_args__ = (UniqueConstraint('scope', 'player'),)
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(Integer, nullable=False, index=True)
+    player = Column(String, nullable=False)
+    score = Column(Integer, nullable=False)
+    # When the score was last raised, so that workers merge only the newer entries
+    updated_at = Column(Float, nullable=False, default=0, index=True)
+
+    def __init__(self, scope, player, score, updated_at=0):
+        self.scope = scope
+        self.player = player
+        self.score = score
+        self.updated_at = updated_at
+
+    def format(self):
+        return {
+            'id': self.id,
+            'scope': self.scope,
+            'player': self.player,
+            'score': self.score
+            }
+
+"""
+QuestionStat
+    aggregated play counts and answer outcomes of a question
+"""
+class QuestionStat(db.Model):
+    __tablename__ = 'question_stats'
+
+    question_id = Column(Integer, primary_key=True, autoincrement=False)
+    plays = Column(Integer, nullable=False, default=0)
+    answers = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, question_id, plays=0, answers=0, correct=0):
+        self.question_id = question_id
+        self.plays = plays
+        self.answers = answers
+        self.correct = correct
+
+    def format(self):
+        return {
+            'question_id': self.question_id,
+            'plays': self.plays,
+            'answers': self.answers,
+            'correct': self.correct,
+            'correct_rate': self.correct / self.answers if self.answers else None
+            }
+
+"""
+QuestionTranslation
+    the question and answer text of a question in another locale
+    than the default one, which is stored in `questions`.
+"""
+class QuestionTranslation(db.Model):
+    __tablename__ = 'question_translations'
+
+    # The locale comes first so that loading a page of one locale is a range scan
+    locale = Column(String, primary_key=True)
+    question_id = Column(Integer, ForeignKey('questions.id', ondelete='CASCADE'), primary_key=True)
+    question = Column(String, nullable=False)
+    answer = Column(String, nullable=False)
+
+    def __init__(self, question_id, locale, question, answer):
+        self.question_id = question_id
+        self.locale = locale
+        self.question = question
+        self.answer = answer
+
+    def format(self):
+        return {
+            'question_id': self.question_id,
+            'locale': self.locale,
+            'question': self.question,
+            'answer': self.answer
+            }
+
+"""
+ChangeEvent
+    one row of the change feed: a question or category that was inserted,
+    updated or deleted, or a bulk update of many of them (`entity_id` is then
+    null and `data` holds the ids).
+"""
+class ChangeEvent(db.Model):
+    __tablename__ = 'change_events'
+
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer)
+    operation = Column(String, nullable=False)
+    data = Column(Text)
+    created_at = Column(Float, nullable=False)
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'operation': self.operation,
+            'data': json.loads(self.data) if self.data else None,
+            'created_at': self.created_at
+            }
+
+"""
+QuestionWriteReceipt
+    a question inserted by the write-behind writer, keyed by the tracking id
+    of its queue entry and committed with the question, so that a retried
+    entry finds its own insert.
+"""
+class QuestionWriteReceipt(db.Model):
+    __tablename__ = 'question_write_receipts'
+
+    tracking_id = Column(String, primary_key=True)
+    question_id = Column(Integer, nullable=False)
+    created_at = Column(Float, nullable=False, index=True)
+
+    def __init__(self, tracking_id, question_id, created_at):
+        self.tracking_id = tracking_id
+        self.question_id = question_id
+        self.created_at = created_at
@@ -0,0 +1,256 @@
+"""
+Compiled, read-only question pack files.
+
+A pack holds a `QuestionBank` in the layout it has in memory: fixed-width
+arrays for the ids, categories, difficulties and text offsets, UTF-8 string
+heaps for the texts and one array of row numbers per category. Workers map
+the file with `mmap` and serve the arrays straight from it, so startup does
+not read the bank and all the workers of a host share the same pages of the
+OS page cache.
+
+Layout, all integers little-endian:
+
+    magic (8 bytes) | format version (uint32) | metadata length (uint32)
+    metadata (JSON) | padding to 8 bytes | sections, each 8-byte aligned
+
+The metadata gives the offset, length and item type of every section, the
+category types, the row range of each category in the `category_rows`
+section and the change feed sequence number the pack was built at.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from sqlalchemy import func, select
+
+from models import db, ChangeEvent
+from snapshot import QuestionBank
+
+MAGIC = b'TRIVPACK'
+FORMAT_VERSION = 1
+_header = struct.Struct('<8sII')
+
+# Section name -> item type of its array; heaps are plain bytes ('B')
+_SECTIONS = {
+    'ids': 'q',
+    'categories': 'q',
+    'difficulties': 'b',
+    'question_heap': 'B',
+    'question_offsets': 'q',
+    'answer_heap': 'B',
+    'answer_offsets': 'q',
+    'search_heap': 'B',
+    'search_offsets': 'q',
+    'category_rows': 'q',
+}
+
+# Seconds between two checks of the pack file for a new version
+DEFAULT_CHECK_INTERVAL = 1
+
+
+def _aligned(position):
+    return (position + 7) & ~7
+
+
+def _as_bytes(data, typecode):
+    if typecode == 'B':
+        return bytes(data)
+    return array(typecode, data).tobytes()
+
+
+def write_pack(path, bank):
+    """
+    Writes `bank` to a pack file at `path`. The file is written next to
+    `path` and renamed over it, so readers never see a partial pack.
+    """
+    category_ids = sorted(bank.category_rows)
+    category_ranges, start = {}, 0
+    for category_id in category_ids:
+        count = len(bank.category_rows[category_id])
+        category_ranges[str(category_id)] = [start, count]
+        start += count
+    contents = {
+        name: getattr(bank, name) for name in _SECTIONS if name != 'category_rows'
+    }
+    contents['category_rows'] = [row for category_id in category_ids
+                                 for row in bank.category_rows[category_id]]
+    blobs = {name: _as_bytes(contents[name], typecode) for name, typecode in _SECTIONS.items()}
+    built_at = time.time()
+
+    def metadata(data_start):
+        sections, position = {}, data_start
+        for name, typecode in _SECTIONS.items():
+            sections[name] = [position, len(blobs[name]), typecode]
+            position = _aligned(position + len(blobs[name]))
+        return json.dumps({
+            'questions': len(bank),
+            'version': bank.version,
+            'built_at': built_at,
+            'category_types': {str(key): value for key, value in bank.category_types.items()},
+            'category_ranges': category_ranges,
+            'sections': sections
+        }).encode('utf-8')
+
+    # The metadata holds the offsets of the sections that follow it, so some
+    # room is reserved for these offsets growing by a few digits
+    data_start = _aligned(_header.size + len(metadata(0)) + 64)
+    encoded = metadata(data_start)
+    if _header.size + len(encoded) > data_start:
+        raise RuntimeError("Pack metadata does not fit its reserved space")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.questions-', suffix='.pack')
+    try:
+        with os.fdopen(descriptor, 'wb') as pack:
+            pack.write(_header.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+            pack.write(encoded)
+            pack.write(b'\x00' * (data_start - pack.tell()))
+            for name in _SECTIONS:
+                pack.write(b'\x00' * (_aligned(pack.tell()) - pack.tell()))
+                pack.write(blobs[name])
+            pack.flush()
+            os.fsync(pack.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def build_pack(path):
+    """
+    Compiles the question bank of the database into a pack at `path`.
+    Must be called within an application context.
+
+    Returns:
+        QuestionBank: the bank written to the pack
+    """
+    # Read before the bank, so the version never claims a change the pack misses
+    version = db.session.execute(select(func.coalesce(func.max(ChangeEvent.seq), 0))).scalar()
+    bank = QuestionBank.load(version)
+    write_pack(path, bank)
+    return bank
+
+
+"""
+MappedHeap
+
+"""
+class MappedHeap:
+    """
+    A string heap inside a mapped pack, with the slicing and `find` of bytes.
+    """
+
+    def __init__(self, mapping, start, length):
+        self._mapping = mapping
+        self._view = memoryview(mapping)[start:start + length]
+        self._start = start
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        return self._view[key]
+
+    def find(self, sub, start=0):
+        position = self._mapping.find(sub, self._start + start, self._start + self._length)
+        return position - self._start if position >= 0 else -1
+
+
+def open_pack(path):
+    """
+    Maps the pack at `path`.
+
+    Returns:
+        QuestionBank: a bank whose arrays are views of the mapped file
+    """
+    if sys.byteorder != 'little':
+        raise RuntimeError("Question packs can only be mapped on little-endian hosts")
+    with open(path, 'rb') as pack:
+        if os.fstat(pack.fileno()).st_size < _header.size:
+            raise ValueError(f"{path} is not a question pack")
+        mapping = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, format_version, metadata_length = _header.unpack_from(mapping)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} question pack")
+    metadata = json.loads(bytes(mapping[_header.size:_header.size + metadata_length]))
+
+    views = {}
+    for name, (start, length, typecode) in metadata['sections'].items():
+        if start + length > len(mapping):
+            raise ValueError(f"{path} is truncated")
+        if typecode == 'B':
+            views[name] = MappedHeap(mapping, start, length)
+        else:
+            views[name] = memoryview(mapping)[start:start + length].cast(typecode)
+
+    rows = views.pop('category_rows')
+    category_rows = {int(category_id): rows[start:start + count]
+                     for category_id, (start, count) in metadata['category_ranges'].items()}
+    bank = QuestionBank(category_rows=category_rows,
+                        category_types={int(key): value for key, value in metadata['category_types'].items()},
+                        version=metadata['version'], **views)
+    bank.built_at = metadata['built_at']
+    return bank
+
+
+"""
+MappedQuestionPack
+
+"""
+class MappedQuestionPack:
+    """
+    Serves the `QuestionBank` of a pack file, with the interface of `QuestionSnapshot`.
+
+    The file is mapped on first use. At most every `check_interval` seconds
+    the file is checked, and a new pack written over it by `flask
+    build-question-pack` is mapped in place of the old one. The old mapping is
+    released once no request uses it anymore.
+    """
+
+    def __init__(self, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._bank = None
+        self._identity = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _file_identity(self):
+        status = os.stat(self.path)
+        return status.st_ino, status.st_mtime_ns, status.st_size
+
+    def current(self):
+        now = time.monotonic()
+        if self._bank is not None and now - self._checked_at < self.check_interval:
+            return self._bank
+        with self._lock:
+            self._checked_at = now
+            try:
+                identity = self._file_identity()
+            except FileNotFoundError:
+                if self._bank is None:
+                    raise RuntimeError(
+                        f"No question pack at {self.path}, build it with `flask build-question-pack`")
+                return self._bank
+            if identity != self._identity:
+                self._bank = open_pack(self.path)
+                self._identity = identity
+                self.reloads += 1
+            return self._bank
+
+    def stats(self):
+        bank = self._bank
+        if bank is None:
+            return {'loaded': False}
+        return dict(bank.memory_usage(), loaded=True, mapped=True, path=self.path,
+                    version=bank.version, built_at=bank.built_at, reloads=self.reloads)
@@ -0,0 +1,136 @@
+"""
+Quiz packs: a whole quiz of one category in a single download.
+
+A pack holds a random subset of the questions of a category, with their
+answers, and a token signed with HMAC-SHA256 that names the category, the
+version of the bank and the ids of the questions. The client plays the pack
+offline and sends all its answers back at once with the token, which proves
+the questions were served by the server without any state kept per pack.
+
+A pack depends only on its category, locale and version: the subset is drawn
+with a generator seeded from them, so every worker builds the same pack, with
+the same bytes and ETag, until the bank changes.
+"""
+import base64
+import gzip
+import hashlib
+import hmac
+import json
+import random
+import threading
+from collections import OrderedDict
+
+DEFAULT_PACK_SIZE = 50
+MAX_PACK_SIZE = 200
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_MAX_AGE = 300
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).digest()
+
+
+def sign_token(secret, claims):
+    """
+    Returns:
+        str: the claims as base64 JSON, a dot and their base64 HMAC-SHA256 signature
+    """
+    payload = json.dumps(claims, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return f"{_encode(payload)}.{_encode(_signature(secret, payload))}"
+
+
+def verify_token(secret, token):
+    """
+    Returns:
+        dict: the claims of a token signed with `secret`, or None
+    """
+    if not isinstance(token, str) or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    try:
+        payload, signature = _decode(payload), _decode(signature)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, _signature(secret, payload)):
+        return None
+    return json.loads(payload)
+
+
+def pack_rng(category_id, locale, version):
+    return random.Random(f"{category_id}:{locale}:{version}")
+
+
+"""
+QuizPack
+
+"""
+class QuizPack:
+    """
+    A built pack: the JSON `payload` compressed once with gzip, and a strong
+    ETag derived from the compressed bytes.
+    """
+
+    def __init__(self, category_id, locale, version, payload):
+        self.category_id = category_id
+        self.locale = locale
+        self.version = version
+        # mtime 0 keeps the bytes, and so the ETag, identical between builds
+        self.body = gzip.compress(
+            json.dumps(payload, separators=(',', ':')).encode('utf-8'), compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
+    def content(self):
+        return gzip.decompress(self.body)
+
+
+"""
+QuizPackCache
+
+"""
+class QuizPackCache:
+    """
+    The latest pack of each (category, locale), least recently used first.
+    A pack of another version than the one asked for is a miss and is
+    replaced by the rebuilt one.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._packs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, category_id, locale, version):
+        with self._lock:
+            pack = self._packs.get((category_id, locale))
+            if pack is None or pack.version != version:
+                self.misses += 1
+                return None
+            self._packs.move_to_end((category_id, locale))
+            self.hits += 1
+            return pack
+
+    def put(self, pack):
+        with self._lock:
+            self._packs[(pack.category_id, pack.locale)] = pack
+            self._packs.move_to_end((pack.category_id, pack.locale))
+            while len(self._packs) > self.max_entries:
+                self._packs.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'packs': len(self._packs),
+                'bytes': sum(len(pack.body) for pack in self._packs.values()),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,187 @@
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+# Least recently used buckets looked at for pruning when a bucket is added
+PRUNE_BATCH = 16
+
+
+"""
+MemoryTokenBucketBackend
+
+"""
+class MemoryTokenBucketBackend:
+    """
+    Token buckets held in a dictionary of
+    `key -> [tokens, last refill time, seconds to refill from empty]`,
+    least recently used first.
+
+    A bucket is refilled lazily when it is used, so idle clients cost nothing
+    but their dictionary entry. When a bucket is added, the few least recently
+    used ones that have been idle long enough to be full again, by their own
+    rate, are dropped; past `max_keys` the least recently used bucket is
+    dropped even if it is not full yet.
+    Buckets are local to the process; use a shared backend to enforce limits
+    across workers.
+    """
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._max_keys = max_keys
+        self._clock = clock
+
+    def take(self, key, rate, burst):
+        """
+        Takes one token from the bucket of `key`.
+
+        Args:
+            key (str): the bucket name
+            rate (float): tokens added per second
+            burst (int): bucket capacity
+
+        Returns:
+            tuple: whether the token was granted and the seconds until the next token
+        """
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._prune(now)
+                bucket = self._buckets[key] = [burst, now, burst / rate]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True, 0
+            return False, (1 - bucket[0]) / rate
+
+    def _prune(self, now):
+        for key in list(itertools.islice(self._buckets, PRUNE_BATCH)):
+            _, refilled_at, refill_time = self._buckets[key]
+            if now - refilled_at >= refill_time:
+                del self._buckets[key]
+        while len(self._buckets) >= self._max_keys:
+            self._buckets.popitem(last=False)
+
+
+"""
+RedisTokenBucketBackend
+
+"""
+class RedisTokenBucketBackend:
+    """
+    Token buckets shared by every worker through Redis. The refill and take are
+    done atomically by a Lua script, so a request costs one round-trip.
+    """
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local granted = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        granted = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {granted, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='trivia:ratelimit:'):
+        if redis is None:
+            raise RuntimeError("The redis package is required for a Redis rate limit backend")
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._prefix = prefix
+
+    def take(self, key, rate, burst):
+        granted, tokens = self._script(keys=[self._prefix + key], args=[rate, burst, time.time()])
+        if granted:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+
+def create_backend(url=None):
+    """
+    Returns the memory backend, or a shared backend for a `redis://` url.
+    """
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisTokenBucketBackend(url)
+    return MemoryTokenBucketBackend()
+
+
+"""
+RateLimiter
+
+"""
+class RateLimiter:
+    """
+    Limits every client to `rate` requests per second with bursts of `burst`
+    requests, per route. Routes without an entry in `route_limits` use `default_limit`.
+    """
+
+    def __init__(self, backend, default_limit=(10, 50), route_limits=None):
+        self.backend = backend
+        self.default_limit = default_limit
+        self.route_limits = route_limits or {}
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def check(self, client, route):
+        """
+        Returns:
+            tuple: whether the request is allowed and the whole seconds to wait if not
+        """
+        rate, burst = self.route_limits.get(route, self.default_limit)
+        allowed, retry_after = self.backend.take(f"{client}:{route}", rate, burst)
+        if allowed:
+            return True, 0
+        with self._lock:
+            self.limited += 1
+        return False, max(1, math.ceil(retry_after))
+
+
+"""
+LoadShedder
+
+"""
+class LoadShedder:
+    """
+    Caps the number of expensive requests running at once. A request above the
+    cap is rejected immediately instead of queueing, so cheap routes keep their
+    latency while the expensive ones are saturated.
+    """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.shed = 0
+
+    def acquire(self):
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
@@ -0,0 +1,143 @@
+import math
+import random
+from itertools import islice
+
+
+def reservoir_sample(items, k, rng=random):
+    """
+    Picks `k` items uniformly at random from an iterable of unknown length in a
+    single pass, holding only `k` items in memory.
+
+    Uses Algorithm L, which computes how many items to skip before the next
+    replacement instead of drawing a random number for every item.
+
+    Args:
+        items (iterable): the population, for example a streamed query result
+        k (int): the number of items to pick
+
+    Returns:
+        list: at most `k` items in random order
+    """
+    iterator = iter(items)
+    reservoir = list(islice(iterator, k))
+    if len(reservoir) < k or k == 0:
+        rng.shuffle(reservoir)
+        return reservoir
+
+    w = math.exp(math.log(1.0 - rng.random()) / k)
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / math.log(1 - w)) if w < 1 else 0
+        try:
+            item = next(islice(iterator, skip, None))
+        except StopIteration:
+            break
+        reservoir[rng.randrange(k)] = item
+        w *= math.exp(math.log(1.0 - rng.random()) / k)
+
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+"""
+AliasTable
+
+"""
+class AliasTable:
+    """
+    Draws keys with probabilities proportional to their weights in constant
+    time per draw, whatever the number of keys (Vose's alias method).
+
+    Building the table takes O(k) for k keys: every key gets a column of
+    height 1 filled with its own probability and topped up by an alias key.
+    A draw picks a column uniformly and then either the key or its alias.
+    """
+
+    def __init__(self, weights):
+        """
+        Args:
+            weights (dict): key -> positive weight
+        """
+        self.keys = list(weights)
+        if not self.keys:
+            raise ValueError("An alias table needs at least one key")
+        total = float(sum(weights.values()))
+        size = len(self.keys)
+        scaled = [weights[key] * size / total for key in self.keys]
+        self._probability = [1.0] * size
+        self._alias = list(range(size))
+
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probability[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1 up to rounding errors and keeps its own key
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sample(self, rng=random):
+        column = rng.randrange(len(self.keys))
+        if rng.random() < self._probability[column]:
+            return self.keys[column]
+        return self.keys[self._alias[column]]
+
+
+# Random draws from a pool before its remaining items are listed instead
+MAX_REJECTIONS = 8
+
+
+def weighted_pool_sample(pools, weights, count, exclude=(), rng=random):
+    """
+    Picks up to `count` distinct items, each from a pool drawn with the
+    probability of its weight, for example question ids from per-category pools.
+
+    A pool is drawn with an `AliasTable` and an item of the pool at random, so
+    a pick takes constant time while most of its pool is still available. A
+    pool whose random draws keep hitting excluded items is narrowed down to
+    its remaining items once; an exhausted pool is dropped and the weights of
+    the others are renormalized.
+
+    Args:
+        pools (dict): key -> sequence of items, an item belonging to a single pool
+        weights (dict): key -> positive weight
+        exclude (iterable): items that must not be picked
+
+    Returns:
+        list: the picked items in the order they were drawn
+    """
+    weights = {key: weight for key, weight in weights.items() if weight > 0 and len(pools.get(key, ()))}
+    seen = set(exclude)
+    remaining = {}  # key -> items of a crowded pool not picked or excluded yet
+    picked = []
+    table = AliasTable(weights) if weights else None
+
+    while table is not None and len(picked) < count:
+        key = table.sample(rng)
+        item = None
+        if key not in remaining:
+            pool = pools[key]
+            for _ in range(MAX_REJECTIONS):
+                candidate = pool[rng.randrange(len(pool))]
+                if candidate not in seen:
+                    item = candidate
+                    break
+            else:
+                remaining[key] = [candidate for candidate in pool if candidate not in seen]
+        if key in remaining:
+            items = remaining[key]
+            if items:
+                # Swap-remove a random remaining item
+                position = rng.randrange(len(items))
+                items[position], items[-1] = items[-1], items[position]
+                item = items.pop()
+        if item is None:
+            del weights[key]
+            table = AliasTable(weights) if weights else None
+            continue
+        seen.add(item)
+        picked.append(item)
+    return picked
@@ -0,0 +1,95 @@
+import threading
+from functools import wraps
+
+from flask import current_app, request
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+"""
+SingleFlight
+
+"""
+class SingleFlight:
+    """
+    Makes concurrent calls with the same key share one execution.
+
+    The first caller of a key runs the function; callers arriving while it is
+    still running wait for it and receive the same result (or exception)
+    instead of running it again. Nothing is cached once the call finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls)
+            }
+
+
+def _request_key():
+    # Everything the read handlers and `listing_response` look at
+    return (request.method, request.full_path, request.headers.get('Accept', ''),
+            request.headers.get('Accept-Encoding', ''), request.headers.get('Accept-Language', ''))
+
+
+def coalesce(single_flight):
+    """
+    Decorator sharing the response of a read-only view between identical concurrent requests.
+    Every request gets its own copy of the response, so `after_request` hooks can modify it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            def render():
+                response = current_app.make_response(view(*args, **kwargs))
+                return response.get_data(), response.status_code, list(response.headers)
+
+            body, status, headers = single_flight.do(_request_key(), render)
+            return current_app.response_class(body, status=status, headers=headers)
+        return wrapper
+    return decorator
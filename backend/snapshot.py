@@ -0,0 +1,284 @@
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from sqlalchemy import select
+
+from models import db, Question, Category
+from sampling import weighted_pool_sample
+
+# Separates the texts of the search heap so that a match cannot span two questions
+SEARCH_SEPARATOR = b'\x00'
+
+
+def _heap(texts, separator=b''):
+    """
+    Concatenates UTF-8 encoded texts into one bytes object.
+
+    Returns:
+        tuple: the heap and the offsets array, where text `i` is heap[offsets[i]:offsets[i + 1] - len(separator)]
+    """
+    offsets = array('q', [0])
+    chunks = []
+    position = 0
+    for text in texts:
+        encoded = (text or '').encode('utf-8') + separator
+        chunks.append(encoded)
+        position += len(encoded)
+        offsets.append(position)
+    return b''.join(chunks), offsets
+
+
+"""
+QuestionBank
+
+"""
+class QuestionBank:
+    """
+    Immutable, column-oriented copy of the question bank.
+
+    Questions are stored in id order as parallel arrays (`ids`, `categories`,
+    `difficulties`) and the texts as UTF-8 heaps addressed by offset arrays,
+    with no Python object per question. `category_rows` holds, per category,
+    the row numbers of its questions.
+    """
+
+    def __init__(self, ids, categories, difficulties, question_heap, question_offsets,
+                 answer_heap, answer_offsets, search_heap, search_offsets,
+                 category_rows, category_types, version=None):
+        self.ids = ids
+        self.categories = categories
+        self.difficulties = difficulties
+        self.question_heap = question_heap
+        self.question_offsets = question_offsets
+        self.answer_heap = answer_heap
+        self.answer_offsets = answer_offsets
+        self.search_heap = search_heap
+        self.search_offsets = search_offsets
+        self.category_rows = category_rows
+        self.category_types = category_types
+        self.version = version
+        self.built_at = time.time()
+
+    @classmethod
+    def build(cls, rows, category_types, version=None):
+        """
+        Args:
+            rows (iterable): (id, question, answer, category, difficulty) tuples in id order
+            category_types (dict): category id -> type
+        """
+        ids, categories, difficulties = array('q'), array('l'), array('b')
+        questions, answers = [], []
+        category_rows = {category_id: array('l') for category_id in category_types}
+        for row, (question_id, question, answer, category, difficulty) in enumerate(rows):
+            ids.append(question_id)
+            categories.append(category or 0)
+            difficulties.append(difficulty or 0)
+            questions.append(question)
+            answers.append(answer)
+            category_rows.setdefault(category or 0, array('l')).append(row)
+
+        question_heap, question_offsets = _heap(questions)
+        answer_heap, answer_offsets = _heap(answers)
+        search_heap, search_offsets = _heap(((question or '').lower() for question in questions),
+                                            SEARCH_SEPARATOR)
+        return cls(ids, categories, difficulties, question_heap, question_offsets,
+                   answer_heap, answer_offsets, search_heap, search_offsets,
+                   category_rows, dict(category_types), version)
+
+    @classmethod
+    def load(cls, version=None):
+        """
+        Reads the whole bank from the database. Must be called within an application context.
+        """
+        questions = Question.__table__
+        category_types = dict(db.session.execute(select(Category.id, Category.type)).all())
+        rows = db.session.execute(
+            select(questions.c.id, questions.c.question, questions.c.answer,
+                   questions.c.category, questions.c.difficulty)
+            .order_by(questions.c.id)
+            .execution_options(stream_results=True))
+        return cls.build(rows, category_types, version)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _text(self, heap, offsets, row):
+        return bytes(heap[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def row(self, row):
+        return {
+            'id': self.ids[row],
+            'question': self._text(self.question_heap, self.question_offsets, row),
+            'answer': self._text(self.answer_heap, self.answer_offsets, row),
+            'category': self.categories[row],
+            'difficulty': self.difficulties[row]
+        }
+
+    def rows(self, rows):
+        return [self.row(row) for row in rows]
+
+    def page(self, start, stop):
+        return self.rows(range(max(start, 0), min(stop, len(self))))
+
+    def row_of(self, question_id):
+        row = bisect_left(self.ids, question_id)
+        if row < len(self.ids) and self.ids[row] == question_id:
+            return row
+        return None
+
+    def category_size(self, category_id):
+        return len(self.category_rows.get(category_id, ()))
+
+    def search(self, term, category=None, after_id=0, limit=50):
+        """
+        Finds the questions whose text contains `term`, ignoring case.
+
+        Returns:
+            tuple: up to `limit` rows with an id above `after_id`, the total number
+                of matches and whether there are more rows after the returned ones
+        """
+        needle = (term or '').lower().encode('utf-8')
+        heap, offsets = self.search_heap, self.search_offsets
+        first_row = bisect_right(self.ids, after_id)
+        matches, total = [], 0
+        position = 0
+        while True:
+            position = heap.find(needle, position)
+            if position < 0 or position >= len(heap):
+                break
+            row = bisect_right(offsets, position) - 1
+            if category is None or self.categories[row] == category:
+                total += 1
+                if row >= first_row and len(matches) <= limit:
+                    matches.append(row)
+            # Continue with the next question
+            position = offsets[row + 1]
+        return self.rows(matches[:limit]), total, len(matches) > limit
+
+    def sample(self, count, category=None, exclude=(), rng=random):
+        """
+        Picks up to `count` random questions, optionally of one category,
+        that are not in `exclude` (question ids).
+
+        Returns:
+            list: the picked rows
+        """
+        pool = self.category_rows.get(category, ()) if category else range(len(self))
+        excluded = {row for row in map(self.row_of, exclude) if row is not None}
+        if category:
+            excluded = {row for row in excluded if self.categories[row] == category}
+        available = len(pool) - len(excluded)
+        if available <= 0:
+            return []
+        count = min(count, available)
+
+        if (count + len(excluded)) * 4 <= len(pool):
+            # Most of the pool is available: rejection sampling touches only a few rows
+            picked = []
+            seen = set(excluded)
+            while len(picked) < count:
+                row = pool[rng.randrange(len(pool))]
+                if row not in seen:
+                    seen.add(row)
+                    picked.append(row)
+            return self.rows(picked)
+
+        return self.rows(rng.sample([row for row in pool if row not in excluded], count))
+
+    def weighted_sample(self, weights, count, exclude=(), rng=random):
+        """
+        Picks up to `count` questions that are not in `exclude` (question ids),
+        each from a category drawn with the probability of its weight.
+
+        Returns:
+            list: the picked rows
+        """
+        excluded = {row for row in map(self.row_of, exclude) if row is not None}
+        return self.rows(weighted_pool_sample(self.category_rows, weights, count, excluded, rng))
+
+    def memory_usage(self):
+        """
+        Returns:
+            dict: bytes used by each column, the total and the total per million questions
+        """
+        def size(sequence):
+            if isinstance(sequence, array):
+                return sequence.itemsize * len(sequence)
+            if isinstance(sequence, memoryview):
+                return sequence.nbytes
+            return len(sequence)
+
+        columns = {
+            'ids': size(self.ids),
+            'categories': size(self.categories),
+            'difficulties': size(self.difficulties),
+            'question_text': size(self.question_heap) + size(self.question_offsets),
+            'answer_text': size(self.answer_heap) + size(self.answer_offsets),
+            'search_text': size(self.search_heap) + size(self.search_offsets),
+            'category_rows': sum(size(rows) for rows in self.category_rows.values()),
+        }
+        total = sum(columns.values())
+        return {
+            'questions': len(self),
+            'columns': columns,
+            'bytes': total,
+            'bytes_per_million_questions': round(total / len(self) * 1000000) if len(self) else 0
+        }
+
+
+"""
+QuestionSnapshot
+
+"""
+class QuestionSnapshot:
+    """
+    Holds the current `QuestionBank` of the worker.
+
+    The bank is loaded on first use and rebuilt whenever the change feed
+    reports a change of the questions or categories; the new bank replaces
+    the old one with a single reference assignment, so requests always see
+    one consistent version. The version is the sequence number of the last
+    change event the bank includes.
+    """
+
+    def __init__(self, change_feed):
+        self.change_feed = change_feed
+        self._bank = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+        change_feed.subscribe(self._apply_changes)
+
+    def current(self):
+        bank = self._bank
+        if bank is None:
+            with self._lock:
+                if self._bank is None:
+                    self._reload()
+                bank = self._bank
+        return bank
+
+    def _reload(self, version=None):
+        # The position is read first, so a change committed while loading is applied again
+        self.change_feed.start()
+        bank = QuestionBank.load(max(version or 0, self.change_feed.position))
+        self._bank = bank
+        self.reloads += 1
+
+    def reload(self, version=None):
+        with self._lock:
+            self._reload(version)
+
+    def _apply_changes(self, events):
+        changes = [event for event in events if event['entity'] in ('question', 'category')]
+        if self._bank is not None and changes:
+            self.reload(max(event['seq'] for event in changes))
+
+    def stats(self):
+        bank = self._bank
+        if bank is None:
+            return {'loaded': False}
+        return dict(bank.memory_usage(), loaded=True, version=bank.version,
+                    built_at=bank.built_at, reloads=self.reloads)
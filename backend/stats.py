@@ -0,0 +1,123 @@
+import threading
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from background import PeriodicTask
+from models import db, QuestionStat
+
+# Number of rows sent to the database in a single upsert statement
+UPSERT_BATCH_SIZE = 1000
+
+
+def upsert_question_stats(rows):
+    """
+    Adds the counters of `rows` to the `question_stats` table, creating missing rows.
+    Uses a single `INSERT ... ON CONFLICT DO UPDATE` per batch where the dialect supports it.
+
+    Args:
+        rows (list): dictionaries with the keys `question_id`, `plays`, `answers` and `correct`
+    """
+    table = QuestionStat.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.question_id],
+            set_={
+                'plays': table.c.plays + statement.excluded.plays,
+                'answers': table.c.answers + statement.excluded.answers,
+                'correct': table.c.correct + statement.excluded.correct,
+            })
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            db.session.execute(statement, rows[start:start + UPSERT_BATCH_SIZE])
+    else:
+        # Generic fallback: one update per row and an insert for the rows that did not exist
+        for row in rows:
+            updated = db.session.execute(
+                table.update()
+                .where(table.c.question_id == row['question_id'])
+                .values(plays=table.c.plays + row['plays'],
+                        answers=table.c.answers + row['answers'],
+                        correct=table.c.correct + row['correct']))
+            if updated.rowcount == 0:
+                db.session.execute(table.insert().values(**row))
+
+
+"""
+QuestionStatsAggregator
+
+"""
+class QuestionStatsAggregator:
+    """
+    Counts how often questions are served and answered in memory and merges the
+    counters into `question_stats` from a background thread every `flush_interval`
+    seconds. Recording is a dictionary update under a lock, so the request path
+    never waits for the database.
+    """
+
+    def __init__(self, app, flush_interval=10):
+        self._lock = threading.Lock()
+        self._pending = {}  # question_id -> [plays, answers, correct]
+        self._flusher = PeriodicTask(app, 'question-stats-flush', flush_interval, self.flush,
+                                     run_at_exit=True)
+
+    def _counters(self, question_id):
+        counters = self._pending.get(question_id)
+        if counters is None:
+            counters = self._pending[question_id] = [0, 0, 0]
+        return counters
+
+    def record_plays(self, question_ids):
+        with self._lock:
+            for question_id in question_ids:
+                self._counters(question_id)[0] += 1
+        self._flusher.start()
+
+    def record_answers(self, answers):
+        """
+        Args:
+            answers (iterable): (question_id, correct) pairs
+        """
+        with self._lock:
+            for question_id, correct in answers:
+                counters = self._counters(question_id)
+                counters[1] += 1
+                counters[2] += bool(correct)
+        self._flusher.start()
+
+    def flush(self):
+        """
+        Writes the pending counters with batched upserts.
+        Must be called within an application context.
+
+        Returns:
+            int: The number of questions whose statistics were updated
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        if not pending:
+            return 0
+
+        rows = [
+            {'question_id': question_id, 'plays': plays, 'answers': answers, 'correct': correct}
+            for question_id, (plays, answers, correct) in pending.items()
+        ]
+        try:
+            upsert_question_stats(rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._merge_back(pending)
+            raise
+        return len(rows)
+
+    def _merge_back(self, pending):
+        with self._lock:
+            for question_id, values in pending.items():
+                counters = self._counters(question_id)
+                for index, value in enumerate(values):
+                    counters[index] += value
@@ -1,26 +1,41 @@
+import io
 import os
 import unittest
 import json
+import gzip
 import random
-from flask_sqlalchemy import SQLAlchemy
+import shutil
+import tempfile
+from unittest import mock
+
+from werkzeug.test import Client
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from fixtures import DatabaseTestCase, TEST_CONFIG, build_database
+from models import db, Question, Category, QuestionStat, ChangeEvent, LeaderboardEntry
+from tenants import TenantDispatcher
+from export import available_formats
+from leaderboard import Leaderboard
+from writebehind import QuestionQueue
+from questionpack import open_pack
+import adminstats
+from adminstats import RouteTimings
+from ratelimit import MemoryTokenBucketBackend
+
 
+class TriviaTestCase(DatabaseTestCase):
+    """This class represents the trivia test case
 
-class TriviaTestCase(unittest.TestCase):
-    """This class represents the trivia test case"""
+    Every test gets a fresh app and a seeded database whose changes are rolled
+    back after the test, see `fixtures.DatabaseTestCase`.
+    """
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables."""
+        super().setUp()
         self.client = self.app.test_client
-        self.username = "student"
-        self.password = "student"
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}:{}@{}/{}".format(
-            self.username, self.password, "localhost:5432", self.database_name
-        )
         
         ran_num = random.randint(1,1000)
         self.test_question = {
@@ -29,17 +44,6 @@ class TriviaTestCase(unittest.TestCase):
             "category": random.randint(1, Category.query.count()),
             "difficulty": random.randint(1,6)
         }
-        
-        
-        setup_db(self.app, self.database_path)
-        # setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
             
             
     def tearDown(self):
@@ -462,6 +466,1165 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response_data['message'], error_body)
         
         
+    def test_submit_score_and_get_leaderboard(self):
+        """Submitting a score ranks the player in the category and global leaderboards"""
+        
+        player = f"test player {random.randint(1, 1000000)}"
+        body = {
+            "player": player,
+            "score": 1000000,
+            "quiz_category": 1
+        }
+        
+        response = self.client().post("/scores", json=body)
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response_data['success'])
+        self.assertEqual(response_data['ranks'], {'0': 1, '1': 1})
+        
+        response = self.client().get("/leaderboard?category=1&limit=1")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_data['leaderboard'][0]['player'], player)
+        
+        response = self.client().get(f"/leaderboard/{player}")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_data['rank'], 1)
+        self.assertEqual(response_data['score'], 1000000)
+        
+        
+    def test_leaderboard_merges_scores_of_other_workers(self):
+        """Scores written by another worker appear after the next sync"""
+        
+        self.client().get("/leaderboard")
+        
+        other_worker = Leaderboard(self.app, 0)
+        other_worker.record("player of another worker", 2, 1000001)
+        other_worker.snapshot()
+        
+        self.assertEqual(self.app.extensions['leaderboard'].sync(), 2)
+        
+        response_data = json.loads(self.client().get("/leaderboard?category=2&limit=1").data)
+        self.assertEqual(response_data['leaderboard'][0]['player'], "player of another worker")
+
+        # Only the entries updated since the last merge are read again
+        with self.app.app_context():
+            db.session.add(LeaderboardEntry(scope=2, player="player of long ago", score=1000002, updated_at=1))
+            db.session.commit()
+        self.assertEqual(self.app.extensions['leaderboard'].sync(), 0)
+        
+        
+    def test_422_submit_score_if_validation_fails(self):
+        """Submitting a negative score or a non integer category returns 422"""
+        
+        response = self.client().post("/scores", json={"player": "test", "score": -1})
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(response_data['success'])
+        
+        response = self.client().post("/scores", json={"player": "test", "score": 1, "quiz_category": "sth"})
+        
+        self.assertEqual(response.status_code, 422)
+        
+        
+    def test_404_get_rank_of_player_without_score(self):
+        """Fetching the rank of a player that never submitted a score returns 404"""
+        
+        response = self.client().get("/leaderboard/a player without any score")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response_data['success'])
+
+
+    def test_record_answers_and_get_question_stats(self):
+        """Recorded answers are merged into the question statistics on flush"""
+        
+        question = Question.query.first()
+        body = {
+            "answers": [
+                {"question_id": question.id, "correct": True},
+                {"question_id": question.id, "correct": False}
+            ]
+        }
+        
+        response = self.client().post("/quizzes/answers", json=body)
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response_data['success'])
+        self.assertEqual(response_data['recorded'], 2)
+        
+        with self.app.app_context():
+            self.app.extensions['question_stats'].flush()
+        
+        response = self.client().get(f"/questions/{question.id}/stats")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response_data['stats']['answers'], 2)
+        self.assertGreaterEqual(response_data['stats']['correct'], 1)
+        
+        
+    def test_422_record_answers_if_validation_fails(self):
+        """Recording an answer without a boolean `correct` returns 422"""
+        
+        body = {"answers": [{"question_id": 1, "correct": "yes"}]}
+        
+        response = self.client().post("/quizzes/answers", json=body)
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(response_data['success'])
+
+
+    def test_recalibrate_difficulty_dry_run(self):
+        """The recalibration command reports the changes without writing them"""
+        
+        response = self.app.test_cli_runner().invoke(args=['recalibrate-difficulty', '--dry-run'])
+        
+        self.assertEqual(response.exit_code, 0)
+        self.assertIn("questions considered", response.output)
+
+
+    def test_recalibrate_difficulty_from_answer_stats(self):
+        """Questions get the difficulty level of their correct rate, in bulk and with one change feed event"""
+
+        from difficulty import recalibrate_difficulty
+
+        with self.app.app_context():
+            easy, hard, medium = [question.id for question in Question.query.order_by(Question.id).limit(3)]
+            for question_id, correct in ((easy, 1000), (hard, 0), (medium, 500)):
+                Question.query.get(question_id).difficulty = 1
+                db.session.add(QuestionStat(question_id, answers=1000, correct=correct))
+            db.session.commit()
+
+            self.assertEqual(recalibrate_difficulty(min_answers=1000, prior_weight=0, dry_run=True),
+                             {'considered': 3, 'updated': 2, 'levels': {3: 1, 5: 1}})
+            self.assertEqual(Question.query.get(hard).difficulty, 1)
+
+            position = db.session.query(func.max(ChangeEvent.seq)).scalar() or 0
+            result = recalibrate_difficulty(min_answers=1000, prior_weight=0)
+            self.assertEqual(result, {'considered': 3, 'updated': 2, 'levels': {3: 1, 5: 1}})
+            self.assertEqual([Question.query.get(question_id).difficulty for question_id in (easy, hard, medium)],
+                             [1, 5, 3])
+
+            events = ChangeEvent.query.filter(ChangeEvent.seq > position).all()
+            self.assertEqual([(event.operation, event.entity_id) for event in events], [('bulk_update', None)])
+            data = events[0].format()['data']
+            self.assertEqual(sorted(data['ids']), sorted([hard, medium]))
+            self.assertEqual(data['fields'], ['difficulty'])
+
+
+    def test_create_new_question_flags_near_duplicates(self):
+        """Creating a paraphrase of an existing question reports the existing question"""
+        
+        question = Question.query.first()
+        question_id = question.id
+        body = {
+            "question": question.question.rstrip('?') + " exactly?",
+            "answer": question.answer,
+            "category": question.category,
+            "difficulty": question.difficulty
+        }
+        
+        response = self.client().post("/questions", json=body)
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response_data['status_code'], 201)
+        self.assertIn(question_id, [duplicate['id'] for duplicate in response_data['near_duplicates']])
+        
+        self.client().delete(f"/questions/{response_data['question_id']}")
+
+
+    def test_export_questions_as_ndjson_resumes_after_id(self):
+        """Exporting returns one JSON record per question with an id greater than `after_id`"""
+        
+        question = Question.query.order_by(Question.id).first()
+        
+        response = self.client().get(f"/questions/export?after_id={question.id}")
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(records), Question.query.filter(Question.id > question.id).count())
+        self.assertTrue(all(record['id'] > question.id for record in records))
+        self.assertIn('category_type', records[0])
+        
+        
+    @unittest.skipUnless('parquet' in available_formats(), "pyarrow is not installed")
+    def test_export_questions_as_parquet_keeps_integer_categories(self):
+        """Parquet exports type the category as an integer, like the other formats"""
+        
+        import pyarrow.parquet
+        
+        response = self.client().get("/questions/export?format=parquet")
+        table = pyarrow.parquet.read_table(io.BytesIO(response.data))
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(str(table.schema.field('category').type), 'int64')
+        self.assertEqual(table.num_rows, Question.query.count())
+        
+        
+    def test_422_export_questions_with_unknown_format(self):
+        """Exporting in an unsupported format returns 422"""
+        
+        response = self.client().get("/questions/export?format=xml")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(response_data['success'])
+
+
+    def test_get_next_questions_for_quiz_with_count(self):
+        """Passing `count` returns that many distinct questions that are not previous questions"""
+        
+        previous_question = Question.query.first()
+        body = {
+            "previous_questions": [previous_question.id],
+            "quiz_category": "",
+            "count": 3
+        }
+        
+        response = self.client().post("/quizzes", json=body)
+        response_data = json.loads(response.data)
+        question_ids = [question['id'] for question in response_data['questions']]
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(question_ids), 3)
+        self.assertEqual(len(set(question_ids)), 3)
+        self.assertNotIn(previous_question.id, question_ids)
+        self.assertEqual(response_data['question'], response_data['questions'][0])
+        
+        # count must be between 1 and 50
+        body['count'] = 0
+        response = self.client().post("/quizzes", json=body)
+        
+        self.assertEqual(response.status_code, 422)
+
+
+    def test_get_next_questions_for_quiz_with_category_weights(self):
+        """`quiz_categories` draws from the weighted categories only and skips previous questions"""
+        
+        science = [question.id for question in Question.query.filter(Question.category == 1)]
+        art = [question.id for question in Question.query.filter(Question.category == 2)]
+        body = {
+            "previous_questions": science[:1],
+            "quiz_categories": {"1": 3, "2": 1},
+            "count": len(science) + len(art)
+        }
+        
+        response = self.client().post("/quizzes", json=body)
+        response_data = json.loads(response.data)
+        question_ids = [question['id'] for question in response_data['questions']]
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(question_ids), sorted(science[1:] + art))
+        
+        # A question created afterwards joins the pool of its category
+        question = Question("Which element has the symbol W?", "Tungsten", 1, 2)
+        question.insert()
+        self.app.extensions['category_pools'].add(question.id, question.category)
+        body = {"previous_questions": science, "quiz_categories": {"1": 1}}
+        response_data = json.loads(self.client().post("/quizzes", json=body).data)
+        self.assertEqual(response_data['question']['id'], question.id)
+        
+        body['previous_questions'].append(question.id)
+        response = self.client().post("/quizzes", json=body)
+        self.assertEqual(response.status_code, 404)
+        
+        for weights in ({}, {"1": 0}, {"science": 1}, {"1": True}):
+            response = self.client().post("/quizzes", json={"previous_questions": [], "quiz_categories": weights})
+            self.assertEqual(response.status_code, 422)
+        response = self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": 1, "quiz_categories": {"2": 1}})
+        self.assertEqual(response.status_code, 422)
+        for count in ("abc", 100000, -5, True):
+            response = self.client().post("/quizzes", json={
+                "previous_questions": [], "quiz_categories": {"1": 1}, "count": count})
+            self.assertEqual(response.status_code, 422)
+
+
+    def test_get_questions_columnar_and_gzip(self):
+        """Listing endpoints return parallel arrays with `shape=columnar` and compress large bodies"""
+        
+        response = self.client().get("/questions?shape=columnar")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_data['shape'], 'columnar')
+        self.assertIsInstance(response_data['questions']['id'], list)
+        self.assertEqual(len(response_data['questions']['id']), len(response_data['questions']['answer']))
+        
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        self.addCleanup(self.app.config.pop, 'COMPRESSION_MIN_SIZE')
+        response = self.client().get("/questions", headers={"Accept-Encoding": "gzip"})
+        
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(json.loads(gzip.decompress(response.data))['success'])
+
+
+    def test_get_metrics_counts_executed_reads(self):
+        """Read requests go through the single-flight layer and are counted in the metrics"""
+        
+        self.app.config['ADMIN_TOKEN'] = "secret"
+        self.client().get("/categories")
+        
+        response = self.client().get("/metrics", headers={"Authorization": "Bearer secret"})
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response_data['single_flight']['executed'], 1)
+        self.assertEqual(response_data['single_flight']['in_flight'], 0)
+
+
+    def test_401_get_metrics_without_admin_token(self):
+        """The metrics of a worker are only served to the admin"""
+        
+        self.app.config['ADMIN_TOKEN'] = "secret"
+        
+        response = self.client().get("/metrics")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(response_data['success'])
+        self.assertNotIn('tenant', response_data)
+
+
+    def test_429_when_client_exceeds_route_rate_limit(self):
+        """A client that empties its token bucket for a route gets 429 with a Retry-After header"""
+        
+        rate_limiter = self.app.extensions['rate_limiter']
+        self.addCleanup(setattr, rate_limiter, 'route_limits', rate_limiter.route_limits)
+        self.addCleanup(self.app.config.update, RATE_LIMIT_ENABLED=False)
+        rate_limiter.route_limits = dict(rate_limiter.route_limits, search_questions=(0.01, 1))
+        self.app.config['RATE_LIMIT_ENABLED'] = True
+        body = {"searchTerm": "a"}
+        
+        response = self.client().post("/questions/search", json=body)
+        self.assertEqual(response.status_code, 200)
+        
+        response = self.client().post("/questions/search", json=body)
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(response_data['success'])
+        self.assertIn('Retry-After', response.headers)
+        
+        # Other routes keep their own bucket
+        response = self.client().get("/categories")
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_rate_limit_buckets_pruned_by_their_own_rate(self):
+        """A full bucket of a fast route is dropped, an empty bucket of a slow route is kept"""
+
+        now = [0]
+        backend = MemoryTokenBucketBackend(max_keys=2, clock=lambda: now[0])
+
+        self.assertEqual(backend.take("client:export_questions", 0.01, 1), (True, 0))
+        self.assertEqual(backend.take("client:get_categories", 10, 50), (True, 0))
+
+        # The categories bucket is full again after 5 seconds, the export bucket after 100
+        now[0] = 10
+        self.assertEqual(backend.take("other:get_categories", 10, 50), (True, 0))
+
+        allowed, retry_after = backend.take("client:export_questions", 0.01, 1)
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 0)
+        
+        
+    def test_503_when_too_many_expensive_requests_in_flight(self):
+        """Expensive routes are shed once the in-flight limit is reached"""
+        
+        load_shedder = self.app.extensions['load_shedder']
+        self.addCleanup(setattr, load_shedder, 'max_in_flight', load_shedder.max_in_flight)
+        load_shedder.max_in_flight = 0
+        
+        response = self.client().post("/quizzes", json={"previous_questions": []})
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response_data['success'])
+        
+        response = self.client().get("/categories")
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_autocomplete_questions_by_prefix(self):
+        """Autocomplete suggests words and questions for a partially typed word"""
+        
+        question = Question.query.first()
+        first_word = question.question.strip().split()[0].lower()
+        
+        response = self.client().get(f"/questions/autocomplete?q={first_word[:2]}&limit=20")
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response_data['success'])
+        self.assertTrue(all(term.startswith(first_word[:2]) for term in response_data['terms']))
+        self.assertLessEqual(len(response_data['questions']), 20)
+        
+        # A new question is suggested without rebuilding the index
+        response = self.client().post("/questions", json=self.test_question)
+        question_id = json.loads(response.data)['question_id']
+        
+        response = self.client().get(f"/questions/autocomplete?q={self.test_question['question']}")
+        response_data = json.loads(response.data)
+        
+        self.assertIn(question_id, [question['id'] for question in response_data['questions']])
+        
+        self.client().delete(f"/questions/{question_id}")
+
+
+    def test_search_questions_pages_with_cursor(self):
+        """Search returns `limit` questions per page, the total of all matches and a cursor for the next page"""
+        
+        body = {"searchTerm": "e", "limit": 2}
+        
+        response = self.client().post("/questions/search", json=body)
+        first_page = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(first_page['questions']), 2)
+        self.assertGreater(first_page['totalQuestions'], 2)
+        self.assertIsNotNone(first_page['next_cursor'])
+        
+        body['cursor'] = first_page['next_cursor']
+        response = self.client().post("/questions/search", json=body)
+        second_page = json.loads(response.data)
+        
+        self.assertEqual(second_page['totalQuestions'], first_page['totalQuestions'])
+        self.assertGreater(second_page['questions'][0]['id'], first_page['questions'][-1]['id'])
+        
+        
+    def test_search_questions_in_category(self):
+        """Search only returns questions of the given category"""
+        
+        response = self.client().post("/questions/search", json={"searchTerm": "", "category": 1})
+        response_data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(int(question['category']) == 1 for question in response_data['questions']))
+        
+        response = self.client().post("/questions/search", json={"searchTerm": "", "limit": 1000})
+        
+        self.assertEqual(response.status_code, 422)
+
+    def test_change_feed_applies_writes_of_other_workers(self):
+        """Questions written without the endpoints reach the autocomplete index through the change feed"""
+
+        self.client().get("/questions/autocomplete?q=what")
+        change_feed = self.app.extensions['change_feed']
+
+        with self.app.app_context():
+            # Written like another worker would, without touching this worker's index
+            question = Question("Which zanzibarian sultan ruled the shortest?", "Khalid bin Barghash", 4, 5)
+            question.insert()
+            question_id = question.id
+            self.assertGreaterEqual(change_feed.poll(), 1)
+
+        response_data = json.loads(self.client().get("/questions/autocomplete?q=zanzibar").data)
+        self.assertEqual([question['id'] for question in response_data['questions']], [question_id])
+
+        with self.app.app_context():
+            Question.query.get(question_id).delete()
+            change_feed.poll()
+
+        response_data = json.loads(self.client().get("/questions/autocomplete?q=zanzibar").data)
+        self.assertEqual(response_data['questions'], [])
+
+    def test_questions_are_localized_from_accept_language(self):
+        """A saved translation is served to the clients asking for its locale, in listings, search and autocomplete"""
+
+        question = Question.query.order_by(Question.id).first()
+        question_id, original = question.id, question.question
+        translation = {"question": "Quelle est la réponse zéphyrine ?", "answer": "Quarante-deux"}
+
+        response = self.client().put(f"/questions/{question_id}/translations/FR", json=translation)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['translation']['locale'], 'fr')
+
+        headers = {"Accept-Language": "fr-CA,fr;q=0.9,en;q=0.5"}
+        response = self.client().get("/questions", headers=headers)
+        questions = {question['id']: question for question in json.loads(response.data)['questions']}
+
+        self.assertEqual(response.headers['Content-Language'], 'fr')
+        self.assertEqual(questions[question_id]['question'], translation['question'])
+        self.assertEqual(questions[question_id]['answer'], translation['answer'])
+
+        response_data = json.loads(self.client().post("/questions/search", json={"searchTerm": "zéphyrine"},
+                                                      headers=headers).data)
+        self.assertEqual([question['id'] for question in response_data['questions']], [question_id])
+
+        response_data = json.loads(self.client().get("/questions/autocomplete?q=zéph", headers=headers).data)
+        self.assertEqual(response_data['terms'], ['zéphyrine'])
+
+        response = self.client().get("/questions")
+        questions = {question['id']: question for question in json.loads(response.data)['questions']}
+        self.assertEqual(response.headers['Content-Language'], 'en')
+        self.assertEqual(questions[question_id]['question'], original)
+
+    def test_422_put_translation_with_invalid_locale(self):
+        """A translation needs a valid language tag other than the default locale"""
+
+        question_id = Question.query.first().id
+        for locale in ("not a locale!", "en"):
+            response = self.client().put(f"/questions/{question_id}/translations/{locale}",
+                                         json={"question": "Question", "answer": "Answer"})
+            self.assertEqual(response.status_code, 422)
+
+
+class WriteBehindTestCase(DatabaseTestCase):
+    """Questions created in write-behind mode"""
+
+    def setUp(self):
+        queue_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_directory)
+        self.app_config = {
+            "QUESTION_WRITE_MODE": "write-behind",
+            "QUESTION_QUEUE_FLUSH_SECONDS": 0,
+            "QUESTION_QUEUE_PATH": os.path.join(queue_directory, "queue.db")
+        }
+        super().setUp()
+        self.client = self.app.test_client
+        self.new_question = {
+            "question": "Which planet has the most moons?",
+            "answer": "Saturn",
+            "category": 1,
+            "difficulty": 3
+        }
+
+    def flush(self):
+        with self.app.app_context():
+            return self.app.extensions['question_writer'].flush()
+
+    def test_create_question_write_behind_with_idempotency_key(self):
+        """A queued question is inserted by the writer, and retries with the same key are not queued again"""
+
+        headers = {"Idempotency-Key": "retry-me"}
+        response = self.client().post("/questions", json=self.new_question, headers=headers)
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response_data['status'], 'queued')
+        self.assertIsNone(response_data['question_id'])
+
+        retry = json.loads(self.client().post("/questions", json=self.new_question, headers=headers).data)
+        self.assertEqual(retry['tracking_id'], response_data['tracking_id'])
+
+        response = self.client().post("/questions", json=dict(self.new_question, answer="Jupiter"), headers=headers)
+        self.assertEqual(response.status_code, 422)
+
+        self.assertEqual(self.flush(), 1)
+
+        response = self.client().get(f"/questions/queue/{response_data['tracking_id']}")
+        status = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(status['status'], 'created')
+        self.assertEqual(Question.query.get(status['question_id']).answer, "Saturn")
+
+    def test_write_behind_rejects_existing_question(self):
+        """A queued question that already exists is rejected when it is flushed"""
+
+        question = Question.query.first()
+        question_id = question.id
+        body = {"question": question.question, "answer": question.answer,
+                "category": question.category, "difficulty": question.difficulty}
+        tracking_id = json.loads(self.client().post("/questions", json=body).data)['tracking_id']
+
+        self.assertEqual(self.flush(), 0)
+
+        status = json.loads(self.client().get(f"/questions/queue/{tracking_id}").data)
+        self.assertEqual(status['status'], 'rejected')
+        self.assertEqual(status['question_id'], question_id)
+        self.assertIn('already exists', status['error'])
+
+    def test_queue_shared_by_workers(self):
+        """Workers sharing a queue file never claim the same entry, nor fail on a shared idempotency key"""
+
+        path = self.app_config["QUESTION_QUEUE_PATH"]
+        first, second = QuestionQueue(path), QuestionQueue(path, claim_lease=0)
+        entry, added = first.enqueue(self.new_question, "shared-key")
+        first.enqueue(dict(self.new_question, answer="Jupiter"))
+
+        # The key was enqueued by the other worker between the lookup and the insert
+        lookups = iter([None])
+        known_key = second._known_key
+        with mock.patch.object(second, '_known_key',
+                               side_effect=lambda *args: next(lookups, None) or known_key(*args)):
+            retry, retry_added = second.enqueue(self.new_question, "shared-key")
+        self.assertTrue(added)
+        self.assertFalse(retry_added)
+        self.assertEqual(retry['tracking_id'], entry['tracking_id'])
+
+        first_claim, first_batch = first.claim(1)
+        _, second_batch = QuestionQueue(path).claim(10)
+        self.assertEqual(len(first_batch), 1)
+        self.assertEqual(len(second_batch), 1)
+        self.assertNotEqual(first_batch[0][0], second_batch[0][0])
+        self.assertEqual(first.get(first_batch[0][0])['status'], 'queued')
+
+        # An expired claim is taken over and the late writer completes nothing
+        takeover_claim, takeover_batch = second.claim(10)
+        self.assertIn(first_batch[0], takeover_batch)
+        first.complete(first_claim, [(first_batch[0][0], 'created', 1, [], None)])
+        self.assertEqual(first.get(first_batch[0][0])['status'], 'queued')
+        self.assertEqual(first.depth(), 2)
+
+
+    def test_404_get_unknown_queued_question(self):
+        """A tracking id that was never returned is not found"""
+
+        response = self.client().get("/questions/queue/unknown")
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response_data['success'])
+
+    def test_write_behind_rejects_entry_that_keeps_failing(self):
+        """An entry the database refuses does not hold up its batch, and is rejected after the last attempt"""
+
+        bad = json.loads(self.client().post("/questions", json=self.new_question).data)['tracking_id']
+        good = json.loads(self.client().post(
+            "/questions", json=dict(self.new_question, answer="Jupiter")).data)['tracking_id']
+
+        writer = self.app.extensions['question_writer'].get()
+        check_duplicates = writer.check_duplicates
+
+        def refuse(payload):
+            if payload['answer'] == "Saturn":
+                raise OperationalError("INSERT", {}, Exception("integer out of range"))
+            return check_duplicates(payload)
+
+        with mock.patch.object(writer, 'check_duplicates', side_effect=refuse):
+            self.assertEqual(self.flush(), 1)
+            self.assertEqual(json.loads(self.client().get(f"/questions/queue/{good}").data)['status'], 'created')
+            self.assertEqual(json.loads(self.client().get(f"/questions/queue/{bad}").data)['status'], 'queued')
+
+            for _ in range(writer.max_attempts - 1):
+                self.assertEqual(self.flush(), 0)
+
+        status = json.loads(self.client().get(f"/questions/queue/{bad}").data)
+        self.assertEqual(status['status'], 'rejected')
+        self.assertIn('integer out of range', status['error'])
+
+    def test_write_behind_retry_after_crash_records_own_insert(self):
+        """An entry whose writer stopped after the commit is created once, not rejected as a duplicate of itself"""
+
+        tracking_id = json.loads(self.client().post("/questions", json=self.new_question).data)['tracking_id']
+
+        writer = self.app.extensions['question_writer'].get()
+        with mock.patch.object(writer.queue, 'complete', side_effect=RuntimeError("worker died")):
+            with self.assertRaises(RuntimeError):
+                self.flush()
+        question_id = Question.query.filter_by(answer="Saturn").one().id
+
+        # The claim of the dead writer expired
+        writer.queue.claim_lease = 0
+        self.assertEqual(self.flush(), 0)
+
+        status = json.loads(self.client().get(f"/questions/queue/{tracking_id}").data)
+        self.assertEqual(status['status'], 'created')
+        self.assertEqual(status['question_id'], question_id)
+        self.assertEqual(Question.query.filter_by(answer="Saturn").count(), 1)
+
+
+class TenantDispatcherTestCase(unittest.TestCase):
+    """Requests of each tenant are served from its own database"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        tenants = {}
+        for tenant, bank_size in (("small", None), ("large", 200)):
+            path = os.path.join(cls.directory, f"{tenant}.db")
+            build_database(path, bank_size)
+            tenants[tenant] = {"database_url": f"sqlite:///{path}"}
+        cls.dispatcher = TenantDispatcher(tenants, TEST_CONFIG)
+
+    @classmethod
+    def tearDownClass(cls):
+        for app in cls.dispatcher.apps.values():
+            with app.app_context():
+                db.get_engine(app).dispose()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.client = Client(self.dispatcher)
+
+    def test_questions_are_partitioned_by_tenant(self):
+        """Each tenant sees its own question bank"""
+
+        totals = {}
+        for tenant in ("small", "large"):
+            response = self.client.get("/questions", headers={"X-Tenant-ID": tenant})
+            self.assertEqual(response.status_code, 200)
+            totals[tenant] = response.json['total_questions']
+
+        self.assertEqual(totals, {"small": 19, "large": 200})
+
+        response = self.client.post("/quizzes", json={"previous_questions": [], "quiz_category": 1, "count": 50},
+                                    headers={"X-Tenant-ID": "large"})
+        self.assertTrue(all(question['question'].endswith('?') and question['answer'].startswith('The ')
+                            for question in response.json['questions']))
+
+    def test_tenant_header_cannot_override_the_host(self):
+        """With a host suffix the tenant comes from the host, whatever the header says"""
+
+        dispatcher = TenantDispatcher(self.dispatcher.tenants, TEST_CONFIG, host_suffix=".trivia.test")
+        dispatcher._apps = self.dispatcher._apps
+        client = Client(dispatcher)
+
+        response = client.get("/questions", base_url="http://small.trivia.test", headers={"X-Tenant-ID": "large"})
+        self.assertEqual(response.json['total_questions'], 19)
+
+        dispatcher.trust_tenant_header = True
+        response = client.get("/questions", base_url="http://small.trivia.test", headers={"X-Tenant-ID": "large"})
+        self.assertEqual(response.json['total_questions'], 200)
+
+    def test_404_unknown_tenant(self):
+        """A request without a known tenant is rejected"""
+
+        for headers in ({"X-Tenant-ID": "unknown"}, {}):
+            response = self.client.get("/categories", headers=headers)
+            self.assertEqual(response.status_code, 404)
+            self.assertFalse(response.json['success'])
+
+
+class SnapshotReadTestCase(DatabaseTestCase):
+    """Read endpoints served from the in-memory question snapshot"""
+
+    app_config = {"READ_MODE": "snapshot", "ADMIN_TOKEN": "secret"}
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+
+    def test_snapshot_serves_the_same_reads_as_the_database(self):
+        """Listings, category questions and search return the rows of the database"""
+
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.order_by(Question.id).limit(10)]
+            science = [question.id for question in Question.query.filter(Question.category == 1).order_by(Question.id)]
+            matching = [question.id for question in Question.query.filter(Question.question.ilike('%title%')).order_by(Question.id)]
+
+        response_data = json.loads(self.client().get("/questions").data)
+        self.assertEqual(response_data['questions'], expected)
+        self.assertEqual(response_data['categories']['1'], 'Science')
+
+        response_data = json.loads(self.client().get("/categories/1/questions").data)
+        self.assertEqual([question['id'] for question in response_data['questions']], science)
+        self.assertEqual(response_data['currentCategory'], 'Science')
+
+        response_data = json.loads(self.client().post("/questions/search", json={"searchTerm": "TITLE", "limit": 1}).data)
+        self.assertEqual(response_data['totalQuestions'], len(matching))
+        self.assertEqual(response_data['questions'][0]['id'], matching[0])
+        self.assertEqual(response_data['next_cursor'], matching[0])
+
+        response = self.client().get("/categories/1000/questions")
+        self.assertEqual(response.status_code, 404)
+
+    def test_snapshot_quiz_and_version_swap(self):
+        """Quiz questions come from the snapshot, which is replaced when the change feed reports a write"""
+
+        with self.app.app_context():
+            science = {question.id for question in Question.query.filter(Question.category == 1)}
+
+        response_data = json.loads(self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": 1, "count": len(science) + 1}).data)
+        self.assertEqual({question['id'] for question in response_data['questions']}, science)
+
+        response = self.client().post("/quizzes", json={"previous_questions": sorted(science), "quiz_category": 1})
+        self.assertEqual(response.status_code, 404)
+
+        snapshot = self.app.extensions['snapshot']
+        version = snapshot.current().version
+        with self.app.app_context():
+            question = Question("Which zanzibarian sultan ruled the shortest?", "Khalid bin Barghash", 1, 5)
+            question.insert()
+            question_id = question.id
+            self.app.extensions['change_feed'].poll()
+
+        self.assertGreater(snapshot.current().version, version)
+        response_data = json.loads(self.client().post("/quizzes", json={
+            "previous_questions": sorted(science), "quiz_category": 1}).data)
+        self.assertEqual(response_data['question']['id'], question_id)
+
+        response_data = json.loads(self.client().post("/quizzes", json={
+            "previous_questions": sorted(science), "quiz_categories": {"1": 1, "2": 1}, "count": 50}).data)
+        picked = {question['id'] for question in response_data['questions']}
+        self.assertIn(question_id, picked)
+        self.assertFalse(picked & science)
+        self.assertEqual({question['category'] for question in response_data['questions']}, {1, 2})
+
+        metrics = json.loads(self.client().get("/metrics", headers={"Authorization": "Bearer secret"}).data)['snapshot']
+        self.assertEqual(metrics['questions'], len(snapshot.current()))
+        self.assertGreater(metrics['bytes_per_million_questions'], 0)
+
+
+class QuestionPackTestCase(DatabaseTestCase):
+    """Read endpoints served from a memory-mapped question pack"""
+
+    def setUp(self):
+        pack_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pack_directory)
+        self.pack_path = os.path.join(pack_directory, "questions.pack")
+        self.app_config = {
+            "READ_MODE": "pack",
+            "QUESTION_PACK_PATH": self.pack_path,
+            "QUESTION_PACK_CHECK_SECONDS": 0,
+            "ADMIN_TOKEN": "secret"
+        }
+        super().setUp()
+        self.client = self.app.test_client
+        result = self.app.test_cli_runner().invoke(args=["build-question-pack"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_pack_serves_the_same_reads_as_the_database(self):
+        """Listings, category questions, search and quizzes are read from the mapped pack"""
+
+        with self.app.app_context():
+            expected = [question.format() for question in Question.query.order_by(Question.id).limit(10)]
+            art = {question.id for question in Question.query.filter(Question.category == 2)}
+
+        response_data = json.loads(self.client().get("/questions").data)
+        self.assertEqual(response_data['questions'], expected)
+
+        response_data = json.loads(self.client().get("/categories/2/questions").data)
+        self.assertEqual({question['id'] for question in response_data['questions']}, art)
+        self.assertEqual(response_data['currentCategory'], 'Art')
+
+        response_data = json.loads(self.client().post("/questions/search", json={"searchTerm": "Title"}).data)
+        self.assertGreater(response_data['totalQuestions'], 0)
+        self.assertTrue(all('title' in question['question'].lower() for question in response_data['questions']))
+
+        response_data = json.loads(self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": 2, "count": len(art)}).data)
+        self.assertEqual({question['id'] for question in response_data['questions']}, art)
+
+        metrics = json.loads(self.client().get("/metrics", headers={"Authorization": "Bearer secret"}).data)['snapshot']
+        self.assertTrue(metrics['mapped'])
+        self.assertEqual(metrics['questions'], len(self.app.extensions['snapshot'].current()))
+
+    def test_rebuilt_pack_is_mapped_by_running_workers(self):
+        """A pack written over the mapped one is picked up without a restart"""
+
+        self.client().get("/questions")
+        with self.app.app_context():
+            question = Question("Which zanzibarian sultan ruled the shortest?", "Khalid bin Barghash", 4, 5)
+            question.insert()
+            question_id = question.id
+
+        response_data = json.loads(self.client().post("/questions/search", json={"searchTerm": "zanzibar"}).data)
+        self.assertEqual(response_data['questions'], [])
+
+        self.app.test_cli_runner().invoke(args=["build-question-pack"])
+        response_data = json.loads(self.client().post("/questions/search", json={"searchTerm": "zanzibar"}).data)
+        self.assertEqual([question['id'] for question in response_data['questions']], [question_id])
+        self.assertEqual(self.app.extensions['snapshot'].reloads, 2)
+
+    def test_invalid_pack_is_rejected(self):
+        """A file that is not a question pack is not mapped"""
+
+        with open(self.pack_path, "wb") as pack:
+            pack.write(b"not a question pack")
+
+        with self.assertRaises(ValueError):
+            open_pack(self.pack_path)
+
+
+class BatchJobTestCase(DatabaseTestCase):
+    """Batch jobs started and followed through the admin API"""
+
+    app_config = {"ADMIN_TOKEN": "secret", "JOB_WORKERS": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+        self.headers = {"Authorization": "Bearer secret"}
+        self.job_runner = self.app.extensions['job_runner']
+
+    def run_job(self, body):
+        response = self.client().post("/admin/jobs", json=body, headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data)['job']['id']
+        self.assertTrue(self.job_runner.wait(job_id, timeout=60).done.is_set())
+        return json.loads(self.client().get(f"/admin/jobs/{job_id}", headers=self.headers).data)['job']
+
+    def test_admin_api_requires_the_admin_token(self):
+        """The admin API answers 401 without the token and 403 when no token is configured"""
+
+        response = self.client().get("/admin/jobs", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(json.loads(response.data)['success'])
+
+        self.app.config['ADMIN_TOKEN'] = None
+        response = self.client().get("/admin/jobs", headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+    def test_validate_import_job(self):
+        """An import is validated in chunks and its invalid and duplicate questions are reported"""
+
+        existing = Question.query.order_by(Question.id).first()
+        new_question = {"question": "Which planet has the most moons?", "answer": "Saturn", "category": 1, "difficulty": 3}
+        job = self.run_job({"type": "validate", "questions": [
+            new_question,
+            dict(new_question, category="science"),
+            dict(new_question, category=1000),
+            {"question": existing.question, "answer": existing.answer, "category": existing.category, "difficulty": 1},
+            dict(new_question, question="which planet has the most MOONS")
+        ]})
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['progress'], 1.0)
+        self.assertEqual(job['result']['valid'], 1)
+        self.assertEqual([problem['index'] for problem in job['result']['problems']], [1, 2, 3, 4])
+        self.assertIn(f"ID {existing.id}", job['result']['problems'][2]['error'])
+        self.assertIn("index 0", job['result']['problems'][3]['error'])
+
+        response = self.client().post("/admin/jobs", json={"type": "validate"}, headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+        response = self.client().post("/admin/jobs", json={"type": "unknown"}, headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_dedup_and_reindex_jobs_on_the_process_pool(self):
+        """Signatures and postings are computed by pool processes and the rebuilt indexes are swapped in"""
+
+        self.job_runner.max_workers = 2
+        self.job_runner.chunk_size = 5
+        self.client().get("/questions/autocomplete?q=what")
+        with self.app.app_context():
+            original = Question.query.filter(Question.answer == 'Edward Scissorhands').one()
+            # Written like another worker would, without touching this worker's indexes
+            paraphrase = Question(original.question.replace("What was", "What is"), original.answer, 5, 3)
+            paraphrase.insert()
+            paraphrase_id, original_id = paraphrase.id, original.id
+
+        job = self.run_job({"type": "dedup", "threshold": 0.6})
+        self.assertEqual(job['status'], 'succeeded', job['error'])
+        self.assertGreater(job['chunks_total'], 1)
+        self.assertIn(sorted([original_id, paraphrase_id]), job['result']['clusters'])
+
+        job = self.run_job({"type": "reindex"})
+        self.assertEqual(job['status'], 'succeeded', job['error'])
+        response_data = json.loads(self.client().get("/questions/autocomplete?q=appendage").data)
+        self.assertIn(paraphrase_id, [question['id'] for question in response_data['questions']])
+
+        jobs = json.loads(self.client().get("/admin/jobs", headers=self.headers).data)['jobs']
+        self.assertEqual([job['type'] for job in jobs], ['reindex', 'dedup'])
+
+
+class ErrorHandlingTestCase(DatabaseTestCase):
+    """Error responses, their status codes and counters"""
+
+    app_config = {"ADMIN_TOKEN": "secret"}
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+
+    def test_failed_write_returns_500_and_leaves_a_clean_session(self):
+        """A failed commit is rolled back at once, answered with a real 500 and counted by type"""
+
+        new_question = {"question": "Which planet has the most moons?", "answer": "Saturn", "category": 1, "difficulty": 3}
+        with mock.patch.object(db.session, 'commit', side_effect=OperationalError("INSERT", {}, Exception("disk I/O error"))):
+            response = self.client().post("/questions", json=new_question)
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response_data['success'])
+        self.assertEqual(response_data['message'], "The question could not be created")
+
+        # The next request of the worker is not affected by the failed transaction
+        response = self.client().post("/questions", json=new_question)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(json.loads(response.data)['question_id'])
+
+        self.client().delete("/questions/100000")
+        errors = json.loads(self.client().get("/metrics", headers={"Authorization": "Bearer secret"}).data)['errors']
+        self.assertEqual(errors['by_status'], {'404': 1, '500': 1})
+        self.assertEqual(errors['by_type'], {'QuestionNotFound': 1, 'PersistenceError': 1})
+
+    def test_abort_without_custom_message(self):
+        """Errors raised without a custom message use the name of the status"""
+
+        response = self.client().get("/no-such-route")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.data)['message'], "Not Found")
+
+
+class AdminStatsTestCase(DatabaseTestCase):
+    """Data shape and performance statistics of the admin API"""
+
+    app_config = {"ADMIN_TOKEN": "secret", "ADMIN_STATS_CACHE_SECONDS": 60}
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+        self.headers = {"Authorization": "Bearer secret"}
+
+    def test_admin_stats(self):
+        """Table sizes, category skew and the slowest routes are reported, and cached"""
+
+        self.client().get("/questions")
+        self.client().post("/questions/search", json={"searchTerm": "title"})
+        self.assertEqual(self.client().get("/admin/stats").status_code, 401)
+
+        response = self.client().get("/admin/stats", headers=self.headers)
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(response_data['tables']['questions'],
+                             {"rows": Question.query.count(), "estimated": False})
+            science = Question.query.filter(Question.category == 1).count()
+        categories = response_data['categories']
+        self.assertFalse(categories['estimated'])
+        self.assertIn({"id": 1, "type": "Science", "questions": science}, categories['categories'])
+        self.assertEqual(categories['categories'][0]['questions'],
+                         max(category['questions'] for category in categories['categories']))
+        self.assertGreater(categories['max_to_mean'], 1)
+        routes = {route['route']: route for route in response_data['slowest_routes']}
+        self.assertEqual(routes['GET /questions']['requests'], 1)
+        self.assertIn('POST /questions/search', routes)
+        self.assertIn('class', response_data['connection_pool'])
+
+        # Served from the cache until ADMIN_STATS_CACHE_SECONDS have passed
+        self.client().get("/questions")
+        cached = json.loads(self.client().get("/admin/stats", headers=self.headers).data)
+        self.assertEqual(cached['generated_at'], response_data['generated_at'])
+        self.assertEqual(cached['slowest_routes'], response_data['slowest_routes'])
+
+    def test_catalog_estimates_read_the_schema_of_the_tenant(self):
+        """Schema tenants look up the planner statistics of their own schema"""
+
+        app = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI="sqlite://", SQLALCHEMY_ENGINE_OPTIONS={
+            "execution_options": {"schema_translate_map": {None: "acme"}}}))
+        with app.app_context():
+            self.assertEqual(adminstats._schema(), "acme")
+
+    def test_route_timings_percentile(self):
+        """The 95th percentile is the upper bound of its latency bucket"""
+
+        timings = RouteTimings()
+        for _ in range(95):
+            timings.record("GET /fast", 0.0015)
+        for _ in range(5):
+            timings.record("GET /fast", 0.3)
+        timings.record("GET /slow", 0.004)
+
+        # Ranked by the 95th percentile, not by the few slow outliers
+        slow, fast = timings.slowest()
+        self.assertEqual(fast['route'], "GET /fast")
+        self.assertEqual(fast['p95_ms'], 2)
+        self.assertEqual(fast['max_ms'], 300.0)
+        self.assertEqual(slow['p95_ms'], 4.0)
+
+
+class QuizPackTestCase(DatabaseTestCase):
+    """Quiz packs downloaded once, played offline and answered in one submission"""
+
+    app_config = {"QUIZ_PACK_SECRET": "secret", "QUIZ_PACK_SIZE": 3}
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client
+
+    def get_pack(self, category_id, headers=None):
+        response = self.client().get(f"/categories/{category_id}/quiz-pack",
+                                     headers=dict({"Accept-Encoding": "gzip"}, **(headers or {})))
+        return response, json.loads(gzip.decompress(response.data)) if response.status_code == 200 else None
+
+    def test_quiz_pack_is_compressed_cached_and_revalidated(self):
+        """A pack is served gzipped with a strong ETag, rebuilt only when the bank changes"""
+
+        with self.app.app_context():
+            science = {question.id for question in Question.query.filter(Question.category == 1)}
+
+        response, response_data = self.get_pack(1)
+        pack = response_data['pack']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('max-age=300', response.headers['Cache-Control'])
+        self.assertEqual(len(pack['questions']), 3)
+        self.assertLessEqual({question['id'] for question in pack['questions']}, science)
+        self.assertTrue(all(question['answer'] for question in pack['questions']))
+
+        etag = response.headers['ETag']
+        response, _ = self.get_pack(1, {"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.app.extensions['quiz_packs'].stats()['hits'], 1)
+
+        # Without gzip the same pack is sent as plain JSON under another ETag
+        response = self.client().get("/categories/1/quiz-pack")
+        self.assertEqual(json.loads(response.data), response_data)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        with self.app.app_context():
+            Question("Which element has the symbol W?", "Tungsten", 1, 2).insert()
+            self.app.extensions['change_feed'].poll()
+        response, response_data = self.get_pack(1, {"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response_data['pack']['version'], pack['version'])
+
+        response, _ = self.get_pack(1000)
+        self.assertEqual(response.status_code, 404)
+
+    def test_pack_results_are_submitted_in_one_batch(self):
+        """The answers of a pack are recorded with its token, and count as a score"""
+
+        _, response_data = self.get_pack(2)
+        pack = response_data['pack']
+        answers = [{"question_id": question['id'], "correct": index > 0}
+                   for index, question in enumerate(pack['questions'])]
+
+        response = self.client().post("/quizzes/pack-results", json={
+            "token": pack['token'], "player": "ada", "answers": answers})
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response_data['recorded'], 3)
+        self.assertEqual(response_data['score'], 2)
+        self.assertEqual(response_data['ranks'], {"0": 1, "2": 1})
+        with self.app.app_context():
+            self.app.extensions['question_stats'].flush()
+            stat = QuestionStat.query.get(pack['questions'][1]['id'])
+            self.assertEqual((stat.plays, stat.answers, stat.correct), (1, 1, 1))
+
+        forged = pack['token'][:-2] + ('AA' if not pack['token'].endswith('AA') else 'BB')
+        response = self.client().post("/quizzes/pack-results", json={"token": forged, "answers": answers})
+        self.assertEqual(response.status_code, 422)
+        response = self.client().post("/quizzes/pack-results", json={
+            "token": pack['token'], "answers": answers + answers[:1]})
+        self.assertEqual(response.status_code, 422)
+
+        self.app.config['QUIZ_PACK_SECRET'] = None
+        response, _ = self.get_pack(2)
+        self.assertEqual(response.status_code, 403)
+
+
+class TrustedProxyTestCase(DatabaseTestCase):
+    """Clients behind a trusted proxy get their own rate limit buckets"""
+
+    app_config = {"RATE_LIMIT_ENABLED": True, "RATE_LIMIT_DEFAULT": (0.001, 1), "TRUSTED_PROXY_COUNT": 1}
+
+    def test_rate_limit_by_forwarded_address(self):
+        """The address appended by the proxy, not the proxy address, keys the rate limit"""
+
+        first = self.app.test_client().get("/categories", headers={"X-Forwarded-For": "203.0.113.1"})
+        second = self.app.test_client().get("/categories", headers={"X-Forwarded-For": "203.0.113.2"})
+        again = self.app.test_client().get("/categories", headers={"X-Forwarded-For": "203.0.113.1"})
+
+        self.assertEqual((first.status_code, second.status_code, again.status_code), (200, 200, 429))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,56 @@
+import os
+import unittest
+import statistics
+import time
+
+from fixtures import DatabaseTestCase
+
+# Questions in the generated bank
+PERF_BANK_SIZE = int(os.environ.get('PERF_BANK_SIZE', 20000))
+# Median latency budget of one request, in milliseconds
+PERF_BUDGET_MS = float(os.environ.get('PERF_BUDGET_MS', 100))
+PERF_REQUESTS = 30
+
+
+@unittest.skipUnless(os.environ.get('RUN_PERF_TESTS'), "set RUN_PERF_TESTS=1 to run the performance tests")
+class LargeBankPerformanceTestCase(DatabaseTestCase):
+    """Latency regression tests of the hot endpoints on a large generated question bank"""
+
+    bank_size = PERF_BANK_SIZE
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def median_ms(self, send):
+        # The first request warms up the connection and the lazily built indexes
+        send()
+        timings = []
+        for _ in range(PERF_REQUESTS):
+            start = time.perf_counter()
+            response = send()
+            timings.append((time.perf_counter() - start) * 1000)
+            self.assertEqual(response.status_code, 200)
+        return statistics.median(timings)
+
+    def test_get_next_question_latency(self):
+        """A quiz question is picked within the budget, with and without a category"""
+
+        previous_questions = list(range(1, 51))
+        for quiz_category in ("", 3):
+            body = {"previous_questions": previous_questions, "quiz_category": quiz_category}
+            median = self.median_ms(lambda: self.client.post("/quizzes", json=body))
+            self.assertLess(median, PERF_BUDGET_MS, f"/quizzes category={quiz_category!r}")
+
+    def test_search_questions_latency(self):
+        """A search page is returned within the budget, for common and rare terms"""
+
+        for search_term in ("river", "galaxy 4999", "no such question"):
+            body = {"searchTerm": search_term}
+            median = self.median_ms(lambda: self.client.post("/questions/search", json=body))
+            self.assertLess(median, PERF_BUDGET_MS, f"/questions/search searchTerm={search_term!r}")
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
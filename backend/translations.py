@@ -0,0 +1,214 @@
+import re
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import and_, func, select
+
+from autocomplete import PrefixIndex
+from models import db, Question, QuestionTranslation
+
+DEFAULT_LOCALE = 'en'
+
+# Translations kept in memory per locale
+DEFAULT_CACHE_SIZE = 10000
+
+_locale = re.compile(r'^[a-z]{2,3}(-[a-z0-9]{2,8})*$')
+
+
+def normalize_locale(locale):
+    """
+    Returns the lower case form of a language tag such as `pt-BR`, or None if it is not one.
+    """
+    locale = (locale or '').strip().replace('_', '-').lower()
+    return locale if _locale.match(locale) else None
+
+
+def localized_columns(locale, default_locale=DEFAULT_LOCALE):
+    """
+    Returns the FROM clause and the question and answer columns of `locale`:
+    the translated text when there is one and the default text otherwise.
+    """
+    questions = Question.__table__
+    if locale == default_locale:
+        return questions, questions.c.question, questions.c.answer
+    translations = QuestionTranslation.__table__
+    source = questions.outerjoin(translations, and_(translations.c.question_id == questions.c.id,
+                                                    translations.c.locale == locale))
+    return (source,
+            func.coalesce(translations.c.question, questions.c.question),
+            func.coalesce(translations.c.answer, questions.c.answer))
+
+
+"""
+LocalizedPrefixIndex
+
+"""
+class LocalizedPrefixIndex(PrefixIndex):
+    """
+    A `PrefixIndex` over the question text of one locale, built on first use.
+    """
+
+    def __init__(self, locale, default_locale=DEFAULT_LOCALE):
+        super().__init__()
+        self.locale = locale
+        self.default_locale = default_locale
+        self._loaded = False
+
+    def _texts_of(self, question_ids=None):
+        source, question, _ = localized_columns(self.locale, self.default_locale)
+        statement = select(Question.__table__.c.id, question).select_from(source)
+        if question_ids is not None:
+            statement = statement.where(Question.__table__.c.id.in_(sorted(question_ids)))
+        return db.session.execute(statement)
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self.load(self._texts_of())
+            self._loaded = True
+
+    def refresh(self, question_ids):
+        """
+        Reloads the text of `question_ids` and drops the questions that no longer exist.
+        """
+        if not self._loaded or not question_ids:
+            return
+        with self._lock:
+            found = set()
+            for question_id, text in self._texts_of(question_ids):
+                found.add(question_id)
+                self.add(question_id, text)
+            for question_id in set(question_ids) - found:
+                self.remove(question_id)
+
+    def complete(self, text, limit=5):
+        self.ensure_loaded()
+        return super().complete(text, limit)
+
+
+"""
+TranslationStore
+
+"""
+class TranslationStore:
+    """
+    Serves the translated question text of every locale.
+
+    Translations are read a page at a time: the ids missing from the cache of
+    a locale are loaded with a single query, and questions without a
+    translation are cached too so that they are not looked up again. The
+    caches and the per-locale autocomplete indexes are invalidated with
+    `invalidate` when questions or translations change.
+    """
+
+    def __init__(self, default_locale=DEFAULT_LOCALE, cache_size=DEFAULT_CACHE_SIZE):
+        self.default_locale = default_locale
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._caches = {}    # locale -> OrderedDict of question id -> (question, answer) or None
+        self._indexes = {}   # locale -> LocalizedPrefixIndex
+        self._locales = None
+        self._generation = 0  # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+
+    def locales(self):
+        """
+        Returns:
+            list: the default locale and every locale with at least one translation
+        """
+        if self._locales is None:
+            translated = db.session.execute(
+                select(QuestionTranslation.locale).distinct()).scalars().all()
+            self._locales = [self.default_locale] + sorted(set(translated) - {self.default_locale})
+        return self._locales
+
+    def negotiate(self, accept_languages):
+        """
+        Picks the best available locale for an `Accept-Language` header.
+        """
+        return accept_languages.best_match(self.locales(), default=self.default_locale)
+
+    def lookup(self, locale, question_ids):
+        """
+        Returns:
+            dict: question id -> (question, answer) for the ids translated into `locale`
+        """
+        with self._lock:
+            cache = self._caches.setdefault(locale, OrderedDict())
+            found, missing = {}, []
+            for question_id in question_ids:
+                if question_id in cache:
+                    cache.move_to_end(question_id)
+                    if cache[question_id] is not None:
+                        found[question_id] = cache[question_id]
+                else:
+                    missing.append(question_id)
+            self.hits += len(question_ids) - len(missing)
+            self.misses += len(missing)
+            generation = self._generation
+
+        if missing:
+            rows = db.session.execute(
+                select(QuestionTranslation.question_id, QuestionTranslation.question,
+                       QuestionTranslation.answer)
+                .where(QuestionTranslation.locale == locale,
+                       QuestionTranslation.question_id.in_(missing))).all()
+            loaded = {question_id: (question, answer) for question_id, question, answer in rows}
+            found.update(loaded)
+            with self._lock:
+                # Rows read before an invalidation may be stale and are not cached
+                if generation == self._generation:
+                    for question_id in missing:
+                        cache[question_id] = loaded.get(question_id)
+                    while len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+        return found
+
+    def localize(self, questions, locale):
+        """
+        Replaces the `question` and `answer` of formatted questions by their
+        translation into `locale`, where there is one.
+        """
+        if locale == self.default_locale or not questions:
+            return questions
+        translated = self.lookup(locale, [question['id'] for question in questions])
+        for question in questions:
+            if question['id'] in translated:
+                question['question'], question['answer'] = translated[question['id']]
+        return questions
+
+    def prefix_index(self, locale):
+        with self._lock:
+            index = self._indexes.get(locale)
+            if index is None:
+                index = self._indexes[locale] = LocalizedPrefixIndex(locale, self.default_locale)
+        return index
+
+    def invalidate(self, question_ids, new_locales=()):
+        """
+        Forgets the cached translations of `question_ids` in every locale and
+        refreshes them in the loaded autocomplete indexes.
+        """
+        with self._lock:
+            self._generation += 1
+            for cache in self._caches.values():
+                for question_id in question_ids:
+                    cache.pop(question_id, None)
+            if self._locales is not None and set(new_locales) - set(self._locales):
+                self._locales = None
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            index.refresh(question_ids)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'locales': len(self._locales or ()),
+                'cached': sum(len(cache) for cache in self._caches.values()),
+                'hits': self.hits,
+                'misses': self.misses
+            }
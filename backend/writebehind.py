@@ -0,0 +1,347 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from background import PeriodicTask
+from models import db, Question, QuestionWriteReceipt
+
+QUEUED = 'queued'
+WRITING = 'writing'
+CREATED = 'created'
+REJECTED = 'rejected'
+
+# Finished entries are kept this long so that retries with the same
+# idempotency key still get the outcome
+DEFAULT_RETENTION = 24 * 3600
+
+# Entries claimed by a writer that did not complete them within this many
+# seconds, for example because its worker died, are claimed again
+DEFAULT_CLAIM_LEASE = 60
+
+# Failed writes of an entry after which it is rejected, so that one entry the
+# database refuses does not hold up the queue
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def payload_digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+"""
+QuestionQueue
+
+"""
+class QuestionQueue:
+    """
+    Durable queue of questions waiting to be written to the main database,
+    stored in a local SQLite file so that queued questions survive a restart.
+
+    Every entry has a tracking id and optionally the idempotency key of the
+    client. Enqueueing again with a known key returns the existing entry
+    instead of adding a second one.
+
+    The file is shared by every worker of the host. A writer claims a batch
+    with a single UPDATE before writing it and completes only the entries of
+    its claim, so two workers never write the same entry; a claim that is
+    not completed within `claim_lease` seconds is taken over by the next one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pending_questions (
+        tracking_id TEXT PRIMARY KEY,
+        idempotency_key TEXT UNIQUE,
+        digest TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        question_id INTEGER,
+        near_duplicates TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at REAL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS ix_pending_questions_status ON pending_questions (status, created_at);
+    """
+
+    def __init__(self, path, retention=DEFAULT_RETENTION, claim_lease=DEFAULT_CLAIM_LEASE):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.retention = retention
+        self.claim_lease = claim_lease
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        # Queue files created before claims were added
+        columns = {row['name'] for row in self._connection.execute('PRAGMA table_info(pending_questions)')}
+        for column, kind in (('attempts', 'INTEGER NOT NULL DEFAULT 0'), ('claimed_by', 'TEXT'),
+                             ('claimed_at', 'REAL')):
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE pending_questions ADD COLUMN {column} {kind}')
+
+    @staticmethod
+    def _format(row):
+        entry = {
+            'tracking_id': row['tracking_id'],
+            # A claimed entry is still waiting to be written for the client
+            'status': QUEUED if row['status'] == WRITING else row['status'],
+            'question_id': row['question_id'],
+            'near_duplicates': json.loads(row['near_duplicates'] or '[]'),
+        }
+        if row['error']:
+            entry['error'] = row['error']
+        return entry
+
+    def enqueue(self, payload, idempotency_key=None):
+        """
+        Adds a validated question to the queue.
+
+        Returns:
+            tuple: the entry and whether it was added (False for a known idempotency key)
+
+        Raises:
+            ValueError: when the idempotency key was used for a different question
+        """
+        digest = payload_digest(payload)
+        now = time.time()
+        with self._lock:
+            if idempotency_key is not None:
+                existing = self._known_key(idempotency_key, digest)
+                if existing is not None:
+                    return existing, False
+
+            tracking_id = uuid.uuid4().hex
+            try:
+                self._connection.execute(
+                    'INSERT INTO pending_questions (tracking_id, idempotency_key, digest, payload, '
+                    'status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (tracking_id, idempotency_key, digest, json.dumps(payload), QUEUED, now, now))
+            except sqlite3.IntegrityError:
+                # Another worker enqueued the same key since the lookup above
+                existing = self._known_key(idempotency_key, digest) if idempotency_key is not None else None
+                if existing is None:
+                    raise
+                return existing, False
+            row = self._connection.execute(
+                'SELECT * FROM pending_questions WHERE tracking_id = ?', (tracking_id,)).fetchone()
+            return self._format(row), True
+
+    def _known_key(self, idempotency_key, digest):
+        row = self._connection.execute(
+            'SELECT * FROM pending_questions WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+        if row is None:
+            return None
+        if row['digest'] != digest:
+            raise ValueError("The idempotency key was already used for a different question")
+        return self._format(row)
+
+    def get(self, tracking_id):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT * FROM pending_questions WHERE tracking_id = ?', (tracking_id,)).fetchone()
+        return self._format(row) if row is not None else None
+
+    def claim(self, limit):
+        """
+        Claims up to `limit` queued entries, oldest first, and the entries
+        whose claim expired, so that no other writer takes them.
+
+        Returns:
+            tuple: the claim id and the claimed (tracking id, payload) pairs
+        """
+        claim_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                'UPDATE pending_questions SET status = ?, claimed_by = ?, claimed_at = ? '
+                'WHERE tracking_id IN (SELECT tracking_id FROM pending_questions '
+                'WHERE status = ? OR (status = ? AND claimed_at < ?) ORDER BY created_at LIMIT ?)',
+                (WRITING, claim_id, now, QUEUED, WRITING, now - self.claim_lease, limit))
+            rows = self._connection.execute(
+                'SELECT tracking_id, payload FROM pending_questions WHERE claimed_by = ? AND status = ? '
+                'ORDER BY created_at', (claim_id, WRITING)).fetchall()
+        return claim_id, [(row['tracking_id'], json.loads(row['payload'])) for row in rows]
+
+    def release(self, claim_id):
+        """
+        Puts the entries of a claim that could not be written back in the queue.
+        """
+        with self._lock:
+            self._connection.execute(
+                'UPDATE pending_questions SET status = ?, claimed_by = NULL, claimed_at = NULL '
+                'WHERE claimed_by = ? AND status = ?', (QUEUED, claim_id, WRITING))
+
+    def fail(self, claim_id, failures, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Puts the entries of a claim whose write failed back in the queue, or
+        rejects them with the error once they failed `max_attempts` times.
+
+        Args:
+            failures (list): (tracking_id, error) pairs
+        """
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                self._connection.executemany(
+                    'UPDATE pending_questions SET attempts = attempts + 1, '
+                    'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, '
+                    'error = CASE WHEN attempts + 1 >= ? THEN ? END, '
+                    'claimed_by = NULL, claimed_at = NULL, updated_at = ? '
+                    'WHERE tracking_id = ? AND claimed_by = ?',
+                    [(max_attempts, REJECTED, QUEUED, max_attempts,
+                      f"The question could not be written: {error}", now, tracking_id, claim_id)
+                     for tracking_id, error in failures])
+
+    def complete(self, claim_id, outcomes):
+        """
+        Records the outcome of the flushed entries of a claim and drops the
+        finished entries older than the retention period, in one transaction.
+        Entries whose claim expired and was taken over are left to the new claim.
+
+        Args:
+            outcomes (list): (tracking_id, status, question_id, near_duplicates, error) tuples
+        """
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                self._connection.executemany(
+                    'UPDATE pending_questions SET status = ?, question_id = ?, near_duplicates = ?, '
+                    'error = ?, updated_at = ? WHERE tracking_id = ? AND claimed_by = ?',
+                    [(status, question_id, json.dumps(near_duplicates), error, now, tracking_id, claim_id)
+                     for tracking_id, status, question_id, near_duplicates, error in outcomes])
+                self._connection.execute(
+                    'DELETE FROM pending_questions WHERE status NOT IN (?, ?) AND updated_at < ?',
+                    (QUEUED, WRITING, now - self.retention))
+
+    def depth(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT count(*) FROM pending_questions WHERE status IN (?, ?)', (QUEUED, WRITING)).fetchone()[0]
+
+
+"""
+QuestionWriter
+
+"""
+class QuestionWriter:
+    """
+    Moves queued questions into the `questions` table from a background thread
+    every `flush_interval` seconds, `batch_size` questions per transaction.
+
+    The checks of the synchronous `POST /questions` are done here: a question
+    that already exists is rejected, and so is a near duplicate when
+    `check_duplicates` says so. `on_created` is called with every inserted question.
+
+    Every entry is written under its own savepoint. An entry the database
+    refuses is retried by the next flushes and rejected after `max_attempts`
+    failures, while the rest of its batch is committed.
+
+    A receipt with the tracking id is committed with every inserted question,
+    so an entry written by a writer that stopped before completing its claim
+    is recorded as created, not as a duplicate of itself, when it is retried.
+    """
+
+    def __init__(self, app, queue, flush_interval=1, batch_size=500,
+                 check_duplicates=None, on_created=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.check_duplicates = check_duplicates
+        self.on_created = on_created
+        self._flush_lock = threading.Lock()
+        self._flusher = PeriodicTask(app, 'question-writer', flush_interval, self.flush,
+                                     run_at_exit=True)
+
+    def start(self):
+        self._flusher.start()
+
+    def flush(self):
+        """
+        Writes the queued questions in batches until the queue is empty.
+        Must be called within an application context.
+
+        Returns:
+            int: The number of questions inserted
+        """
+        inserted = 0
+        with self._flush_lock:
+            while True:
+                claim_id, batch = self.queue.claim(self.batch_size)
+                if not batch:
+                    return inserted
+                created, failed = self._write(claim_id, batch)
+                inserted += created
+                if failed:
+                    # The failed entries are retried by the next flush, not right away
+                    return inserted
+
+    def _write_entry(self, tracking_id, payload):
+        # Autoflush makes the questions added earlier in the batch visible here
+        existing = Question.query.filter_by(
+            question=payload['question'], answer=payload['answer'],
+            category=payload['category']).first()
+        if existing is not None:
+            return (tracking_id, REJECTED, existing.id, [],
+                    f"The question already exists with an ID {existing.id}"), None
+
+        near_duplicates, error = [], None
+        if self.check_duplicates is not None:
+            near_duplicates, error = self.check_duplicates(payload)
+        if error is not None:
+            return (tracking_id, REJECTED, None, near_duplicates, error), None
+
+        question = Question(question=payload['question'], answer=payload['answer'],
+                            category=payload['category'], difficulty=payload['difficulty'])
+        db.session.add(question)
+        db.session.flush()
+        db.session.add(QuestionWriteReceipt(tracking_id, question.id, time.time()))
+        return (tracking_id, CREATED, question.id, near_duplicates, None), question
+
+    def _write(self, claim_id, batch):
+        outcomes, created, failures = [], [], []
+        try:
+            receipts = dict(db.session.query(QuestionWriteReceipt.tracking_id, QuestionWriteReceipt.question_id)
+                            .filter(QuestionWriteReceipt.tracking_id.in_([tracking_id for tracking_id, _ in batch])))
+            for tracking_id, payload in batch:
+                if tracking_id in receipts:
+                    outcomes.append((tracking_id, CREATED, receipts[tracking_id], [], None))
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        outcome, question = self._write_entry(tracking_id, payload)
+                except SQLAlchemyError as error:
+                    failures.append((tracking_id, str(getattr(error, 'orig', None) or error)))
+                    continue
+                outcomes.append(outcome)
+                if question is not None:
+                    created.append(question)
+            db.session.query(QuestionWriteReceipt).filter(
+                QuestionWriteReceipt.created_at < time.time() - self.queue.retention).delete()
+            db.session.commit()
+        except Exception:
+            # The entries go back to the queue and are retried by the next flush
+            db.session.rollback()
+            self.queue.release(claim_id)
+            raise
+
+        # A crash before this line inserts nothing twice: the retry finds the receipts
+        self.queue.complete(claim_id, outcomes)
+        if failures:
+            self.queue.fail(claim_id, failures, self.max_attempts)
+        if self.on_created is not None:
+            for question in created:
+                self.on_created(question)
+        return len(created), len(failures)